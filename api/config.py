@@ -3,7 +3,7 @@ Application Configuration
 Validates and provides access to environment variables
 """
 from pydantic_settings import BaseSettings
-from pydantic import Field, field_validator
+from pydantic import Field, field_validator, model_validator
 from typing import Optional
 from functools import lru_cache
 import os
@@ -22,8 +22,9 @@ class Settings(BaseSettings):
     supabase_service_key: str = Field(..., alias="SUPABASE_SERVICE_KEY")
     supabase_jwt_secret: str = Field(..., alias="SUPABASE_JWT_SECRET")
     
-    # Gemini AI
-    gemini_api_key: str = Field(..., alias="GEMINI_API_KEY")
+    # Gemini AI (not needed with the local simulated provider)
+    llm_provider: str = Field(default="gemini", alias="LLM_PROVIDER")
+    gemini_api_key: Optional[str] = Field(default=None, alias="GEMINI_API_KEY")
     
     # Stripe
     stripe_secret_key: Optional[str] = Field(default=None, alias="STRIPE_SECRET_KEY")
@@ -59,10 +60,16 @@ class Settings(BaseSettings):
     @field_validator('gemini_api_key')
     @classmethod
     def validate_gemini_key(cls, v):
-        if len(v) < 20:
+        if v is not None and len(v) < 20:
             raise ValueError('GEMINI_API_KEY appears to be invalid')
         return v
     
+    @model_validator(mode='after')
+    def require_gemini_key(self):
+        if self.llm_provider.lower() != "local" and not self.gemini_api_key:
+            raise ValueError('GEMINI_API_KEY is required unless LLM_PROVIDER=local')
+        return self
+    
     @property
     def is_production(self) -> bool:
         return self.environment == "production"
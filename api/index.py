@@ -26,8 +26,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Vercel and Lambda enter the lifespan around every invocation (Mangum), so
+# shutdown work there would run after each request
+SERVERLESS = bool(os.getenv("VERCEL") or os.getenv("AWS_LAMBDA_FUNCTION_NAME"))
+
 # Import routers
-from routes import auth, generate, threads, scripts, tokens, payments, user, affiliate
+from routes import auth, generate, threads, scripts, tokens, payments, user, affiliate, search, metrics
 
 
 @asynccontextmanager
@@ -39,7 +43,9 @@ async def lifespan(app: FastAPI):
     logger.info("Starting Pine Script AI Generator API")
     
     # Validate required environment variables
-    required_vars = ["SUPABASE_URL", "SUPABASE_SERVICE_KEY", "SUPABASE_JWT_SECRET", "GEMINI_API_KEY"]
+    required_vars = ["SUPABASE_URL", "SUPABASE_SERVICE_KEY", "SUPABASE_JWT_SECRET"]
+    if os.getenv("LLM_PROVIDER", "gemini").lower() != "local":
+        required_vars.append("GEMINI_API_KEY")
     missing_vars = [var for var in required_vars if not os.getenv(var)]
     
     if missing_vars:
@@ -52,10 +58,18 @@ async def lifespan(app: FastAPI):
     logger.info(f"Redis configured: {bool(os.getenv('UPSTASH_REDIS_URL'))}")
     logger.info(f"Stripe configured: {bool(os.getenv('STRIPE_SECRET_KEY'))}")
     
+    # Build the rulebook section index up front so no request pays for it
+    from services.ai_service import get_context_index
+    logger.info(f"Context index ready: {get_context_index().get_stats()}")
+    
     yield
     
     # Shutdown
     logger.info("Shutting down Pine Script AI Generator API")
+    if not SERVERLESS:
+        # Serverless instances keep the pool warm across invocations
+        from utils.supabase_client import close_db
+        await close_db()
 
 
 # Initialize FastAPI app
@@ -128,7 +142,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["*"],
-    expose_headers=["X-Request-ID"],
+    expose_headers=["X-Request-ID", "X-Next-Cursor"],
 )
 
 # Gzip Compression for responses > 1KB
@@ -144,6 +158,8 @@ app.include_router(tokens.router, prefix="/api/tokens", tags=["Tokens"])
 app.include_router(payments.router, prefix="/api/payments", tags=["Payments"])
 app.include_router(user.router, prefix="/api/user", tags=["User"])
 app.include_router(affiliate.router, prefix="/api/affiliate", tags=["Affiliate"])
+app.include_router(search.router, prefix="/api/search", tags=["Search"])
+app.include_router(metrics.router, prefix="/api/metrics", tags=["System"])
 
 
 # Health check endpoint
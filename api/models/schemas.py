@@ -126,6 +126,7 @@ class GenerateResponse(BaseModel):
     message: dict
     tokens_remaining: int
     natural_language: str
+    diagnostics: Optional[List[dict]] = None  # Validator findings left in the code
 
 # ============================================
 # THREAD SCHEMAS
@@ -188,6 +189,33 @@ class UpdateScriptRequest(BaseModel):
     description: Optional[str] = Field(None, max_length=1000)
     code: Optional[str] = Field(None, min_length=10)
 
+class SimilarScriptsRequest(BaseModel):
+    code: str = Field(..., min_length=10, max_length=50000)
+
+class SimilarScript(BaseModel):
+    id: str
+    name: str
+    description: Optional[str]
+    strategy_type: StrategyType
+    created_at: datetime
+    similarity: float
+
+# ============================================
+# SEARCH SCHEMAS
+# ============================================
+class SearchKind(str, Enum):
+    script = "script"
+    thread = "thread"
+
+class SearchResult(BaseModel):
+    kind: SearchKind
+    id: str
+    title: str
+    snippet: str
+    message_id: Optional[str] = None
+    rank: float
+    updated_at: datetime
+
 # ============================================
 # TOKEN SCHEMAS
 # ============================================
@@ -6,7 +6,7 @@ from fastapi import APIRouter, HTTPException, Depends, Request
 from typing import List, Optional
 from pydantic import BaseModel
 from utils.security import get_current_user
-from utils.supabase_client import get_supabase
+from utils.supabase_client import get_db
 import logging
 from datetime import datetime
 
@@ -34,10 +34,10 @@ async def get_influencer_stats(user: dict = Depends(get_current_user)):
     """
     Get stats for the current influencer
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Check if user is an influencer
-    inf_res = supabase.table("influencers").select("*").eq("user_id", user['id']).execute()
+    inf_res = await db.table("influencers").select("*").eq("user_id", user['id']).execute()
     
     if not inf_res.data:
         raise HTTPException(status_code=403, detail="Not an influencer")
@@ -45,7 +45,7 @@ async def get_influencer_stats(user: dict = Depends(get_current_user)):
     influencer = inf_res.data[0]
     
     # Get referral count (number of commissions)
-    comm_res = supabase.table("commissions").select("id", count="exact").eq("influencer_id", influencer['id']).execute()
+    comm_res = await db.table("commissions").select("id", count="exact").eq("influencer_id", influencer['id']).execute()
     referral_count = comm_res.count if comm_res.count is not None else 0
     
     return {
@@ -61,17 +61,17 @@ async def get_commissions(user: dict = Depends(get_current_user)):
     """
     Get list of commissions for the current influencer
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Check if user is an influencer
-    inf_res = supabase.table("influencers").select("id").eq("user_id", user['id']).execute()
+    inf_res = await db.table("influencers").select("id").eq("user_id", user['id']).execute()
     if not inf_res.data:
         raise HTTPException(status_code=403, detail="Not an influencer")
     
     influencer_id = inf_res.data[0]['id']
     
     # Get commissions
-    comm_res = supabase.table("commissions").select("*").eq("influencer_id", influencer_id).order("created_at", desc=True).execute()
+    comm_res = await db.table("commissions").select("*").eq("influencer_id", influencer_id).order("created_at", desc=True).execute()
     
     return comm_res.data
 
@@ -80,15 +80,15 @@ async def register_as_influencer(referral_code: str, user: dict = Depends(get_cu
     """
     Register the current user as an influencer with a custom code
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Check if code already exists
-    existing = supabase.table("influencers").select("id").eq("referral_code", referral_code).execute()
+    existing = await db.table("influencers").select("id").eq("referral_code", referral_code).execute()
     if existing.data:
         raise HTTPException(status_code=400, detail="Referral code already taken")
     
     # Check if user is already an influencer
-    existing_inf = supabase.table("influencers").select("id").eq("user_id", user['id']).execute()
+    existing_inf = await db.table("influencers").select("id").eq("user_id", user['id']).execute()
     if existing_inf.data:
         raise HTTPException(status_code=400, detail="You are already registered as an influencer")
     
@@ -99,6 +99,6 @@ async def register_as_influencer(referral_code: str, user: dict = Depends(get_cu
         "commission_rate_percent": 10.0
     }
     
-    res = supabase.table("influencers").insert(inf_data).execute()
+    res = await db.table("influencers").insert(inf_data).execute()
     
     return {"message": "Successfully registered as influencer", "data": res.data[0]}
@@ -9,7 +9,10 @@ from models.schemas import (
     MessageResponse
 )
 from utils.security import get_current_user
-from utils.supabase_client import get_supabase
+from utils.supabase_client import get_supabase, get_db
+from utils.profile_cache import invalidate_profile
+from postgrest.types import ReturnMethod
+from datetime import datetime, timezone
 import os
 import logging
 
@@ -48,6 +51,7 @@ async def signup(request: SignupRequest):
                 supabase.table("user_profiles").update({
                     "referred_by_code": request.referral_code
                 }).eq("id", str(res.user.id)).execute()
+                await invalidate_profile(str(res.user.id))
             except Exception as e:
                 logger.warning(f"Failed to save referral code for user {res.user.id}: {str(e)}")
         
@@ -105,9 +109,10 @@ async def login(request: LoginRequest):
         
         # Update last login timestamp
         try:
-            supabase.table("user_profiles").update({
-                "last_login": "now()"
-            }).eq("id", str(res.user.id)).execute()
+            await get_db().table("user_profiles").update(
+                {"last_login": datetime.now(timezone.utc).isoformat()},
+                returning=ReturnMethod.minimal
+            ).eq("id", str(res.user.id)).execute()
         except Exception:
             pass  # Non-critical, don't fail login
         
@@ -3,18 +3,39 @@ AI Code Generation Endpoints
 Handles code generation, explanation, and refinement
 """
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Dict, Optional
+from typing import Dict, List, Optional, AsyncIterator, Awaitable, Callable, Tuple
 from models.schemas import GenerateRequest, GenerateResponse
-from services.ai_service import generate_pine_script, explain_code, refine_code
-from services.token_service import check_token_balance, deduct_tokens
-from services.cache_service import get_cached_response, cache_response
+from services.ai_service import (
+    generate_pine_script, explain_code, refine_code, repair_pine_script,
+    stream_pine_script, stream_explanation, stream_refinement, route_model,
+    ASSIST_MODEL, GENERATION_MODEL
+)
+from services.pine_validator import validate, has_errors
+from services.token_service import check_token_balance, deduct_tokens, record_generation
+from services.cache_service import (
+    get_cached_response, cache_response, get_cached_code_response, cache_code_response
+)
+from services.singleflight import coalesce
+from services.gemini_resilience import GeminiError
+from services.thread_context import build_thread_context, ThreadCodeTooLargeError
+from services.output_predictor import predict_output
+from services.script_fingerprint import fingerprint, find_similar_scripts
 from utils.security import get_current_user
-from utils.rate_limiter import check_user_rate_limit, check_gemini_limits, record_gemini_usage
-from utils.supabase_client import get_supabase
-from utils.helpers import tokens_to_words, estimate_tokens, calculate_expires_at, sanitize_prompt
-from datetime import datetime
+from utils.rate_limiter import (
+    check_user_rate_limit, acquire_gemini_capacity, record_gemini_usage, reserve_gemini_request
+)
+from utils.supabase_client import get_db
+from postgrest.types import ReturnMethod
+from utils.helpers import (
+    tokens_to_words, estimate_tokens, calculate_expires_at, sanitize_prompt,
+    format_sse, hash_prompt, extract_pine_script
+)
+from datetime import datetime, timedelta, timezone
+import asyncio
 import logging
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -44,21 +65,14 @@ class RefineResponse(BaseModel):
     tokens_used: int
     tokens_remaining: int
     thread_id: Optional[str] = None
+    diagnostics: Optional[List[dict]] = None
 
 
-@router.post("/generate", response_model=GenerateResponse)
-async def generate_code(
-    request: GenerateRequest,
-    user: Dict = Depends(get_current_user)
-):
+def _check_generation_allowed(prompt: str, user: Dict) -> int:
     """
-    Generate Pine Script code from natural language prompt
+    Run rate limit and prompt size checks for a generation
+    Returns the estimated token count for the prompt
     """
-    supabase = get_supabase()
-    
-    # Sanitize prompt
-    prompt = sanitize_prompt(request.prompt)
-    
     # Check user rate limit
     check_user_rate_limit(user['id'], user['plan'])
     
@@ -78,133 +92,427 @@ async def generate_code(
             }
         )
     
-    # Check token balance (only for non-cached requests, estimated)
+    return estimated_tokens
+
+
+async def _require_token_balance(user: Dict, estimated_tokens: int, include_estimate: bool = False) -> None:
+    """
+    Raise 400 if the user cannot afford the estimated tokens
+    """
     if not await check_token_balance(user, estimated_tokens):
+        detail = {
+            "error": "insufficient_tokens",
+            "message": f"Insufficient tokens. You have {user['tokens_remaining']} tokens remaining.",
+            "tokens_remaining": user['tokens_remaining']
+        }
+        if include_estimate:
+            detail["estimated_needed"] = estimated_tokens
+        raise HTTPException(status_code=400, detail=detail)
+
+
+def _new_thread(user: Dict, prompt: str) -> Dict:
+    """
+    Fields of the thread created for a prompt outside any thread
+    """
+    return {
+        'title': prompt[:50] + "..." if len(prompt) > 50 else prompt,
+        'is_saved': user['plan'] != 'hobby',
+        'expires_at': calculate_expires_at(user['plan']).isoformat() if user['plan'] == 'hobby' else None
+    }
+
+
+async def _verify_thread(db, user: Dict, thread_id: str) -> None:
+    """
+    Raise 404 unless the thread exists and belongs to the user
+    """
+    thread_response = await db.table("threads").select("*").eq("id", thread_id).single().execute()
+    if not thread_response.data or thread_response.data['user_id'] != user['id']:
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+
+async def _thread_history(db, user: Dict, thread_id: Optional[str]) -> Optional[str]:
+    """
+    Verify thread ownership and build its history for a follow-up
+    Raises 400 when the thread's code is too large for the plan's context
+    """
+    if not thread_id:
+        return None
+    owned, history = await asyncio.gather(
+        _verify_thread(db, user, thread_id),
+        build_thread_context(db, thread_id, user['plan']),
+        return_exceptions=True
+    )
+    # Ownership first, so nothing about another user's thread is revealed
+    if isinstance(owned, BaseException):
+        raise owned
+    if isinstance(history, ThreadCodeTooLargeError):
+        e = history
         raise HTTPException(
             status_code=400,
             detail={
-                "error": "insufficient_tokens",
-                "message": f"Insufficient tokens. You have {user['tokens_remaining']} tokens remaining.",
-                "tokens_remaining": user['tokens_remaining'],
-                "estimated_needed": estimated_tokens
+                "error": "thread_code_too_long",
+                "message": f"The script in this conversation ({e.code_tokens} tokens) is too long to continue on the {user['plan']} plan (max {e.budget} tokens). Start a new conversation with the part you want to change.",
+                "code_tokens": e.code_tokens,
+                "max_tokens": e.budget,
+                "upgrade_hint": "Upgrade your plan to continue longer scripts."
             }
         )
+    if isinstance(history, BaseException):
+        raise history
+    return history
+
+
+async def _write_exchange(thread_id: str, user_message: Dict, assistant_message: Dict) -> Dict:
+    """
+    Add a user/assistant message pair to a thread and bump its activity
+    Written before responding: on serverless deployments nothing is
+    guaranteed to run after the response. Returns the assistant message
+    """
+    db = get_db()
+    created_at = datetime.now(timezone.utc)
+    user_row = {
+        'id': str(uuid.uuid4()),
+        'thread_id': thread_id,
+        'role': 'user',
+        'created_at': created_at.isoformat(),
+        **user_message
+    }
+    # Explicit timestamps keep the pair in order when inserted together
+    assistant_row = {
+        'id': str(uuid.uuid4()),
+        'thread_id': thread_id,
+        'role': 'assistant',
+        'created_at': (created_at + timedelta(microseconds=1)).isoformat(),
+        **assistant_message
+    }
+    
+    await asyncio.gather(
+        db.table("messages").insert([user_row, assistant_row], returning=ReturnMethod.minimal).execute(),
+        db.table("threads").update(
+            {'last_activity': assistant_row['created_at']}, returning=ReturnMethod.minimal
+        ).eq("id", thread_id).execute()
+    )
+    
+    return assistant_row
+
+
+async def _save_cached_exchange(
+    user: Dict,
+    prompt: str,
+    thread_id: Optional[str],
+    content: str,
+    diagnostics: Optional[List[dict]] = None
+) -> GenerateResponse:
+    """
+    Persist a cache hit as a new exchange without deducting tokens
+    """
+    saved = await record_generation(
+        user['id'], thread_id, _new_thread(user, prompt),
+        prompt, 0, content, 0, 0, 0  # Cached, no cost
+    )
+    thread_id, message = saved['thread_id'], saved['message']
+    
+    return GenerateResponse(
+        thread_id=thread_id,
+        message=message,
+        tokens_remaining=user['tokens_remaining'],
+        natural_language=f"Cached response (0 tokens used), {tokens_to_words(user['tokens_remaining'])} remaining",
+        diagnostics=diagnostics
+    )
+
+
+def _cached_content(cached_response: Dict) -> str:
+    return cached_response.get('content', cached_response.get('message', {}).get('content', ''))
+
+
+async def _save_generation(
+    user: Dict,
+    prompt: str,
+    prompt_tokens: int,
+    thread_id: Optional[str],
+    code: str,
+    input_tokens: int,
+    output_tokens: int,
+    total_tokens: int,
+    diagnostics: Optional[List[dict]] = None
+) -> GenerateResponse:
+    """
+    Persist a completed generation and charge the user for it
+    The thread (if new), both messages, the deduction and the thread
+    totals are written in one transaction
+    """
+    # Record actual usage for rate limiting
+    record_gemini_usage(total_tokens)
+    
+    saved = await record_generation(
+        user['id'], thread_id, _new_thread(user, prompt),
+        prompt, prompt_tokens, code, input_tokens, output_tokens, total_tokens
+    )
+    # No user when nothing was charged (e.g. a stream without usage metadata)
+    tokens_remaining = saved['user']['tokens_remaining'] if saved.get('user') else user['tokens_remaining']
+    if saved.get('shortfall'):
+        logger.warning(f"Generation overran the balance of user {user['id']} by {saved['shortfall']} tokens")
+    
+    return GenerateResponse(
+        thread_id=saved['thread_id'],
+        message=saved['message'],
+        tokens_remaining=tokens_remaining,
+        natural_language=f"{tokens_to_words(total_tokens)} used, {tokens_to_words(tokens_remaining)} remaining",
+        diagnostics=diagnostics
+    )
+
+
+# Gemini failures that are worth telling the client about (others stay 500)
+UPSTREAM_ERRORS = {
+    "quota": (503, "quota_exceeded"),
+    "rate": (503, "service_busy"),
+    "transient": (503, "service_unavailable"),
+    "timeout": (504, "generation_timeout"),
+}
+
+
+def _upstream_error(e: Exception) -> Optional[HTTPException]:
+    """
+    Map a classified Gemini error to an HTTP error, None for anything else
+    """
+    if not isinstance(e, GeminiError) or e.kind not in UPSTREAM_ERRORS:
+        return None
+    
+    status_code, error = UPSTREAM_ERRORS[e.kind]
+    detail = {"error": error, "message": str(e)}
+    if e.retry_after is not None:
+        detail["retry_after"] = max(1, int(e.retry_after))
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+# Keep references to running stream tasks so they are not garbage collected
+_stream_tasks = set()
+
+
+def _sse_response(
+    events: AsyncIterator[Dict],
+    on_complete: Callable[[Dict], Awaitable[Dict]],
+    error_message: str
+) -> StreamingResponse:
+    """
+    Stream token events to the client as Server-Sent Events
+    
+    The model stream runs in its own task, so on_complete (token accounting
+    and persistence) still runs if the client disconnects mid-stream.
+    on_complete receives the final usage event and returns the "done" payload.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    async def pump():
+        try:
+            async for event in events:
+                if event["type"] == "token":
+                    await queue.put(format_sse("token", {"text": event["text"]}))
+                else:
+                    result = await on_complete(event)
+                    await queue.put(format_sse("done", result))
+        except HTTPException as e:
+            await queue.put(format_sse("error", {"status_code": e.status_code, "detail": e.detail}))
+        except Exception as e:
+            logger.error(f"Stream error: {str(e)}")
+            upstream = _upstream_error(e)
+            if upstream:
+                await queue.put(format_sse("error", {"status_code": upstream.status_code, "detail": upstream.detail}))
+            else:
+                await queue.put(format_sse("error", {"status_code": 500, "detail": error_message}))
+        finally:
+            await queue.put(None)
+    
+    task = asyncio.create_task(pump())
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+    
+    async def body():
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield item
+    
+    return StreamingResponse(
+        body(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            # Keeps GZipMiddleware from buffering the stream
+            "Content-Encoding": "identity"
+        }
+    )
+
+
+async def _single_event(event: Dict) -> AsyncIterator[Dict]:
+    yield event
+
+
+def _check_code(content: str) -> List[dict]:
+    """
+    Run the local Pine Script validator over a model response
+    """
+    return [d.to_dict() for d in validate(extract_pine_script(content))]
+
+
+def _repair_tokens(output_tokens: int) -> int:
+    """
+    Tokens a repair call may add: it resends the generated code (about
+    output_tokens) and writes it out again
+    """
+    return 2 * output_tokens
+
+
+async def _validate_and_repair(
+    content: str,
+    model_name: str = GENERATION_MODEL
+) -> Tuple[str, List[dict], int, int]:
+    """
+    Validate generated code and, if it has errors, make one repair call
+    with the model that wrote it
+    
+    The repaired version is kept only if it has fewer errors than the original.
+    Returns (content, diagnostics, extra_input_tokens, extra_output_tokens)
+    """
+    diagnostics = validate(extract_pine_script(content))
+    if not has_errors(diagnostics):
+        return content, [d.to_dict() for d in diagnostics], 0, 0
+    
+    problems = [f"Line {d.line}: {d.message}" for d in diagnostics if d.severity == "error"]
+    
+    # The repair is a Gemini call of its own, admitted against the minute limit
+    if not await reserve_gemini_request():
+        logger.info(f"Validator found {len(problems)} errors, no Gemini capacity for a repair")
+        return content, [d.to_dict() for d in diagnostics], 0, 0
+    logger.info(f"Validator found {len(problems)} errors, requesting repair")
+    
+    try:
+        repaired, input_tokens, output_tokens, _ = await repair_pine_script(content, problems, model_name)
+    except Exception as e:
+        logger.warning(f"Repair failed: {str(e)}")
+        return content, [d.to_dict() for d in diagnostics], 0, 0
+    
+    repaired_diagnostics = validate(extract_pine_script(repaired))
+    repaired_errors = sum(1 for d in repaired_diagnostics if d.severity == "error")
+    if repaired_errors < len(problems):
+        return repaired, [d.to_dict() for d in repaired_diagnostics], input_tokens, output_tokens
+    
+    return content, [d.to_dict() for d in diagnostics], input_tokens, output_tokens
+
+
+async def _generate_checked(prompt: str, user: Dict, reserved_tokens: int, history: Optional[str] = None) -> Dict:
+    """
+    Call Gemini for a prompt and validate (and repair) the code
+    """
+    # Wait for global Gemini capacity before making API call
+    await acquire_gemini_capacity(reserved_tokens, user['plan'])
+    
+    code, input_tokens, output_tokens, total_tokens = await generate_pine_script(prompt, user, history)
+    
+    # Catch mechanical v6 mistakes before the user has to
+    code, diagnostics, repair_input, repair_output = await _validate_and_repair(code, route_model(prompt, history))
+    input_tokens += repair_input
+    output_tokens += repair_output
+    total_tokens += repair_input + repair_output
+    
+    return {
+        'content': code,
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': total_tokens,
+        'diagnostics': diagnostics
+    }
+
+
+async def _generate_and_cache(prompt: str, user: Dict, reserved_tokens: int) -> Dict:
+    """
+    Generate for a prompt and cache the result
+    Runs once per prompt for all concurrent identical requests
+    """
+    result = await _generate_checked(prompt, user, reserved_tokens)
+    
+    # Cache the response for future identical prompts
+    await cache_response(prompt, {
+        'content': result['content'],
+        'tokens_used': result['total_tokens'],
+        'diagnostics': result['diagnostics']
+    })
+    
+    return result
+
+
+@router.post("/generate", response_model=GenerateResponse)
+async def generate_code(
+    request: GenerateRequest,
+    user: Dict = Depends(get_current_user)
+):
+    """
+    Generate Pine Script code from natural language prompt
+    """
+    db = get_db()
+    
+    # Sanitize prompt
+    prompt = sanitize_prompt(request.prompt)
+    
+    estimated_tokens = _check_generation_allowed(prompt, user)
+    
+    # Verify thread ownership before spending anything on it,
+    # and carry its history so follow-ups keep their context
+    history = await _thread_history(db, user, request.thread_id)
+    
+    # Check token balance (only for non-cached requests, estimated)
+    # Input plus the p90 output for similar prompts and room for a repair
+    # call, so few requests fail mid-flight
+    prediction = await predict_output("generate", prompt)
+    reserved_tokens = estimated_tokens + estimate_tokens(history) + prediction.p90 + _repair_tokens(prediction.p90)
+    await _require_token_balance(user, reserved_tokens, include_estimate=True)
     
     # Check cache first - cached responses are FREE (no token deduction)
-    cached_response = await get_cached_response(prompt)
+    # Follow-ups depend on their thread, so they skip the prompt cache
+    cached_response = None if history else await get_cached_response(prompt)
     if cached_response:
         logger.info(f"Cache hit for user {user['id']}")
         
         # For cached responses, we create a new thread/message but don't deduct tokens
-        thread_id = request.thread_id
-        
-        if not thread_id:
-            # Create new thread
-            thread_data = {
-                'user_id': user['id'],
-                'title': prompt[:50] + "..." if len(prompt) > 50 else prompt,
-                'is_saved': user['plan'] != 'hobby',
-                'expires_at': calculate_expires_at(user['plan']).isoformat() if user['plan'] == 'hobby' else None
-            }
-            thread_response = supabase.table("threads").insert(thread_data).execute()
-            thread_id = thread_response.data[0]['id']
-        
-        # Insert user message
-        supabase.table("messages").insert({
-            'thread_id': thread_id,
-            'role': 'user',
-            'content': prompt,
-            'tokens_used': 0  # Cached, no cost
-        }).execute()
-        
-        # Insert cached assistant response
-        message_response = supabase.table("messages").insert({
-            'thread_id': thread_id,
-            'role': 'assistant',
-            'content': cached_response.get('content', cached_response.get('message', {}).get('content', '')),
-            'tokens_used': 0  # Cached, no cost
-        }).execute()
-        message = message_response.data[0]
-        
-        return GenerateResponse(
-            thread_id=thread_id,
-            message=message,
-            tokens_remaining=user['tokens_remaining'],
-            natural_language=f"Cached response (0 tokens used), {tokens_to_words(user['tokens_remaining'])} remaining"
+        return await _save_cached_exchange(
+            user, prompt, request.thread_id,
+            _cached_content(cached_response), cached_response.get('diagnostics')
         )
     
-    # Check global Gemini limits before making API call
-    check_gemini_limits(estimated_tokens)
-    
-    # Create or get thread
-    if request.thread_id:
-        thread_response = supabase.table("threads").select("*").eq("id", request.thread_id).single().execute()
-        if not thread_response.data or thread_response.data['user_id'] != user['id']:
-            raise HTTPException(status_code=404, detail="Thread not found")
-        thread_id = request.thread_id
-    else:
-        thread_data = {
-            'user_id': user['id'],
-            'title': prompt[:50] + "..." if len(prompt) > 50 else prompt,
-            'is_saved': user['plan'] != 'hobby',
-            'expires_at': calculate_expires_at(user['plan']).isoformat() if user['plan'] == 'hobby' else None
-        }
-        thread_response = supabase.table("threads").insert(thread_data).execute()
-        thread_id = thread_response.data[0]['id']
-    
-    # Insert user message
-    supabase.table("messages").insert({
-        'thread_id': thread_id,
-        'role': 'user',
-        'content': prompt,
-        'tokens_used': estimated_tokens
-    }).execute()
-    
     try:
-        # Generate code with AI
-        code, input_tokens, output_tokens, total_tokens = await generate_pine_script(prompt, user)
-        
-        # Record actual usage for rate limiting
-        record_gemini_usage(total_tokens)
+        if history:
+            result, is_leader = await _generate_checked(prompt, user, reserved_tokens, history), True
+        else:
+            # Generate code with AI; identical concurrent prompts share one call
+            result, is_leader = await coalesce(
+                f"generate:{hash_prompt(prompt)}",
+                lambda: _generate_and_cache(prompt, user, reserved_tokens),
+                lambda: get_cached_response(prompt)
+            )
         
-        # Deduct tokens from user balance
-        updated_user = await deduct_tokens(user['id'], total_tokens, thread_id, 'generate')
+        if not is_leader:
+            # Another request paid for this generation, serve it like a cache hit
+            logger.info(f"Coalesced generation for user {user['id']}")
+            return await _save_cached_exchange(
+                user, prompt, request.thread_id,
+                _cached_content(result), result.get('diagnostics')
+            )
         
-        # Insert assistant message
-        assistant_message_data = {
-            'thread_id': thread_id,
-            'role': 'assistant',
-            'content': code,
-            'tokens_used': total_tokens,
-            'input_tokens': input_tokens,
-            'output_tokens': output_tokens
-        }
-        message_response = supabase.table("messages").insert(assistant_message_data).execute()
-        message = message_response.data[0]
-        
-        # Update thread metadata
-        supabase.table("threads").update({
-            'total_tokens_used': supabase.table("threads").select("total_tokens_used").eq("id", thread_id).single().execute().data.get('total_tokens_used', 0) + total_tokens,
-            'last_activity': datetime.now().isoformat()
-        }).eq("id", thread_id).execute()
-        
-        # Cache the response for future identical prompts
-        await cache_response(prompt, {
-            'content': code,
-            'tokens_used': total_tokens
-        })
-        
-        return GenerateResponse(
-            thread_id=thread_id,
-            message=message,
-            tokens_remaining=updated_user['tokens_remaining'],
-            natural_language=f"{tokens_to_words(total_tokens)} used, {tokens_to_words(updated_user['tokens_remaining'])} remaining"
+        return await _save_generation(
+            user, prompt, estimated_tokens, request.thread_id,
+            result['content'], result['input_tokens'], result['output_tokens'], result['total_tokens'],
+            result['diagnostics']
         )
     
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Generation error: {str(e)}")
+        upstream = _upstream_error(e)
+        if upstream:
+            raise upstream
         raise HTTPException(
             status_code=500,
             detail={
@@ -215,6 +523,127 @@ async def generate_code(
         )
 
 
+@router.post("/generate/stream")
+async def generate_code_stream(
+    request: GenerateRequest,
+    user: Dict = Depends(get_current_user)
+):
+    """
+    Streaming variant of /generate (Server-Sent Events)
+    
+    Emits "token" events as code is produced, then one "done" event carrying
+    the GenerateResponse fields, or an "error" event
+    """
+    db = get_db()
+    
+    prompt = sanitize_prompt(request.prompt)
+    
+    estimated_tokens = _check_generation_allowed(prompt, user)
+    
+    # Read the history before this prompt is added to the thread
+    history = await _thread_history(db, user, request.thread_id)
+    
+    reserved_tokens = estimated_tokens + estimate_tokens(history) + (await predict_output("generate", prompt)).p90
+    await _require_token_balance(user, reserved_tokens, include_estimate=True)
+    
+    # Cache hits are replayed as a single token event (follow-ups skip the cache)
+    cached_response = None if history else await get_cached_response(prompt)
+    if cached_response:
+        logger.info(f"Cache hit for user {user['id']}")
+        content = _cached_content(cached_response)
+        
+        async def complete_cached(event: Dict) -> Dict:
+            response = await _save_cached_exchange(
+                user, prompt, request.thread_id, content, cached_response.get('diagnostics')
+            )
+            return response.model_dump()
+        
+        return _sse_response(
+            _single_event({"type": "token", "text": content}),
+            complete_cached,
+            "Failed to generate code. Please try again."
+        )
+    
+    await acquire_gemini_capacity(reserved_tokens, user['plan'])
+    
+    async def complete(event: Dict) -> Dict:
+        # Tokens are already on screen, so problems are reported but not repaired
+        diagnostics = _check_code(event["content"])
+        if not history:
+            await cache_response(prompt, {
+                'content': event["content"],
+                'tokens_used': event["total_tokens"],
+                'diagnostics': diagnostics
+            })
+        response = await _save_generation(
+            user, prompt, estimated_tokens, request.thread_id,
+            event["content"], event["input_tokens"], event["output_tokens"], event["total_tokens"],
+            diagnostics
+        )
+        return response.model_dump()
+    
+    return _sse_response(
+        stream_pine_script(prompt, user, history),
+        complete,
+        "Failed to generate code. Please try again."
+    )
+
+
+async def _check_explain_allowed(request: ExplainRequest, user: Dict) -> int:
+    """
+    Run balance and global checks for an explanation (after the cache missed)
+    Returns the estimated token count
+    """
+    # Estimate tokens: input plus the p90 explanation length for code this size
+    estimated_tokens = estimate_tokens(request.code) + (await predict_output("explain", request.code)).p90
+    
+    # Check token balance
+    await _require_token_balance(user, estimated_tokens)
+    
+    # Wait for global Gemini capacity
+    await acquire_gemini_capacity(estimated_tokens, user['plan'])
+    
+    return estimated_tokens
+
+
+def _cached_explanation(user: Dict, cached: Dict) -> ExplainResponse:
+    """
+    Serve a cached explanation without deducting tokens
+    """
+    return ExplainResponse(
+        explanation=cached['content'],
+        tokens_used=0,  # Cached, no cost
+        tokens_remaining=user['tokens_remaining']
+    )
+
+
+async def _save_explanation(user: Dict, request: ExplainRequest, explanation: str, tokens_used: int) -> ExplainResponse:
+    """
+    Charge the user for a completed explanation and cache it for the same code
+    """
+    # Record usage
+    record_gemini_usage(tokens_used)
+    
+    # Deduct tokens
+    updated_user = await deduct_tokens(
+        user['id'], 
+        tokens_used, 
+        request.thread_id, 
+        'explain'
+    )
+    
+    await cache_code_response("explain", request.code, {
+        'content': explanation,
+        'tokens_used': tokens_used
+    })
+    
+    return ExplainResponse(
+        explanation=explanation,
+        tokens_used=tokens_used,
+        tokens_remaining=updated_user['tokens_remaining']
+    )
+
+
 @router.post("/explain", response_model=ExplainResponse)
 async def explain_pine_script(
     request: ExplainRequest,
@@ -223,52 +652,161 @@ async def explain_pine_script(
     """
     Explain Pine Script code in simple terms
     """
-    # Check rate limit
     check_user_rate_limit(user['id'], user['plan'])
     
-    # Estimate tokens
-    estimated_tokens = estimate_tokens(request.code) + 500  # Buffer for response
+    # Saved scripts get explained again and again; cached explanations are free
+    cached = await get_cached_code_response("explain", request.code)
+    if cached:
+        logger.info(f"Explain cache hit for user {user['id']}")
+        return _cached_explanation(user, cached)
     
-    # Check token balance
-    if not await check_token_balance(user, estimated_tokens):
-        raise HTTPException(
-            status_code=400,
-            detail={
-                "error": "insufficient_tokens",
-                "message": f"Insufficient tokens. You have {user['tokens_remaining']} remaining.",
-                "tokens_remaining": user['tokens_remaining']
-            }
-        )
-    
-    # Check global limits
-    check_gemini_limits(estimated_tokens)
+    await _check_explain_allowed(request, user)
     
     try:
         # Get explanation from AI
         explanation, tokens_used = await explain_code(request.code)
         
-        # Record usage
-        record_gemini_usage(tokens_used)
-        
-        # Deduct tokens
-        updated_user = await deduct_tokens(
-            user['id'], 
-            tokens_used, 
-            request.thread_id, 
-            'explain'
-        )
-        
-        return ExplainResponse(
-            explanation=explanation,
-            tokens_used=tokens_used,
-            tokens_remaining=updated_user['tokens_remaining']
-        )
+        return await _save_explanation(user, request, explanation, tokens_used)
     
     except Exception as e:
         logger.error(f"Explain error: {str(e)}")
+        upstream = _upstream_error(e)
+        if upstream:
+            raise upstream
         raise HTTPException(status_code=500, detail="Failed to explain code. Please try again.")
 
 
+@router.post("/explain/stream")
+async def explain_pine_script_stream(
+    request: ExplainRequest,
+    user: Dict = Depends(get_current_user)
+):
+    """
+    Streaming variant of /explain (Server-Sent Events)
+    """
+    check_user_rate_limit(user['id'], user['plan'])
+    
+    # Cache hits are replayed as a single token event
+    cached = await get_cached_code_response("explain", request.code)
+    if cached:
+        logger.info(f"Explain cache hit for user {user['id']}")
+        
+        async def complete_cached(event: Dict) -> Dict:
+            return _cached_explanation(user, cached).model_dump()
+        
+        return _sse_response(
+            _single_event({"type": "token", "text": cached['content']}),
+            complete_cached,
+            "Failed to explain code. Please try again."
+        )
+    
+    await _check_explain_allowed(request, user)
+    
+    async def complete(event: Dict) -> Dict:
+        response = await _save_explanation(user, request, event["content"], event["total_tokens"])
+        return response.model_dump()
+    
+    return _sse_response(
+        stream_explanation(request.code),
+        complete,
+        "Failed to explain code. Please try again."
+    )
+
+
+async def _check_refine_allowed(instruction: str, request: RefineRequest, user: Dict, repair: bool = False) -> int:
+    """
+    Run balance and global checks for a refinement (after the cache missed)
+    With repair, room for a repair call is included
+    Returns the estimated token count
+    """
+    # Estimate tokens: input plus the p90 refinement length for code this size
+    p90 = (await predict_output("refine", request.code)).p90
+    estimated_tokens = estimate_tokens(request.code) + estimate_tokens(instruction) + p90
+    if repair:
+        estimated_tokens += _repair_tokens(p90)
+    
+    # Check token balance
+    await _require_token_balance(user, estimated_tokens)
+    
+    # Wait for global Gemini capacity
+    await acquire_gemini_capacity(estimated_tokens, user['plan'])
+    
+    return estimated_tokens
+
+
+async def _save_refinement_messages(thread_id: str, instruction: str, refined_code: str, tokens_used: int) -> None:
+    """
+    Add a refinement exchange to a thread
+    """
+    await _write_exchange(
+        thread_id,
+        {
+            'content': f"[Refinement Request] {instruction}",
+            'tokens_used': estimate_tokens(instruction) if tokens_used else 0
+        },
+        {'content': refined_code, 'tokens_used': tokens_used}
+    )
+
+
+async def _cached_refinement(user: Dict, request: RefineRequest, instruction: str, cached: Dict) -> RefineResponse:
+    """
+    Serve a cached refinement without deducting tokens, saving it to the thread if given
+    """
+    if request.thread_id:
+        await _save_refinement_messages(request.thread_id, instruction, cached['content'], 0)  # Cached, no cost
+    
+    return RefineResponse(
+        code=cached['content'],
+        tokens_used=0,
+        tokens_remaining=user['tokens_remaining'],
+        thread_id=request.thread_id,
+        diagnostics=cached.get('diagnostics')
+    )
+
+
+async def _save_refinement(
+    user: Dict,
+    request: RefineRequest,
+    instruction: str,
+    refined_code: str,
+    tokens_used: int,
+    diagnostics: Optional[List[dict]] = None
+) -> RefineResponse:
+    """
+    Charge the user for a completed refinement, save it to the thread,
+    and cache it for the same code and instruction
+    """
+    # Record usage
+    record_gemini_usage(tokens_used)
+    
+    # Deduct tokens
+    updated_user = await deduct_tokens(
+        user['id'], 
+        tokens_used, 
+        request.thread_id, 
+        'refine'
+    )
+    
+    # If thread_id provided, save to thread
+    thread_id = request.thread_id
+    if thread_id:
+        await _save_refinement_messages(thread_id, instruction, refined_code, tokens_used)
+    
+    await cache_code_response("refine", request.code, {
+        'content': refined_code,
+        'tokens_used': tokens_used,
+        'diagnostics': diagnostics
+    }, instruction=instruction)
+    
+    return RefineResponse(
+        code=refined_code,
+        tokens_used=tokens_used,
+        tokens_remaining=updated_user['tokens_remaining'],
+        thread_id=thread_id,
+        diagnostics=diagnostics
+    )
+
+
 @router.post("/refine", response_model=RefineResponse)
 async def refine_pine_script(
     request: RefineRequest,
@@ -277,76 +815,87 @@ async def refine_pine_script(
     """
     Refine/modify existing Pine Script code based on instructions
     """
-    supabase = get_supabase()
-    
-    # Check rate limit
-    check_user_rate_limit(user['id'], user['plan'])
-    
     # Sanitize instruction
     instruction = sanitize_prompt(request.instruction)
     
-    # Estimate tokens
-    estimated_tokens = estimate_tokens(request.code) + estimate_tokens(instruction) + 1000
+    check_user_rate_limit(user['id'], user['plan'])
     
-    # Check token balance
-    if not await check_token_balance(user, estimated_tokens):
-        raise HTTPException(
-            status_code=400,
-            detail={
-                "error": "insufficient_tokens",
-                "message": f"Insufficient tokens. You have {user['tokens_remaining']} remaining.",
-                "tokens_remaining": user['tokens_remaining']
-            }
-        )
+    # Refinements are saved to the thread, so it must be the user's
+    if request.thread_id:
+        await _verify_thread(get_db(), user, request.thread_id)
     
-    # Check global limits
-    check_gemini_limits(estimated_tokens)
+    # Same code and instruction as an earlier refinement: free, like generate cache hits
+    cached = await get_cached_code_response("refine", request.code, instruction)
+    if cached:
+        logger.info(f"Refine cache hit for user {user['id']}")
+        return await _cached_refinement(user, request, instruction, cached)
+    
+    await _check_refine_allowed(instruction, request, user, repair=True)
     
     try:
         # Refine code with AI
         refined_code, tokens_used = await refine_code(request.code, instruction)
         
-        # Record usage
-        record_gemini_usage(tokens_used)
+        refined_code, diagnostics, repair_input, repair_output = await _validate_and_repair(refined_code, ASSIST_MODEL)
+        tokens_used += repair_input + repair_output
         
-        # Deduct tokens
-        updated_user = await deduct_tokens(
-            user['id'], 
-            tokens_used, 
-            request.thread_id, 
-            'refine'
-        )
-        
-        # If thread_id provided, save to thread
-        thread_id = request.thread_id
-        if thread_id:
-            # Add refinement message to thread
-            supabase.table("messages").insert({
-                'thread_id': thread_id,
-                'role': 'user',
-                'content': f"[Refinement Request] {instruction}",
-                'tokens_used': estimate_tokens(instruction)
-            }).execute()
-            
-            supabase.table("messages").insert({
-                'thread_id': thread_id,
-                'role': 'assistant',
-                'content': refined_code,
-                'tokens_used': tokens_used
-            }).execute()
-        
-        return RefineResponse(
-            code=refined_code,
-            tokens_used=tokens_used,
-            tokens_remaining=updated_user['tokens_remaining'],
-            thread_id=thread_id
+        return await _save_refinement(
+            user, request, instruction, refined_code, tokens_used, diagnostics
         )
     
     except Exception as e:
         logger.error(f"Refine error: {str(e)}")
+        upstream = _upstream_error(e)
+        if upstream:
+            raise upstream
         raise HTTPException(status_code=500, detail="Failed to refine code. Please try again.")
 
 
+@router.post("/refine/stream")
+async def refine_pine_script_stream(
+    request: RefineRequest,
+    user: Dict = Depends(get_current_user)
+):
+    """
+    Streaming variant of /refine (Server-Sent Events)
+    """
+    instruction = sanitize_prompt(request.instruction)
+    
+    check_user_rate_limit(user['id'], user['plan'])
+    
+    if request.thread_id:
+        await _verify_thread(get_db(), user, request.thread_id)
+    
+    # Cache hits are replayed as a single token event
+    cached = await get_cached_code_response("refine", request.code, instruction)
+    if cached:
+        logger.info(f"Refine cache hit for user {user['id']}")
+        
+        async def complete_cached(event: Dict) -> Dict:
+            return (await _cached_refinement(user, request, instruction, cached)).model_dump()
+        
+        return _sse_response(
+            _single_event({"type": "token", "text": cached['content']}),
+            complete_cached,
+            "Failed to refine code. Please try again."
+        )
+    
+    await _check_refine_allowed(instruction, request, user)
+    
+    async def complete(event: Dict) -> Dict:
+        response = await _save_refinement(
+            user, request, instruction, event["content"], event["total_tokens"],
+            _check_code(event["content"])
+        )
+        return response.model_dump()
+    
+    return _sse_response(
+        stream_refinement(request.code, instruction),
+        complete,
+        "Failed to refine code. Please try again."
+    )
+
+
 @router.post("/estimate")
 async def estimate_generation_tokens(
     request: GenerateRequest,
@@ -354,18 +903,38 @@ async def estimate_generation_tokens(
 ):
     """
     Estimate tokens needed for a generation request
+    similar_scripts lists saved scripts that are near-duplicates of the
+    cached answer to this prompt, so the user can reuse one instead
     """
     prompt = sanitize_prompt(request.prompt)
     estimated_input = estimate_tokens(prompt)
-    estimated_output = estimated_input * 3  # Rough estimate: output is ~3x input
-    estimated_total = estimated_input + estimated_output
+    
+    # Output sizes observed for similar prompts; the total uses the p90
+    prediction = await predict_output("generate", prompt)
+    estimated_total = estimated_input + prediction.p90
+    # What /generate holds back for the balance check (including a repair call)
+    reserved_tokens = estimated_total + _repair_tokens(prediction.p90)
+    
+    similar_scripts = []
+    cached_response = await get_cached_response(prompt, record_stats=False)
+    if cached_response:
+        code = extract_pine_script(_cached_content(cached_response))
+        try:
+            similar_scripts = await find_similar_scripts(
+                user['id'], await asyncio.to_thread(fingerprint, code), limit=3
+            )
+        except Exception as e:
+            logger.warning(f"Similar script lookup failed: {e}")
     
     return {
         "estimated_input_tokens": estimated_input,
-        "estimated_output_tokens": estimated_output,
+        "estimated_output_tokens": prediction.expected,
+        "estimated_output_tokens_p90": prediction.p90,
         "estimated_total": estimated_total,
         "natural_language": tokens_to_words(estimated_total),
         "within_limit": estimated_input <= user['max_input_tokens'],
-        "can_afford": estimated_total <= user['tokens_remaining'],
-        "tokens_remaining": user['tokens_remaining']
+        "reserved_tokens": reserved_tokens,
+        "can_afford": reserved_tokens <= user['tokens_remaining'],
+        "tokens_remaining": user['tokens_remaining'],
+        "similar_scripts": similar_scripts
     }
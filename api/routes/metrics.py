@@ -0,0 +1,63 @@
+"""
+Operational Metrics Endpoints
+Cache, context and capacity statistics for operators
+"""
+from fastapi import APIRouter, HTTPException, Header
+from typing import Optional
+from services.cache_service import get_cache_stats
+from services.ai_service import get_context_cache_stats, get_context_index, get_router_stats, get_token_estimator_stats
+from services.singleflight import get_singleflight_stats
+from services.gemini_resilience import get_resilience_stats
+from services.output_predictor import get_output_predictor_stats
+from services.search_service import get_search_stats
+from services.script_fingerprint import get_fingerprint_stats
+from utils.rate_limiter import get_gemini_status, get_admission_queue_status
+from utils.supabase_client import get_db_stats
+from utils.profile_cache import get_profile_cache_stats
+from utils.security import get_jwt_cache_stats
+import hmac
+import os
+
+router = APIRouter()
+
+
+def _require_metrics_key(key: Optional[str]) -> None:
+    """
+    Metrics need X-Metrics-Key matching METRICS_API_KEY
+    Without a configured key they are only available in development
+    """
+    expected = os.getenv("METRICS_API_KEY")
+    
+    if not expected:
+        if os.getenv("ENVIRONMENT") == "development":
+            return
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    if not key or not hmac.compare_digest(key, expected):
+        raise HTTPException(status_code=403, detail="Invalid metrics key")
+
+
+@router.get("/")
+async def get_metrics(x_metrics_key: Optional[str] = Header(default=None)):
+    """
+    Get all operational metrics
+    """
+    _require_metrics_key(x_metrics_key)
+    
+    return {
+        "prompt_cache": get_cache_stats(),
+        "singleflight": get_singleflight_stats(),
+        "profile_cache": get_profile_cache_stats(),
+        "jwt_cache": get_jwt_cache_stats(),
+        "context_cache": get_context_cache_stats(),
+        "context_index": get_context_index().get_stats(),
+        "model_router": get_router_stats(),
+        "token_estimator": get_token_estimator_stats(),
+        "output_predictor": get_output_predictor_stats(),
+        "gemini_resilience": get_resilience_stats(),
+        "gemini": get_gemini_status(),
+        "admission_queue": get_admission_queue_status(),
+        "database": get_db_stats(),
+        "search": get_search_stats(),
+        "script_fingerprints": get_fingerprint_stats()
+    }
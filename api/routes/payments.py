@@ -5,7 +5,8 @@ Handles checkout sessions and webhook events for subscription management
 from fastapi import APIRouter, HTTPException, Depends, Request
 from models.schemas import CreateCheckoutRequest, CreateCheckoutResponse
 from utils.security import get_current_user
-from utils.supabase_client import get_supabase
+from utils.supabase_client import get_db
+from utils.profile_cache import invalidate_profile
 from services.token_service import reset_monthly_tokens
 from services.affiliate_service import process_referral_commission
 import stripe
@@ -41,7 +42,7 @@ async def create_checkout(request: CreateCheckoutRequest, user: dict = Depends(g
     Create a Stripe Checkout session for subscription
     """
     try:
-        supabase = get_supabase()
+        db = get_db()
         
         # Determine price ID from plan and billing cycle
         if request.billing_cycle == "yearly":
@@ -66,9 +67,10 @@ async def create_checkout(request: CreateCheckoutRequest, user: dict = Depends(g
             customer_id = customer.id
             
             # Update user profile with Stripe customer ID
-            supabase.table("user_profiles").update({
+            await db.table("user_profiles").update({
                 'stripe_customer_id': customer_id
             }).eq("id", user['id']).execute()
+            await invalidate_profile(user['id'])
         
         # Create checkout session
         checkout_session = stripe.checkout.Session.create(
@@ -120,7 +122,7 @@ async def stripe_webhook(request: Request):
         logger.error(f"Invalid webhook signature: {str(e)}")
         raise HTTPException(status_code=400, detail="Invalid signature")
     
-    supabase = get_supabase()
+    db = get_db()
     event_type = event['type']
     data = event['data']['object']
     
@@ -129,23 +131,23 @@ async def stripe_webhook(request: Request):
     try:
         # Handle checkout.session.completed - New subscription
         if event_type == 'checkout.session.completed':
-            await handle_checkout_completed(supabase, data)
+            await handle_checkout_completed(db, data)
         
         # Handle subscription updates
         elif event_type == 'customer.subscription.updated':
-            await handle_subscription_updated(supabase, data)
+            await handle_subscription_updated(db, data)
         
         # Handle subscription deletion/cancellation
         elif event_type == 'customer.subscription.deleted':
-            await handle_subscription_deleted(supabase, data)
+            await handle_subscription_deleted(db, data)
         
         # Handle successful invoice payment (monthly renewal)
         elif event_type == 'invoice.payment_succeeded':
-            await handle_invoice_paid(supabase, data)
+            await handle_invoice_paid(db, data)
         
         # Handle failed payment
         elif event_type == 'invoice.payment_failed':
-            await handle_payment_failed(supabase, data)
+            await handle_payment_failed(db, data)
         
         return {"status": "success", "event": event_type}
         
@@ -154,7 +156,7 @@ async def stripe_webhook(request: Request):
         raise HTTPException(status_code=500, detail=f"Webhook processing failed: {str(e)}")
 
 
-async def handle_checkout_completed(supabase, session):
+async def handle_checkout_completed(db, session):
     """
     Handle successful checkout - activate subscription
     """
@@ -183,7 +185,8 @@ async def handle_checkout_completed(supabase, session):
         'updated_at': datetime.now().isoformat()
     }
     
-    supabase.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await db.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await invalidate_profile(user_id)
     logger.info(f"Activated {plan} subscription for user {user_id}")
     
     # Process affiliate commission
@@ -192,7 +195,7 @@ async def handle_checkout_completed(supabase, session):
     
     if amount_total > 0:
         await process_referral_commission(
-            supabase, 
+            db, 
             user_id, 
             amount_total, 
             currency, 
@@ -201,7 +204,7 @@ async def handle_checkout_completed(supabase, session):
         )
 
 
-async def handle_subscription_updated(supabase, subscription):
+async def handle_subscription_updated(db, subscription):
     """
     Handle subscription updates (plan changes, status changes)
     """
@@ -210,7 +213,7 @@ async def handle_subscription_updated(supabase, subscription):
     plan = subscription.get('metadata', {}).get('plan')
     
     # Find user by subscription ID
-    user_response = supabase.table("user_profiles").select("id").eq("stripe_subscription_id", subscription_id).single().execute()
+    user_response = await db.table("user_profiles").select("id").eq("stripe_subscription_id", subscription_id).single().execute()
     
     if not user_response.data:
         logger.warning(f"No user found for subscription: {subscription_id}")
@@ -232,18 +235,19 @@ async def handle_subscription_updated(supabase, subscription):
             'max_input_tokens': plan_config['max_input_tokens']
         })
     
-    supabase.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await db.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await invalidate_profile(user_id)
     logger.info(f"Updated subscription for user {user_id}: status={status}")
 
 
-async def handle_subscription_deleted(supabase, subscription):
+async def handle_subscription_deleted(db, subscription):
     """
     Handle subscription cancellation - downgrade to hobby
     """
     subscription_id = subscription.get('id')
     
     # Find user by subscription ID
-    user_response = supabase.table("user_profiles").select("id").eq("stripe_subscription_id", subscription_id).single().execute()
+    user_response = await db.table("user_profiles").select("id").eq("stripe_subscription_id", subscription_id).single().execute()
     
     if not user_response.data:
         logger.warning(f"No user found for cancelled subscription: {subscription_id}")
@@ -263,11 +267,12 @@ async def handle_subscription_deleted(supabase, subscription):
         'updated_at': datetime.now().isoformat()
     }
     
-    supabase.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await db.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await invalidate_profile(user_id)
     logger.info(f"Cancelled subscription for user {user_id}, downgraded to hobby")
 
 
-async def handle_invoice_paid(supabase, invoice):
+async def handle_invoice_paid(db, invoice):
     """
     Handle successful invoice payment - reset monthly tokens
     """
@@ -277,7 +282,7 @@ async def handle_invoice_paid(supabase, invoice):
         return
     
     # Find user by subscription ID
-    user_response = supabase.table("user_profiles").select("*").eq("stripe_subscription_id", subscription_id).single().execute()
+    user_response = await db.table("user_profiles").select("*").eq("stripe_subscription_id", subscription_id).single().execute()
     
     if not user_response.data:
         logger.warning(f"No user found for invoice subscription: {subscription_id}")
@@ -290,7 +295,7 @@ async def handle_invoice_paid(supabase, invoice):
     logger.info(f"Reset monthly tokens for user {user['id']}")
 
 
-async def handle_payment_failed(supabase, invoice):
+async def handle_payment_failed(db, invoice):
     """
     Handle failed payment - update subscription status
     """
@@ -300,7 +305,7 @@ async def handle_payment_failed(supabase, invoice):
         return
     
     # Find user by subscription ID
-    user_response = supabase.table("user_profiles").select("id").eq("stripe_subscription_id", subscription_id).single().execute()
+    user_response = await db.table("user_profiles").select("id").eq("stripe_subscription_id", subscription_id).single().execute()
     
     if not user_response.data:
         return
@@ -308,10 +313,11 @@ async def handle_payment_failed(supabase, invoice):
     user_id = user_response.data['id']
     
     # Update status to past_due
-    supabase.table("user_profiles").update({
+    await db.table("user_profiles").update({
         'subscription_status': 'past_due',
         'updated_at': datetime.now().isoformat()
     }).eq("id", user_id).execute()
+    await invalidate_profile(user_id)
     
     logger.warning(f"Payment failed for user {user_id}")
 
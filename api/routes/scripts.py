@@ -1,53 +1,122 @@
 """
 Script Library Endpoints
 """
-from fastapi import APIRouter, HTTPException, Depends
-from models.schemas import SaveScriptRequest, UpdateScriptRequest, ScriptDetail, ScriptListItem
+import asyncio
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from models.schemas import (
+    SaveScriptRequest, UpdateScriptRequest, ScriptDetail, ScriptListItem, StrategyType,
+    SimilarScriptsRequest, SimilarScript
+)
+from services.script_fingerprint import fingerprint, find_similar_scripts
 from utils.security import get_current_user
-from utils.supabase_client import get_supabase
-from typing import List, Dict
+from utils.supabase_client import get_db, or_filter, order_by
+from utils.helpers import encode_cursor, decode_cursor, keyset_filter
+from typing import List, Dict, Optional
 
 router = APIRouter()
 
 @router.post("/", response_model=ScriptDetail)
 async def save_script(request: SaveScriptRequest, user: Dict = Depends(get_current_user)):
-    supabase = get_supabase()
+    db = get_db()
     data = {
         **request.model_dump(),
-        "user_id": user['id']
+        "user_id": user['id'],
+        "fingerprint": await asyncio.to_thread(fingerprint, request.code)
     }
-    res = supabase.table("scripts").insert(data).execute()
+    res = await db.table("scripts").insert(data).execute()
     return res.data[0]
 
+# List pages go newest first on (created_at, id); code_preview is a stored column
+SCRIPT_CURSOR_KEYS = ("created_at", "id")
+SCRIPT_LIST_COLUMNS = "id, name, description, code_preview, strategy_type, tokens_used, created_at"
+
 @router.get("/", response_model=List[ScriptListItem])
-async def list_scripts(user: Dict = Depends(get_current_user)):
-    supabase = get_supabase()
-    res = supabase.table("scripts").select("*").eq("user_id", user['id']).order("created_at", desc=True).execute()
+async def list_scripts(
+    response: Response,
+    user: Dict = Depends(get_current_user),
+    limit: int = Query(default=50, ge=1, le=200),
+    cursor: Optional[str] = Query(default=None, description="X-Next-Cursor of the previous page"),
+    strategy_type: Optional[StrategyType] = Query(default=None)
+):
+    """
+    List the user's scripts, newest first, without their code
+    X-Next-Cursor is passed back as cursor for the next page and is
+    absent on the last one
+    """
+    db = get_db()
+    query = db.table("scripts").select(SCRIPT_LIST_COLUMNS).eq("user_id", user['id'])
+    
+    if strategy_type:
+        query = query.eq("strategy_type", strategy_type.value)
+    
+    if cursor:
+        try:
+            after = decode_cursor(cursor, SCRIPT_CURSOR_KEYS)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = or_filter(query, keyset_filter("created_at", after['created_at'], after['id']))
+    
+    # One extra row tells whether there is a next page
+    res = await order_by(query, "created_at.desc", "id.desc").limit(limit + 1).execute()
+    scripts = res.data or []
+    
+    if len(scripts) > limit:
+        scripts = scripts[:limit]
+        last = scripts[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({key: last[key] for key in SCRIPT_CURSOR_KEYS})
     
-    scripts = []
-    for s in res.data:
-        scripts.append({
-            **s,
-            "code_preview": s['code'][:150] + "..."
-        })
     return scripts
 
+@router.post("/similar", response_model=List[SimilarScript])
+async def find_similar(
+    request: SimilarScriptsRequest,
+    user: Dict = Depends(get_current_user),
+    limit: int = Query(default=5, ge=1, le=20)
+):
+    """
+    Saved scripts that are near-duplicates of the given code, most similar first
+    """
+    return await find_similar_scripts(
+        user['id'], await asyncio.to_thread(fingerprint, request.code), limit=limit
+    )
+
 @router.get("/{script_id}", response_model=ScriptDetail)
 async def get_script(script_id: str, user: Dict = Depends(get_current_user)):
-    supabase = get_supabase()
-    res = supabase.table("scripts").select("*").eq("id", script_id).eq("user_id", user['id']).single().execute()
+    db = get_db()
+    res = await db.table("scripts").select("*").eq("id", script_id).eq("user_id", user['id']).single().execute()
     if not res.data:
         raise HTTPException(status_code=404, detail="Script not found")
     return res.data
 
 @router.patch("/{script_id}")
 async def update_script(script_id: str, request: UpdateScriptRequest, user: Dict = Depends(get_current_user)):
-    supabase = get_supabase()
-    res = supabase.table("scripts").update(request.model_dump(exclude_unset=True)).eq("id", script_id).eq("user_id", user['id']).execute()
+    db = get_db()
+    data = request.model_dump(exclude_unset=True)
+    if data.get("code"):
+        data["fingerprint"] = await asyncio.to_thread(fingerprint, data["code"])
+    res = await db.table("scripts").update(data).eq("id", script_id).eq("user_id", user['id']).execute()
     return res.data[0]
 
+@router.get("/{script_id}/similar", response_model=List[SimilarScript])
+async def get_similar_scripts(
+    script_id: str,
+    user: Dict = Depends(get_current_user),
+    limit: int = Query(default=5, ge=1, le=20)
+):
+    """
+    Other saved scripts that are near-duplicates of this one
+    """
+    db = get_db()
+    res = await db.table("scripts").select("code, fingerprint").eq("id", script_id).eq("user_id", user['id']).execute()
+    if not res.data:
+        raise HTTPException(status_code=404, detail="Script not found")
+    
+    script = res.data[0]
+    hashes = script.get('fingerprint') or await asyncio.to_thread(fingerprint, script['code'])
+    return await find_similar_scripts(user['id'], hashes, exclude_id=script_id, limit=limit)
+
 @router.delete("/{script_id}")
 async def delete_script(script_id: str, user: Dict = Depends(get_current_user)):
-    supabase = get_supabase()
-    supabase.table("scripts").delete().eq("id", script_id).eq("user_id", user['id']).execute()
+    db = get_db()
+    await db.table("scripts").delete().eq("id", script_id).eq("user_id", user['id']).execute()
     return {"message": "Script deleted"}
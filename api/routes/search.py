@@ -0,0 +1,49 @@
+"""
+Library Search Endpoints
+"""
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
+from models.schemas import SearchKind, SearchResult
+from services.search_service import search_library, SEARCH_KINDS
+from utils.security import get_current_user
+from utils.helpers import encode_cursor, decode_cursor
+from typing import List, Dict, Optional
+
+router = APIRouter()
+
+# Results are ranked, so pages continue by position rather than by keyset
+SEARCH_CURSOR_KEYS = ("offset",)
+
+@router.get("/", response_model=List[SearchResult])
+async def search(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    kind: Optional[SearchKind] = Query(default=None, description="Only scripts or only threads"),
+    limit: int = Query(default=20, ge=1, le=50),
+    cursor: Optional[str] = Query(default=None, description="X-Next-Cursor of the previous page"),
+    user: Dict = Depends(get_current_user)
+):
+    """
+    Search the user's scripts and threads, best match first
+    Matches in snippets are wrapped in **; a thread result's message_id
+    is its best matching message. X-Next-Cursor is passed back as cursor
+    for the next page and is absent on the last one
+    """
+    offset = 0
+    if cursor:
+        try:
+            offset = decode_cursor(cursor, SEARCH_CURSOR_KEYS)['offset']
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if not isinstance(offset, int) or offset < 0:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    kinds = (kind.value,) if kind else SEARCH_KINDS
+
+    # One extra row tells whether there is a next page
+    results = await search_library(user['id'], q, kinds, limit + 1, offset)
+
+    if len(results) > limit:
+        results = results[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor({"offset": offset + limit})
+
+    return results
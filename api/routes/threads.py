@@ -2,78 +2,84 @@
 Thread Management Endpoints
 Handles conversation threads with optimized queries
 """
-from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi import APIRouter, HTTPException, Depends, Query, Response
 from models.schemas import CreateThreadRequest, UpdateThreadRequest, ThreadDetail, ThreadListItem
 from utils.security import get_current_user
-from utils.supabase_client import get_supabase
+from utils.supabase_client import get_db, or_filter, order_by
+from utils.helpers import encode_cursor, decode_cursor, keyset_filter
 from typing import List, Dict, Optional
 from datetime import datetime
+import asyncio
+import os
 
 router = APIRouter()
 
 
+# Sort key of the thread list; id breaks ties between equal timestamps
+THREAD_CURSOR_KEYS = ("last_activity", "id")
+
+
 @router.get("/", response_model=List[ThreadListItem])
 async def list_threads(
+    response: Response,
     user: Dict = Depends(get_current_user),
     limit: int = Query(default=20, ge=1, le=100),
-    offset: int = Query(default=0, ge=0),
+    cursor: Optional[str] = Query(default=None, description="X-Next-Cursor of the previous page"),
+    offset: int = Query(default=0, ge=0, description="Deprecated, use cursor"),
     saved_only: bool = Query(default=False)
 ):
     """
-    List all threads for the current user with optimized query
-    Uses a single query with embedded messages to avoid N+1 problem
+    List threads for the current user, most recently active first
+    
+    Pages by keyset on (last_activity, id): the X-Next-Cursor response
+    header is passed back as cursor for the next page and is absent on
+    the last one. message_count and preview are maintained on the thread
+    row, so no message bodies are read.
     """
-    supabase = get_supabase()
+    db = get_db()
     
-    # Build query with embedded messages (PostgREST foreign key embedding)
-    query = supabase.table("threads").select(
-        "id, title, total_tokens_used, last_activity, is_saved, created_at, "
-        "messages(id, content, role, created_at)"
+    query = db.table("threads").select(
+        "id, title, message_count, preview, total_tokens_used, last_activity, is_saved"
     ).eq("user_id", user['id'])
     
     # Filter saved threads if requested
     if saved_only:
         query = query.eq("is_saved", True)
     
-    # Order by last activity and apply pagination
-    query = query.order("last_activity", desc=True).range(offset, offset + limit - 1)
-    
-    res = query.execute()
-    
-    threads = []
-    for t in res.data:
-        messages = t.get('messages', [])
-        
-        # Sort messages by created_at to get the latest
-        sorted_messages = sorted(
-            messages, 
-            key=lambda m: m.get('created_at', ''), 
-            reverse=True
-        )
-        
-        # Get preview from latest assistant message or latest message
-        preview = ""
-        if sorted_messages:
-            # Try to find the latest assistant message first
-            for msg in sorted_messages:
-                if msg.get('role') == 'assistant':
-                    preview = msg.get('content', '')[:100]
-                    break
-            # Fallback to latest message
-            if not preview:
-                preview = sorted_messages[0].get('content', '')[:100]
-        
-        threads.append({
+    if cursor:
+        try:
+            after = decode_cursor(cursor, THREAD_CURSOR_KEYS)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = or_filter(query, keyset_filter("last_activity", after['last_activity'], after['id']))
+    
+    # One extra row tells whether there is a next page
+    query = order_by(query, "last_activity.desc", "id.desc")
+    if cursor or not offset:
+        query = query.limit(limit + 1)
+    else:
+        query = query.range(offset, offset + limit + 1)
+    
+    res = await query.execute()
+    rows = res.data or []
+    
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({key: last[key] for key in THREAD_CURSOR_KEYS})
+    
+    return [
+        {
             "id": t['id'],
             "title": t['title'],
-            "message_count": len(messages),
+            "message_count": t.get('message_count') or 0,
             "total_tokens_used": t['total_tokens_used'],
             "last_activity": t['last_activity'],
             "is_saved": t['is_saved'],
-            "preview": preview
-        })
-    
-    return threads
+            "preview": t.get('preview') or ""
+        }
+        for t in rows
+    ]
 
 
 @router.get("/count")
@@ -81,14 +87,17 @@ async def get_thread_count(user: Dict = Depends(get_current_user)):
     """
     Get total thread count for pagination
     """
-    supabase = get_supabase()
+    db = get_db()
     
-    # Use count query
-    res = supabase.table("threads").select("id", count="exact").eq("user_id", user['id']).execute()
+    # Use count queries, run concurrently
+    total, saved = await asyncio.gather(
+        db.table("threads").select("id", count="exact").eq("user_id", user['id']).execute(),
+        db.table("threads").select("id", count="exact").eq("user_id", user['id']).eq("is_saved", True).execute()
+    )
     
     return {
-        "total": res.count or 0,
-        "saved": supabase.table("threads").select("id", count="exact").eq("user_id", user['id']).eq("is_saved", True).execute().count or 0
+        "total": total.count or 0,
+        "saved": saved.count or 0
     }
 
 
@@ -100,7 +109,7 @@ async def create_thread(
     """
     Create a new thread
     """
-    supabase = get_supabase()
+    db = get_db()
     
     thread_data = {
         "user_id": user['id'],
@@ -111,35 +120,102 @@ async def create_thread(
         )
     }
     
-    res = supabase.table("threads").insert(thread_data).execute()
+    res = await db.table("threads").insert(thread_data).execute()
     
     return res.data[0]
 
 
+# Message pages go newest first on (created_at, id)
+MESSAGE_CURSOR_KEYS = ("created_at", "id")
+MESSAGE_COLUMNS = "id, role, tokens_used, input_tokens, output_tokens, created_at, content_length"
+
+# In headers-only mode, bodies longer than this are left out
+MESSAGE_INLINE_MAX_CHARS = int(os.getenv("MESSAGE_INLINE_MAX_CHARS", "2000"))
+
+
 @router.get("/{thread_id}", response_model=ThreadDetail)
-async def get_thread(thread_id: str, user: Dict = Depends(get_current_user)):
+async def get_thread(
+    thread_id: str,
+    response: Response,
+    user: Dict = Depends(get_current_user),
+    limit: int = Query(default=50, ge=1, le=200),
+    before: Optional[str] = Query(default=None, description="X-Next-Cursor of the previous page"),
+    headers_only: bool = Query(default=False)
+):
     """
-    Get a specific thread with all messages
+    Get a thread with a page of its messages
+    
+    Pages go back from the newest message; each page is returned oldest
+    first. X-Next-Cursor is passed as before to load older messages and is
+    absent once the start of the thread is reached. With headers_only,
+    messages longer than MESSAGE_INLINE_MAX_CHARS come without content
+    (content_length tells their size) and are fetched from
+    /{thread_id}/messages/{message_id} when opened.
     """
-    supabase = get_supabase()
+    db = get_db()
+    
+    query = db.table("messages").select(
+        MESSAGE_COLUMNS if headers_only else f"{MESSAGE_COLUMNS}, content"
+    ).eq("thread_id", thread_id)
     
-    # Get thread and verify ownership
-    thread_res = supabase.table("threads").select("*").eq("id", thread_id).eq("user_id", user['id']).single().execute()
+    if before:
+        try:
+            after = decode_cursor(before, MESSAGE_CURSOR_KEYS)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = or_filter(query, keyset_filter("created_at", after['created_at'], after['id']))
+    
+    # Ownership check and the page are independent reads
+    thread_res, msg_res = await asyncio.gather(
+        db.table("threads").select("*").eq("id", thread_id).eq("user_id", user['id']).execute(),
+        order_by(query, "created_at.desc", "id.desc").limit(limit + 1).execute()
+    )
     
     if not thread_res.data:
         raise HTTPException(status_code=404, detail="Thread not found")
     
-    # Get messages ordered by creation time
-    msg_res = supabase.table("messages").select(
-        "id, role, content, tokens_used, input_tokens, output_tokens, created_at"
-    ).eq("thread_id", thread_id).order("created_at", desc=False).execute()
+    messages = msg_res.data or []
+    if len(messages) > limit:
+        messages = messages[:limit]
+        oldest = messages[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor({key: oldest[key] for key in MESSAGE_CURSOR_KEYS})
+    messages.reverse()
+    
+    if headers_only:
+        # Fill in the bodies that are small enough to send inline
+        inline_ids = [m['id'] for m in messages if (m.get('content_length') or 0) <= MESSAGE_INLINE_MAX_CHARS]
+        bodies = {}
+        if inline_ids:
+            body_res = await db.table("messages").select("id, content").in_("id", inline_ids).execute()
+            bodies = {row['id']: row['content'] for row in body_res.data or []}
+        for message in messages:
+            message['content'] = bodies.get(message['id'])
+            message['content_omitted'] = message['content'] is None
     
     return {
-        **thread_res.data,
-        "messages": msg_res.data
+        **thread_res.data[0],
+        "messages": messages
     }
 
 
+@router.get("/{thread_id}/messages/{message_id}")
+async def get_message(thread_id: str, message_id: str, user: Dict = Depends(get_current_user)):
+    """
+    Get one message of a thread with its full content
+    """
+    db = get_db()
+    
+    thread_res, msg_res = await asyncio.gather(
+        db.table("threads").select("id").eq("id", thread_id).eq("user_id", user['id']).execute(),
+        db.table("messages").select(f"{MESSAGE_COLUMNS}, content").eq("id", message_id).eq("thread_id", thread_id).execute()
+    )
+    
+    if not thread_res.data or not msg_res.data:
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    return msg_res.data[0]
+
+
 @router.patch("/{thread_id}")
 async def update_thread(
     thread_id: str, 
@@ -149,16 +225,16 @@ async def update_thread(
     """
     Update thread title
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Verify ownership first
-    existing = supabase.table("threads").select("id").eq("id", thread_id).eq("user_id", user['id']).single().execute()
+    existing = await db.table("threads").select("id").eq("id", thread_id).eq("user_id", user['id']).single().execute()
     
     if not existing.data:
         raise HTTPException(status_code=404, detail="Thread not found")
     
     # Update thread
-    res = supabase.table("threads").update({
+    res = await db.table("threads").update({
         "title": request.title,
         "updated_at": datetime.now().isoformat()
     }).eq("id", thread_id).execute()
@@ -177,10 +253,10 @@ async def toggle_save_thread(
     """
     Toggle thread saved status (for hobby users to save important threads)
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Get current thread
-    thread_res = supabase.table("threads").select("is_saved").eq("id", thread_id).eq("user_id", user['id']).single().execute()
+    thread_res = await db.table("threads").select("is_saved").eq("id", thread_id).eq("user_id", user['id']).single().execute()
     
     if not thread_res.data:
         raise HTTPException(status_code=404, detail="Thread not found")
@@ -188,7 +264,7 @@ async def toggle_save_thread(
     # Toggle saved status
     new_saved = not thread_res.data['is_saved']
     
-    res = supabase.table("threads").update({
+    res = await db.table("threads").update({
         "is_saved": new_saved,
         "expires_at": None if new_saved else datetime.now().isoformat(),
         "updated_at": datetime.now().isoformat()
@@ -206,16 +282,16 @@ async def delete_thread(thread_id: str, user: Dict = Depends(get_current_user)):
     """
     Delete a thread and all its messages
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Verify ownership first
-    existing = supabase.table("threads").select("id").eq("id", thread_id).eq("user_id", user['id']).single().execute()
+    existing = await db.table("threads").select("id").eq("id", thread_id).eq("user_id", user['id']).single().execute()
     
     if not existing.data:
         raise HTTPException(status_code=404, detail="Thread not found")
     
     # Delete thread (messages will be cascade deleted)
-    supabase.table("threads").delete().eq("id", thread_id).execute()
+    await db.table("threads").delete().eq("id", thread_id).execute()
     
     return {"message": "Thread deleted", "id": thread_id}
 
@@ -229,14 +305,14 @@ async def delete_all_threads(
     Delete all threads for the user
     By default, keeps saved threads unless saved_too=True
     """
-    supabase = get_supabase()
+    db = get_db()
     
-    query = supabase.table("threads").delete().eq("user_id", user['id'])
+    query = db.table("threads").delete().eq("user_id", user['id'])
     
     if not saved_too:
         query = query.eq("is_saved", False)
     
-    query.execute()
+    await query.execute()
     
     return {
         "message": "Threads deleted",
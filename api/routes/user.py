@@ -4,7 +4,8 @@ User Profile Endpoints
 from fastapi import APIRouter, Depends
 from models.schemas import UserProfile, UpdateProfileRequest
 from utils.security import get_current_user
-from utils.supabase_client import get_supabase
+from utils.supabase_client import get_db
+from utils.profile_cache import invalidate_profile
 from typing import Dict
 
 router = APIRouter()
@@ -16,6 +17,7 @@ async def get_profile(user: Dict = Depends(get_current_user)):
 
 @router.patch("/profile")
 async def update_profile(request: UpdateProfileRequest, user: Dict = Depends(get_current_user)):
-    supabase = get_supabase()
-    res = supabase.table("user_profiles").update(request.model_dump(exclude_unset=True)).eq("id", user['id']).execute()
+    db = get_db()
+    res = await db.table("user_profiles").update(request.model_dump(exclude_unset=True)).eq("id", user['id']).execute()
+    await invalidate_profile(user['id'])
     return res.data[0]
@@ -1,15 +1,163 @@
 """
-AI Service - Gemini 2.0 Flash Integration
+AI Service - Gemini Integration
 Handles code generation with context caching
+Models come from the configured LLM provider (services.llm_provider)
 """
-import google.generativeai as genai
+import asyncio
+import logging
 import os
-from typing import Dict, Tuple
-from functools import lru_cache
-from datetime import timedelta
+import time
+from typing import Dict, List, Tuple, AsyncIterator, Optional
+from functools import lru_cache, partial
+from services.context_cache import ContextCacheManager
+from services.context_retrieval import ContextIndex
+from services.llm_provider import get_provider
+from services.model_router import (
+    classify_prompt, RouteDecision, RouterStats, FAST_TIER, HEAVY_TIER, ROUTER_MAX_OUTPUT_TOKENS
+)
+from services.output_predictor import record_output
+from services.gemini_resilience import GeminiError, GeminiTimeoutError, call_with_resilience, classify_error
+from utils.rate_limiter import record_gemini_usage
+from utils.helpers import estimate_tokens
+from utils.token_estimator import token_estimator
 
-# Configure Gemini
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+logger = logging.getLogger(__name__)
+
+# Concurrency and timeout limits for Gemini calls
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "90"))
+
+# Models used for generation and for explain/refine
+GENERATION_MODEL = os.getenv("GEMINI_GENERATION_MODEL", "models/gemini-3-pro-preview")
+ASSIST_MODEL = os.getenv("GEMINI_ASSIST_MODEL", "models/gemini-2.0-flash-001")
+
+# Generation tiers picked by the model router
+FAST_GENERATION_MODEL = os.getenv("GEMINI_FAST_GENERATION_MODEL", ASSIST_MODEL)
+MODEL_TIERS = {
+    FAST_TIER: FAST_GENERATION_MODEL,
+    HEAVY_TIER: GENERATION_MODEL,
+}
+
+# How the rulebook reaches the model:
+# "auto" serves the whole rulebook from the Gemini context cache, and sends
+# the core rules plus the top-k sections relevant to the request whenever
+# no cache is available (provider without caching, or creation failed);
+# "retrieval" always sends the relevant sections; "cache" uses the context
+# cache, falling back to the whole rulebook
+PINE_CONTEXT_MODE = os.getenv("PINE_CONTEXT_MODE", "auto")
+PINE_CONTEXT_TOP_K = int(os.getenv("PINE_CONTEXT_TOP_K", "4"))
+
+# Lazily created so it binds to the running event loop
+_gemini_semaphore = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """
+    Get the semaphore bounding concurrent Gemini calls in this worker
+    """
+    global _gemini_semaphore
+    if _gemini_semaphore is None:
+        _gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    return _gemini_semaphore
+
+
+def _model_name(model) -> str:
+    return getattr(model, "model_name", None) or "gemini"
+
+
+def _record_discarded(model_name: str, response) -> None:
+    """
+    Record usage of a response that lost a hedge race
+    It counts against the global Gemini budget but is never charged to a user
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    _record_usage(model_name, usage)
+    record_gemini_usage(usage.prompt_token_count + usage.candidates_token_count)
+
+
+async def _attempt(model, contents, **kwargs):
+    """
+    Run a single Gemini request on the async client path
+    Bounded by GEMINI_MAX_CONCURRENCY and GEMINI_TIMEOUT_SECONDS so a slow
+    generation never stalls the event loop or other requests
+    """
+    async with _get_semaphore():
+        return await asyncio.wait_for(
+            model.generate_content_async(contents, **kwargs),
+            timeout=GEMINI_TIMEOUT_SECONDS
+        )
+
+
+async def _generate(model, contents, **kwargs):
+    """
+    Run a Gemini request with retries (and hedging when enabled)
+    Raises a GeminiError
+    """
+    model_name = _model_name(model)
+    return await call_with_resilience(
+        lambda: _attempt(model, contents, **kwargs),
+        model_name,
+        partial(_record_discarded, model_name)
+    )
+
+
+async def _stream(model, contents, **kwargs) -> AsyncIterator:
+    """
+    Stream a Gemini response chunk by chunk
+    Holds a concurrency slot for the whole stream; GEMINI_TIMEOUT_SECONDS
+    applies to the stream as a whole, not to each chunk. Opening the stream
+    is retried, failures after the first chunk are not
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GEMINI_TIMEOUT_SECONDS
+    model_name = _model_name(model)
+    
+    async with _get_semaphore():
+        try:
+            response = await call_with_resilience(
+                lambda: asyncio.wait_for(
+                    model.generate_content_async(contents, stream=True, **kwargs),
+                    timeout=max(deadline - loop.time(), 0.001)
+                ),
+                f"{model_name}:stream",
+                partial(_record_discarded, model_name),
+                hedge=False
+            )
+            chunks = response.__aiter__()
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except asyncio.TimeoutError:
+            raise GeminiTimeoutError(f"Request timed out after {GEMINI_TIMEOUT_SECONDS:.0f} seconds")
+
+
+def _is_truncated(response) -> bool:
+    """
+    Check whether a response (or final stream chunk) stopped at max_output_tokens
+    """
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return False
+    return getattr(reason, "name", reason) in ("MAX_TOKENS", 2)
+
+
+def _chunk_text(chunk) -> str:
+    """
+    Get the text of a streamed chunk (final chunks may carry only metadata)
+    """
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
 
 # Load context file
 @lru_cache(maxsize=1)
@@ -24,58 +172,218 @@ def load_context_file() -> str:
     with open(context_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-# Create cached content (reused across requests)
 @lru_cache(maxsize=1)
-def get_cached_context():
+def get_context_index() -> ContextIndex:
+    """
+    Get the section index over the Pine Script context file (built once)
     """
-    Get cached Gemini context
-    This significantly reduces costs
+    return ContextIndex(load_context_file())
+
+# One self-renewing context cache per model, shared by generate/explain/refine
+context_cache = ContextCacheManager(load_context_file)
+
+
+async def _get_model(model_name: str, generation_config=None, query: Optional[str] = None) -> Tuple[object, str]:
     """
-    context = load_context_file()
+    Get a model carrying the Pine Script context
     
-    # Create cache (valid for 24 hours)
-    cache = genai.caching.CachedContent.create(
-        model='models/gemini-2.0-flash-001',
-        system_instruction=context,
-        ttl=timedelta(hours=24),
-    )
+    The context cache holds the full rulebook prefix and is preferred
+    unless the mode is "retrieval". Without a cache, only the sections
+    relevant to the query are sent (except in "cache" mode, which sends
+    the full context as the system instruction so it is never dropped)
+    
+    Returns: (model, instruction) where instruction is the system text sent
+    with each request ("" when it is served from the context cache)
+    """
+    provider = get_provider()
     
-    return cache
+    if PINE_CONTEXT_MODE != "retrieval" and provider.supports_context_cache:
+        cached_context = await context_cache.get(model_name)
+        if cached_context is not None:
+            model = provider.cached_model(cached_context, generation_config)
+            if model is not None:
+                return model, ""
+    
+    if PINE_CONTEXT_MODE != "cache" and query:
+        instruction = get_context_index().build_context(query, PINE_CONTEXT_TOP_K)
+        return provider.model(model_name, instruction, generation_config), instruction
+    
+    return provider.model(model_name, load_context_file(), generation_config), load_context_file()
+
+
+def _record_usage(model_name: str, usage, sent_text: Optional[str] = None) -> None:
+    """
+    Record token usage of a call, including tokens served from the context cache
+    With sent_text (everything sent outside the cache), the prompt token
+    count also calibrates the token estimator
+    """
+    cached_tokens = context_cache.record_usage(model_name, usage)
+    logger.info(
+        f"Gemini usage ({model_name}): prompt={usage.prompt_token_count} "
+        f"cached={cached_tokens} output={usage.candidates_token_count}"
+    )
+    if sent_text:
+        token_estimator.record(sent_text, usage.prompt_token_count - cached_tokens)
+
+
+def _charged_input_tokens(usage, instruction: str) -> int:
+    """
+    Input tokens charged to the user: the prompt without the rulebook
+    context, whether it was served from the context cache or sent as the
+    instruction, so charges count the same tokens balance checks reserve
+    """
+    cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+    return max(0, usage.prompt_token_count - cached_tokens - token_estimator.estimate(instruction))
+
+
+def get_token_estimator_stats() -> Dict:
+    """
+    Get the token estimator's calibration factors and error statistics
+    """
+    return token_estimator.get_stats()
+
+
+def get_context_cache_stats() -> Dict:
+    """
+    Get context cache lifecycle and cached token statistics
+    """
+    return context_cache.get_stats()
+
+
+router_stats = RouterStats()
+
+
+def get_router_stats() -> Dict:
+    """
+    Get per-tier latency, token and truncation statistics of the model router
+    """
+    return {"provider": get_provider().name, **router_stats.get_stats()}
+
+
+def _generation_config(max_output_tokens: int = 8192):
+    return get_provider().generation_config(
+        temperature=0.7,
+        top_p=0.95,
+        top_k=40,
+        max_output_tokens=max_output_tokens,
+    )
+
+
+def _route(prompt: str, history: Optional[str] = None) -> Tuple[RouteDecision, str]:
+    """
+    Pick the model and output budget for a generation prompt
+    Follow-ups rewrite the thread's code, so their budget covers it
+    """
+    decision = classify_prompt(prompt)
+    if history:
+        decision.max_output_tokens = min(
+            ROUTER_MAX_OUTPUT_TOKENS,
+            max(decision.max_output_tokens, estimate_tokens(history) * 2)
+        )
+    return decision, MODEL_TIERS[decision.tier]
+
+
+def route_model(prompt: str, history: Optional[str] = None) -> str:
+    """
+    The model the router picks for a generation prompt
+    """
+    return _route(prompt, history)[1]
+
+
+def _wrap_user_prompt(prompt: str) -> str:
+    """
+    Wrap the user prompt in sandboxing delimiters
+    """
+    return f"---USER_PROMPT_START---\n{prompt}\n---USER_PROMPT_END---"
+
+
+def _build_generation_prompt(prompt: str, history: Optional[str] = None) -> str:
+    """
+    Wrap the prompt, preceded by the thread history for follow-ups
+    """
+    if not history:
+        return _wrap_user_prompt(prompt)
+    return f"""{history}
+
+FOLLOW-UP REQUEST (apply it to the current code and return the complete updated script):
+{_wrap_user_prompt(prompt)}"""
+
 
-async def generate_pine_script(prompt: str, user: Dict) -> Tuple[str, int, int, int]:
+def _build_explain_prompt(code: str) -> str:
+    return f"""Explain this Pine Script code in simple terms:
+
+{code}
+
+Provide:
+1. What this code does (2-3 sentences)
+2. Key components and their purpose
+3. Entry/exit conditions (if strategy)
+4. How to use it in TradingView"""
+
+
+def _build_refine_prompt(code: str, instruction: str) -> str:
+    return f"""Modify this Pine Script code according to the instruction:
+
+CURRENT CODE:
+{code}
+
+INSTRUCTION:
+{instruction}
+
+Return only the modified Pine Script code with comments explaining changes."""
+
+
+def _build_repair_prompt(content: str, problems: List[str]) -> str:
+    issues = "\n".join(f"- {problem}" for problem in problems)
+    return f"""A validator found these problems in the Pine Script below:
+
+{issues}
+
+SCRIPT:
+{content}
+
+Fix every problem listed and return the complete corrected Pine Script v6 code.
+Keep everything else unchanged."""
+
+
+def _generation_error(e: Exception) -> GeminiError:
+    """
+    Map Gemini API errors to classified errors with user-facing messages
+    """
+    return classify_error(e)
+
+async def generate_pine_script(prompt: str, user: Dict, history: Optional[str] = None) -> Tuple[str, int, int, int]:
     """
-    Generate Pine Script code using Gemini 2.0 Flash
+    Generate Pine Script code using Gemini
+    history is the thread context for follow-ups (see services.thread_context)
     
     Returns: (code, input_tokens, output_tokens, total_tokens)
     """
     try:
-        # Get cached context
-        cached_context = get_cached_context()
+        # Pick the model tier and output budget for this prompt
+        decision, model_name = _route(prompt, history)
+        started = time.perf_counter()
         
-        # Create model
-        model = genai.GenerativeModel(
-            model_name='models/gemini-3-pro-preview'
-        )
+        # Create model with cached context
+        model, instruction = await _get_model(model_name, _generation_config(decision.max_output_tokens), query=prompt)
         
         # Generate content with sandboxing delimiters
-        sanitized_prompt = f"---USER_PROMPT_START---\n{prompt}\n---USER_PROMPT_END---"
-        
-        response = model.generate_content(
-            sanitized_prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7,
-                top_p=0.95,
-                top_k=40,
-                max_output_tokens=8192,
-            )
-        )
+        contents = _build_generation_prompt(prompt, history)
+        response = await _generate(model, contents)
         
         # Extract token usage
         usage = response.usage_metadata
-        input_tokens = usage.prompt_token_count
+        _record_usage(model_name, usage, instruction + contents)
+        input_tokens = _charged_input_tokens(usage, instruction)
         output_tokens = usage.candidates_token_count
         total_tokens = input_tokens + output_tokens
         
+        router_stats.record(
+            decision, model_name, (time.perf_counter() - started) * 1000,
+            input_tokens, output_tokens, _is_truncated(response)
+        )
+        record_output("generate", prompt, output_tokens)
+        
         # Extract code from response
         code = response.text
         
@@ -83,14 +391,34 @@ async def generate_pine_script(prompt: str, user: Dict) -> Tuple[str, int, int,
     
     except Exception as e:
         # Handle API errors
-        error_msg = str(e)
+        raise _generation_error(e)
+
+async def repair_pine_script(
+    content: str,
+    problems: List[str],
+    model_name: str = GENERATION_MODEL
+) -> Tuple[str, int, int, int]:
+    """
+    Ask the model that wrote the code to fix its validator problems
+    
+    Returns: (code, input_tokens, output_tokens, total_tokens)
+    """
+    try:
+        query = "\n".join(problems)
+        model, instruction = await _get_model(model_name, _generation_config(), query=query)
+        
+        contents = _build_repair_prompt(content, problems)
+        response = await _generate(model, contents)
+        
+        usage = response.usage_metadata
+        _record_usage(model_name, usage, instruction + contents)
+        input_tokens = _charged_input_tokens(usage, instruction)
+        output_tokens = usage.candidates_token_count
         
-        if "quota" in error_msg.lower():
-            raise Exception("API quota exceeded. Please try again later.")
-        elif "rate" in error_msg.lower():
-            raise Exception("Too many requests. Please wait a moment.")
-        else:
-            raise Exception(f"AI generation failed: {error_msg}")
+        return response.text, input_tokens, output_tokens, input_tokens + output_tokens
+    
+    except Exception as e:
+        raise _generation_error(e)
 
 async def explain_code(code: str) -> Tuple[str, int]:
     """
@@ -99,26 +427,21 @@ async def explain_code(code: str) -> Tuple[str, int]:
     Returns: (explanation, tokens_used)
     """
     try:
-        cached_context = get_cached_context()
-        model = genai.GenerativeModel.from_cached_content(cached_content=cached_context)
+        model, instruction = await _get_model(ASSIST_MODEL, query=code)
         
-        prompt = f"""Explain this Pine Script code in simple terms:
-
-{code}
-
-Provide:
-1. What this code does (2-3 sentences)
-2. Key components and their purpose
-3. Entry/exit conditions (if strategy)
-4. How to use it in TradingView"""
-        
-        response = model.generate_content(prompt)
+        contents = _build_explain_prompt(code)
+        response = await _generate(model, contents)
+        usage = response.usage_metadata
+        _record_usage(ASSIST_MODEL, usage, instruction + contents)
+        record_output("explain", code, usage.candidates_token_count)
         
-        tokens_used = response.usage_metadata.total_token_count
+        tokens_used = _charged_input_tokens(usage, instruction) + usage.candidates_token_count
         explanation = response.text
         
         return explanation, tokens_used
     
+    except GeminiError:
+        raise
     except Exception as e:
         raise Exception(f"Code explanation failed: {str(e)}")
 
@@ -129,25 +452,113 @@ async def refine_code(code: str, instruction: str) -> Tuple[str, int]:
     Returns: (refined_code, tokens_used)
     """
     try:
-        cached_context = get_cached_context()
-        model = genai.GenerativeModel.from_cached_content(cached_content=cached_context)
+        model, context = await _get_model(ASSIST_MODEL, query=f"{instruction}\n{code}")
+        
+        contents = _build_refine_prompt(code, instruction)
+        response = await _generate(model, contents)
+        usage = response.usage_metadata
+        _record_usage(ASSIST_MODEL, usage, context + contents)
+        record_output("refine", code, usage.candidates_token_count)
         
-        prompt = f"""Modify this Pine Script code according to the instruction:
+        tokens_used = _charged_input_tokens(usage, context) + usage.candidates_token_count
+        refined_code = response.text
+        
+        return refined_code, tokens_used
+    
+    except GeminiError:
+        raise
+    except Exception as e:
+        raise Exception(f"Code refinement failed: {str(e)}")
 
-CURRENT CODE:
-{code}
 
-INSTRUCTION:
-{instruction}
+async def _stream_with_usage(model_name: str, model, instruction: str, contents, **kwargs) -> AsyncIterator[Dict]:
+    """
+    Stream text events followed by one usage event with the full content
+    """
+    parts = []
+    usage = None
+    truncated = False
+    
+    async for chunk in _stream(model, contents, **kwargs):
+        if getattr(chunk, "usage_metadata", None):
+            usage = chunk.usage_metadata
+        truncated = truncated or _is_truncated(chunk)
+        text = _chunk_text(chunk)
+        if text:
+            parts.append(text)
+            yield {"type": "token", "text": text}
+    
+    if usage:
+        _record_usage(model_name, usage, instruction + contents)
+    
+    input_tokens = _charged_input_tokens(usage, instruction) if usage else 0
+    output_tokens = usage.candidates_token_count if usage else 0
+    
+    yield {
+        "type": "usage",
+        "content": "".join(parts),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens,
+        "truncated": truncated
+    }
 
-Return only the modified Pine Script code with comments explaining changes."""
+
+async def stream_pine_script(prompt: str, user: Dict, history: Optional[str] = None) -> AsyncIterator[Dict]:
+    """
+    Stream Pine Script generation
+    
+    Yields {"type": "token", "text"} events, then a single
+    {"type": "usage", "content", "input_tokens", "output_tokens", "total_tokens"}
+    """
+    try:
+        decision, model_name = _route(prompt, history)
+        started = time.perf_counter()
         
-        response = model.generate_content(prompt)
+        model, instruction = await _get_model(model_name, _generation_config(decision.max_output_tokens), query=prompt)
         
-        tokens_used = response.usage_metadata.total_token_count
-        refined_code = response.text
+        async for event in _stream_with_usage(model_name, model, instruction, _build_generation_prompt(prompt, history)):
+            if event["type"] == "usage":
+                router_stats.record(
+                    decision, model_name, (time.perf_counter() - started) * 1000,
+                    event["input_tokens"], event["output_tokens"], event["truncated"]
+                )
+                record_output("generate", prompt, event["output_tokens"])
+            yield event
+    
+    except Exception as e:
+        raise _generation_error(e)
+
+async def stream_explanation(code: str) -> AsyncIterator[Dict]:
+    """
+    Stream a Pine Script explanation (same events as stream_pine_script)
+    """
+    try:
+        model, instruction = await _get_model(ASSIST_MODEL, query=code)
         
-        return refined_code, tokens_used
+        async for event in _stream_with_usage(ASSIST_MODEL, model, instruction, _build_explain_prompt(code)):
+            if event["type"] == "usage":
+                record_output("explain", code, event["output_tokens"])
+            yield event
+    
+    except GeminiError:
+        raise
+    except Exception as e:
+        raise Exception(f"Code explanation failed: {str(e)}")
+
+async def stream_refinement(code: str, instruction: str) -> AsyncIterator[Dict]:
+    """
+    Stream a Pine Script refinement (same events as stream_pine_script)
+    """
+    try:
+        model, context = await _get_model(ASSIST_MODEL, query=f"{instruction}\n{code}")
+        
+        async for event in _stream_with_usage(ASSIST_MODEL, model, context, _build_refine_prompt(code, instruction)):
+            if event["type"] == "usage":
+                record_output("refine", code, event["output_tokens"])
+            yield event
     
+    except GeminiError:
+        raise
     except Exception as e:
         raise Exception(f"Code refinement failed: {str(e)}")
@@ -6,7 +6,35 @@ import os
 from typing import Optional, Dict
 from upstash_redis import Redis
 from utils.helpers import hash_prompt
+from services.semantic_cache import SemanticPromptIndex
+from services.pine_validator import split_lines
+import hashlib
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Optional near-duplicate tier (MinHash/LSH index kept in each worker)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.8"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "100000"))
+
+semantic_index = SemanticPromptIndex(max_entries=SEMANTIC_CACHE_MAX_ENTRIES)
+
+_cache_stats = {
+    "lookups": 0,
+    "exact_hits": 0,
+    "semantic_hits": 0,
+    "misses": 0
+}
+
+# Explain/refine responses, keyed on normalized code
+CODE_CACHE_ACTIONS = ("explain", "refine")
+
+_action_stats = {
+    action: {"lookups": 0, "hits": 0, "misses": 0}
+    for action in CODE_CACHE_ACTIONS
+}
 
 # Initialize Upstash Redis
 redis_client = None
@@ -25,22 +53,41 @@ def get_redis():
     
     return redis_client
 
-async def get_cached_response(prompt: str) -> Optional[Dict]:
+async def get_cached_response(prompt: str, record_stats: bool = True) -> Optional[Dict]:
     """
     Get cached AI response for prompt
-    Returns None if not cached
+    Returns None if not cached; record_stats=False for lookups that are
+    not generations (e.g. estimates)
     """
     try:
         redis = get_redis()
         if not redis:
             return None
         
+        stats = _cache_stats if record_stats else dict.fromkeys(_cache_stats, 0)
+        stats["lookups"] += 1
+        
         cache_key = f"prompt:{hash_prompt(prompt)}"
         cached_data = redis.get(cache_key)
         
         if cached_data:
+            stats["exact_hits"] += 1
             return json.loads(cached_data)
         
+        # Fall back to the most similar cached prompt
+        if SEMANTIC_CACHE_ENABLED:
+            match = semantic_index.lookup(prompt, SEMANTIC_CACHE_THRESHOLD)
+            if match:
+                similar_key, similarity = match
+                cached_data = redis.get(similar_key)
+                if cached_data:
+                    stats["semantic_hits"] += 1
+                    logger.info(f"Semantic cache hit (similarity {similarity:.2f})")
+                    return json.loads(cached_data)
+                # Expired in Redis
+                semantic_index.remove(similar_key)
+        
+        stats["misses"] += 1
         return None
     except Exception as e:
         print(f"Cache retrieval error: {e}")
@@ -58,10 +105,121 @@ async def cache_response(prompt: str, response: Dict, ttl: int = 86400) -> None:
         
         cache_key = f"prompt:{hash_prompt(prompt)}"
         redis.setex(cache_key, ttl, json.dumps(response))
+        
+        if SEMANTIC_CACHE_ENABLED:
+            semantic_index.add(cache_key, prompt, ttl)
+    
+    except Exception as e:
+        print(f"Cache storage error: {e}")
+
+def normalize_code(code: str) -> str:
+    """
+    Canonical form of Pine Script for cache keys
+    Comments, blank lines and spacing are dropped and wrapped lines joined;
+    indentation is kept as block depth since it changes meaning
+    """
+    lines = []
+    for line in split_lines(code):
+        if not line.tokens:
+            # The version annotation changes meaning, other comments don't
+            if line.comment and line.comment.replace(" ", "").startswith("//@version"):
+                lines.append(line.comment.replace(" ", ""))
+            continue
+        
+        text = " ".join(token.value for token in line.tokens)
+        if line.continuation and lines:
+            lines[-1] += " " + text
+        else:
+            lines.append("\t" * (line.indent // 4) + text)
+    
+    return "\n".join(lines)
+
+
+def _code_cache_key(action: str, code: str, instruction: Optional[str] = None) -> str:
+    code_hash = hashlib.sha256(normalize_code(code).encode('utf-8')).hexdigest()[:32]
+    if instruction is None:
+        return f"{action}:{code_hash}"
+    instruction_hash = hash_prompt(" ".join(instruction.split()))
+    return f"{action}:{code_hash}:{instruction_hash}"
+
+
+async def get_cached_code_response(action: str, code: str, instruction: Optional[str] = None) -> Optional[Dict]:
+    """
+    Get a cached explain/refine response for this code (and instruction)
+    Returns None if not cached
+    """
+    try:
+        redis = get_redis()
+        if not redis:
+            return None
+        
+        stats = _action_stats[action]
+        stats["lookups"] += 1
+        
+        cached_data = redis.get(_code_cache_key(action, code, instruction))
+        if cached_data:
+            stats["hits"] += 1
+            return json.loads(cached_data)
+        
+        stats["misses"] += 1
+        return None
+    except Exception as e:
+        print(f"Cache retrieval error: {e}")
+        return None
+
+async def cache_code_response(
+    action: str,
+    code: str,
+    response: Dict,
+    instruction: Optional[str] = None,
+    ttl: int = 86400
+) -> None:
+    """
+    Cache an explain/refine response
+    TTL: 86400 seconds = 24 hours
+    """
+    try:
+        redis = get_redis()
+        if not redis:
+            return
+        
+        redis.setex(_code_cache_key(action, code, instruction), ttl, json.dumps(response))
     
     except Exception as e:
         print(f"Cache storage error: {e}")
 
+def get_cache_stats() -> Dict:
+    """
+    Get prompt cache hit rates, including the semantic tier, and hit
+    rates per action
+    """
+    lookups = _cache_stats["lookups"]
+    hits = _cache_stats["exact_hits"] + _cache_stats["semantic_hits"]
+    
+    per_action = {
+        "generate": {
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0
+        }
+    }
+    for action, stats in _action_stats.items():
+        per_action[action] = {
+            **stats,
+            "hit_rate": round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        }
+    
+    return {
+        **_cache_stats,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "semantic": {
+            "enabled": SEMANTIC_CACHE_ENABLED,
+            "threshold": SEMANTIC_CACHE_THRESHOLD,
+            **semantic_index.get_stats()
+        },
+        "per_action": per_action
+    }
+
 async def clear_user_cache(user_id: str) -> None:
     """
     Clear cache for specific user (if needed)
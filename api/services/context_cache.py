@@ -0,0 +1,146 @@
+"""
+Gemini Context Cache Manager
+Keeps one provider context cache per model and renews it before it expires
+"""
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional
+from services.llm_provider import get_provider
+
+logger = logging.getLogger(__name__)
+
+# Cache lifetime and how long before expiry it gets extended
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = int(os.getenv("CONTEXT_CACHE_REFRESH_MARGIN_SECONDS", "300"))
+
+# After a failed create, don't retry for this long (requests fall back to the full context)
+CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "300"))
+
+
+@dataclass
+class _CacheEntry:
+    cache: object
+    expires_at: datetime
+
+
+class ContextCacheManager:
+    """
+    Tracks Gemini CachedContent handles per model name
+
+    Handles are extended ahead of expiry (or recreated if the extension
+    fails), so callers never get an expired cache.
+    """
+
+    def __init__(self, load_instruction: Callable[[], str]):
+        self._load_instruction = load_instruction
+        self._entries: Dict[str, _CacheEntry] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._retry_after: Dict[str, datetime] = {}
+        self._stats = {
+            "creates": 0,
+            "extensions": 0,
+            "failures": 0,
+            "calls": 0,
+            "cached_tokens": 0,
+            "prompt_tokens": 0,
+        }
+
+    async def get(self, model_name: str) -> Optional[object]:
+        """
+        Get a live cache handle for the model, or None if caching is unavailable
+        """
+        now = datetime.now(timezone.utc)
+        entry = self._entries.get(model_name)
+        if entry and (entry.expires_at - now).total_seconds() > CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+            return entry.cache
+
+        retry_after = self._retry_after.get(model_name)
+        if retry_after and now < retry_after:
+            return entry.cache if entry and entry.expires_at > now else None
+
+        lock = self._locks.setdefault(model_name, asyncio.Lock())
+        async with lock:
+            # Another request may have renewed it while we waited
+            now = datetime.now(timezone.utc)
+            entry = self._entries.get(model_name)
+            if entry and (entry.expires_at - now).total_seconds() > CONTEXT_CACHE_REFRESH_MARGIN_SECONDS:
+                return entry.cache
+
+            try:
+                if entry and entry.expires_at > now:
+                    try:
+                        entry = await asyncio.to_thread(self._extend, entry)
+                        self._stats["extensions"] += 1
+                    except Exception as e:
+                        logger.warning(f"Context cache extend failed for {model_name}, recreating: {e}")
+                        entry = await asyncio.to_thread(self._create, model_name)
+                        self._stats["creates"] += 1
+                else:
+                    entry = await asyncio.to_thread(self._create, model_name)
+                    self._stats["creates"] += 1
+            except Exception as e:
+                self._stats["failures"] += 1
+                self._retry_after[model_name] = now + timedelta(seconds=CONTEXT_CACHE_RETRY_SECONDS)
+                logger.error(f"Context cache unavailable for {model_name}: {e}")
+                current = self._entries.get(model_name)
+                return current.cache if current and current.expires_at > now else None
+
+            self._entries[model_name] = entry
+            self._retry_after.pop(model_name, None)
+            return entry.cache
+
+    def _create(self, model_name: str) -> _CacheEntry:
+        cache = get_provider().create_context_cache(
+            model_name, self._load_instruction(), timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+        )
+        logger.info(f"Created context cache {cache.name} for {model_name}")
+        return _CacheEntry(cache=cache, expires_at=self._expire_time(cache))
+
+    def _extend(self, entry: _CacheEntry) -> _CacheEntry:
+        get_provider().extend_context_cache(entry.cache, timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS))
+        return _CacheEntry(cache=entry.cache, expires_at=self._expire_time(entry.cache))
+
+    @staticmethod
+    def _expire_time(cache) -> datetime:
+        expire_time = getattr(cache, "expire_time", None)
+        if not expire_time:
+            return datetime.now(timezone.utc) + timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS)
+        if expire_time.tzinfo is None:
+            expire_time = expire_time.replace(tzinfo=timezone.utc)
+        return expire_time
+
+    def record_usage(self, model_name: str, usage) -> int:
+        """
+        Record usage_metadata of a call, returns its cached_content_token_count
+        """
+        cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+        self._stats["calls"] += 1
+        self._stats["cached_tokens"] += cached_tokens
+        self._stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+
+        if model_name in self._entries and not cached_tokens:
+            logger.warning(f"Call to {model_name} reported no cached content tokens")
+
+        return cached_tokens
+
+    def get_stats(self) -> Dict:
+        """
+        Get cache lifecycle counters and the share of prompt tokens served from cache
+        """
+        now = datetime.now(timezone.utc)
+        prompt_tokens = self._stats["prompt_tokens"]
+
+        return {
+            **self._stats,
+            "cached_token_ratio": round(self._stats["cached_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0,
+            "caches": {
+                model_name: {
+                    "name": getattr(entry.cache, "name", None),
+                    "expires_in": int((entry.expires_at - now).total_seconds())
+                }
+                for model_name, entry in self._entries.items()
+            }
+        }
@@ -0,0 +1,206 @@
+"""
+Context Retrieval - Section-level BM25 over the Pine Script rulebook
+Selects the rule sections relevant to a prompt instead of sending the whole file
+"""
+import math
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+# Sections always sent, whatever the prompt
+CORE_SECTIONS = (
+    "VERSION & DECLARATION RULES",
+    "SUMMARY CHECKLIST FOR ERROR-FREE v6 CODE",
+)
+
+# Trading vocabulary mapped to the terms the rulebook uses
+QUERY_EXPANSIONS = {
+    "rsi": ["ta.rsi", "ta"],
+    "ema": ["ta.ema", "ta"],
+    "sma": ["ta.sma", "ta"],
+    "wma": ["ta.wma", "ta"],
+    "macd": ["ta.macd", "ta", "tuple"],
+    "atr": ["ta.atr", "ta"],
+    "bollinger": ["ta.bb", "ta"],
+    "stochastic": ["ta.stoch", "ta"],
+    "vwap": ["ta.vwap", "ta"],
+    "crossover": ["ta.crossover", "ta"],
+    "crossunder": ["ta.crossunder", "ta"],
+    "cross": ["ta.crossover", "ta.crossunder"],
+    "alert": ["alert", "alertcondition"],
+    "alerts": ["alert", "alertcondition"],
+    "notification": ["alert", "alertcondition"],
+    "stop": ["strategy.exit", "stop", "strategy"],
+    "loss": ["strategy.exit", "stop"],
+    "profit": ["strategy.exit", "limit", "strategy"],
+    "backtest": ["strategy"],
+    "entry": ["strategy.entry", "strategy"],
+    "entries": ["strategy.entry", "strategy"],
+    "exit": ["strategy.exit", "strategy.close", "strategy"],
+    "long": ["strategy.long", "strategy.entry"],
+    "short": ["strategy.short", "strategy.entry"],
+    "position": ["strategy.position_size", "strategy"],
+    "mtf": ["request.security", "timeframe"],
+    "timeframe": ["request.security", "timeframe"],
+    "htf": ["request.security", "timeframe"],
+    "session": ["session", "time"],
+    "table": ["table.new", "table.cell"],
+    "dashboard": ["table.new", "table.cell"],
+    "label": ["label.new", "label"],
+    "labels": ["label.new", "label"],
+    "line": ["line.new", "line"],
+    "lines": ["line.new", "line"],
+    "box": ["box.new", "box"],
+    "background": ["bgcolor", "color"],
+    "colour": ["color"],
+    "plot": ["plot", "plotshape"],
+    "draw": ["plot"],
+    "input": ["input.int", "input.float", "input"],
+    "inputs": ["input.int", "input.float", "input"],
+    "settings": ["input"],
+    "library": ["library", "export"],
+}
+
+# Prompt filler words that would otherwise match every section
+STOPWORDS = frozenset({
+    "a", "an", "and", "the", "with", "for", "to", "of", "in", "on", "at", "by", "is", "it",
+    "that", "this", "be", "or", "as", "me", "my", "i", "can", "you", "please", "create",
+    "make", "write", "build", "script", "code", "pine", "pinescript", "using", "use", "when",
+})
+
+HEADING_WEIGHT = 3
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"[a-z_][a-z0-9_]*(?:\.[a-z_][a-z0-9_]*)*|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens; dotted names (ta.rsi) also yield their parts
+    """
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if "." in token:
+            tokens.extend(token.split("."))
+    return tokens
+
+
+@dataclass
+class Section:
+    heading: str
+    text: str
+    position: int
+    term_counts: Counter = field(default_factory=Counter, repr=False)
+    length: int = 0
+
+
+def split_sections(text: str) -> List[Section]:
+    """
+    Split the rulebook on its '## ' headings
+    Text before the first heading (the title) is kept as the first section
+    """
+    sections = []
+    heading = ""
+    lines: List[str] = []
+
+    for line in text.splitlines():
+        if line.startswith("## "):
+            if heading or "".join(lines).strip():
+                sections.append(Section(heading=heading, text="\n".join(lines).strip(), position=len(sections)))
+            heading = line[3:].strip()
+            lines = [line]
+        else:
+            lines.append(line)
+
+    if heading or "".join(lines).strip():
+        sections.append(Section(heading=heading, text="\n".join(lines).strip(), position=len(sections)))
+
+    return sections
+
+
+class ContextIndex:
+    """
+    BM25 index over rulebook sections
+    """
+
+    def __init__(self, text: str, core_sections=CORE_SECTIONS):
+        started = time.perf_counter()
+
+        self.sections = split_sections(text)
+        core = {name.lower() for name in core_sections}
+        # The title preamble has no heading and always goes with the core
+        self.core = [s for s in self.sections if not s.heading or s.heading.lower() in core]
+        core_positions = {s.position for s in self.core}
+        self.candidates = [s for s in self.sections if s.position not in core_positions]
+
+        document_frequency: Counter = Counter()
+        for section in self.candidates:
+            counts = Counter(tokenize(section.text))
+            for token in tokenize(section.heading):
+                counts[token] += HEADING_WEIGHT
+            section.term_counts = counts
+            section.length = sum(counts.values())
+            document_frequency.update(counts.keys())
+
+        n = len(self.candidates)
+        self.average_length = sum(s.length for s in self.candidates) / n if n else 0.0
+        self.idf: Dict[str, float] = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+        self.build_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def _expand_query(self, query: str) -> List[str]:
+        terms = [term for term in tokenize(query) if term not in STOPWORDS]
+        expanded = list(terms)
+        for term in terms:
+            expanded.extend(QUERY_EXPANSIONS.get(term, []))
+        return expanded
+
+    def score(self, query: str) -> List[tuple]:
+        """
+        Score every non-core section, returns (score, section) sorted best first
+        """
+        terms = set(self._expand_query(query))
+        results = []
+
+        for section in self.candidates:
+            score = 0.0
+            for term in terms:
+                tf = section.term_counts.get(term)
+                if not tf:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * section.length / self.average_length)
+                score += self.idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            if score > 0:
+                results.append((score, section))
+
+        results.sort(key=lambda item: item[0], reverse=True)
+        return results
+
+    def retrieve(self, query: str, top_k: int = 4) -> List[Section]:
+        """
+        Get the top_k most relevant non-core sections for the query
+        """
+        return [section for _, section in self.score(query)[:top_k]]
+
+    def build_context(self, query: str, top_k: int = 4) -> str:
+        """
+        Build the system instruction: core sections plus the top_k matches,
+        in rulebook order
+        """
+        selected = sorted(self.core + self.retrieve(query, top_k), key=lambda s: s.position)
+        return "\n\n".join(section.text for section in selected)
+
+    def get_stats(self) -> Dict:
+        return {
+            "sections": len(self.sections),
+            "core_sections": len(self.core),
+            "terms": len(self.idf),
+            "build_ms": self.build_ms,
+        }
@@ -0,0 +1,248 @@
+"""
+Gemini Resilience - Error classification, retries with backoff, and hedging
+The caller's admission covers the first request; every retry and hedge
+takes its own slot from the per-minute budget, and is skipped without one
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+from collections import deque
+from functools import partial
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+from services.llm_provider import ProviderError, ProviderRateLimitError, ProviderUnavailableError, get_provider
+from utils.rate_limiter import reserve_gemini_request
+
+logger = logging.getLogger(__name__)
+
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "0.5"))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "8"))
+
+# Hedging sends a second request when the first is slower than the p95
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() == "true"
+GEMINI_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_MIN_DELAY_SECONDS", "5"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+_RETRY_IN_PATTERN = re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE)
+
+
+class GeminiError(Exception):
+    """
+    A classified Gemini failure with a user-facing message
+    """
+    kind = "unknown"
+    retryable = False
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class GeminiQuotaError(GeminiError):
+    kind = "quota"
+
+
+class GeminiRateLimitError(GeminiError):
+    kind = "rate"
+    retryable = True
+
+
+class GeminiTransientError(GeminiError):
+    kind = "transient"
+    retryable = True
+
+
+class GeminiTimeoutError(GeminiError):
+    kind = "timeout"
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """
+    The server's suggested delay, from the provider error or the message
+    """
+    if isinstance(error, ProviderError) and error.retry_after is not None:
+        return error.retry_after
+    match = _RETRY_IN_PATTERN.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def classify_error(error: Exception) -> GeminiError:
+    """
+    Map an exception from the model client to a GeminiError
+    """
+    if isinstance(error, GeminiError):
+        return error
+
+    error = get_provider().translate_error(error)
+
+    if isinstance(error, asyncio.TimeoutError):
+        return GeminiTimeoutError("The AI service took too long to respond. Please try again.")
+
+    message = str(error)
+
+    if isinstance(error, ProviderRateLimitError) or "429" in message:
+        # Daily quotas don't recover within a request; per-minute limits do
+        if "per day" in message.lower() or "perday" in message.lower():
+            return GeminiQuotaError("API quota exceeded. Please try again later.", _retry_after(error))
+        return GeminiRateLimitError("Too many requests. Please wait a moment.", _retry_after(error))
+
+    if isinstance(error, ProviderUnavailableError):
+        return GeminiTransientError("The AI service is temporarily unavailable. Please try again.", _retry_after(error))
+
+    if "quota" in message.lower():
+        return GeminiQuotaError("API quota exceeded. Please try again later.", _retry_after(error))
+
+    return GeminiError(f"AI generation failed: {message}")
+
+
+_latencies: Dict[str, Deque[float]] = {}
+
+_stats = {
+    "calls": 0,
+    "retries": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "retries_skipped": 0,
+    "hedges_skipped": 0,
+    "discarded_responses": 0,
+    "failures": {}
+}
+
+
+def _hedge_delay(key: str) -> Optional[float]:
+    """
+    p95 latency of recent successful calls, None until there are enough samples
+    """
+    samples = _latencies.get(key)
+    if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    p95 = ordered[int(len(ordered) * 0.95) - 1]
+    return max(p95, GEMINI_HEDGE_MIN_DELAY_SECONDS)
+
+
+async def _timed(call: Callable[[], Awaitable[Any]], key: str) -> Any:
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    result = await call()
+    _latencies.setdefault(key, deque(maxlen=LATENCY_WINDOW)).append(loop.time() - started)
+    return result
+
+
+def _discard_late(on_discarded: Callable[[Any], None], task: asyncio.Task) -> None:
+    """
+    A losing hedge that finished anyway was still billed by Gemini
+    """
+    if not task.cancelled() and task.exception() is None:
+        _stats["discarded_responses"] += 1
+        on_discarded(task.result())
+
+
+async def _hedged(
+    call: Callable[[], Awaitable[Any]],
+    key: str,
+    on_discarded: Callable[[Any], None]
+) -> Any:
+    """
+    Run call, and a second copy if the first is slower than the hedge delay
+    The first successful response wins; the other is cancelled
+    """
+    primary = asyncio.create_task(_timed(call, key))
+    pending = {primary}
+    winner = None
+    errors = []
+
+    try:
+        delay = _hedge_delay(key)
+        if delay is not None:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                pending = done
+            elif await reserve_gemini_request():
+                _stats["hedges"] += 1
+                pending.add(asyncio.create_task(_timed(call, key)))
+            else:
+                _stats["hedges_skipped"] += 1
+
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task
+                else:
+                    _discard_late(on_discarded, task)
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(partial(_discard_late, on_discarded))
+
+    if winner is None:
+        raise errors[0]
+    if winner is not primary:
+        _stats["hedge_wins"] += 1
+    return winner.result()
+
+
+async def call_with_resilience(
+    call: Callable[[], Awaitable[Any]],
+    key: str,
+    on_discarded: Callable[[Any], None],
+    hedge: bool = GEMINI_HEDGE_ENABLED
+) -> Any:
+    """
+    Run a Gemini call with retries on rate limits and transient errors
+
+    Backoff is exponential with full jitter, and never shorter than the
+    server's retry-after; a retry that gets no slot in the per-minute
+    budget is not sent. With hedge, each attempt may send a backup request;
+    successful responses that lose the race go to on_discarded so their
+    usage can be recorded without charging the user.
+    Raises a GeminiError.
+    """
+    _stats["calls"] += 1
+
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            if hedge:
+                return await _hedged(call, key, on_discarded)
+            return await _timed(call, key)
+        except Exception as e:
+            error = classify_error(e)
+            _stats["failures"][error.kind] = _stats["failures"].get(error.kind, 0) + 1
+
+            if not error.retryable or attempt == GEMINI_MAX_RETRIES:
+                raise error from e
+
+            delay = random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * 2 ** attempt))
+            if error.retry_after is not None:
+                if error.retry_after > GEMINI_RETRY_MAX_SECONDS:
+                    raise error from e
+                delay = max(delay, error.retry_after)
+
+            logger.warning(f"Gemini {error.kind} error, retry {attempt + 1} in {delay:.2f}s: {e}")
+            await asyncio.sleep(delay)
+
+            if not await reserve_gemini_request():
+                _stats["retries_skipped"] += 1
+                raise error from e
+            _stats["retries"] += 1
+
+
+def get_resilience_stats() -> Dict:
+    """
+    Get retry, hedging and failure counters plus hedge delays per model
+    """
+    return {
+        **_stats,
+        "hedge_enabled": GEMINI_HEDGE_ENABLED,
+        "hedge_delay_seconds": {
+            key: round(delay, 3)
+            for key in _latencies
+            if (delay := _hedge_delay(key)) is not None
+        }
+    }
@@ -0,0 +1,176 @@
+"""
+LLM Provider - Backend selection for generate/explain/refine
+LLM_PROVIDER=gemini (default) talks to Gemini, LLM_PROVIDER=local uses the
+simulated backend in services.local_llm for load tests without API keys
+
+Only GeminiProvider imports the Gemini SDK. Providers report failures as
+ProviderError subclasses (see translate_error), which services.gemini_resilience
+classifies for retries
+"""
+import logging
+import os
+from abc import ABC, abstractmethod
+from datetime import timedelta
+from functools import lru_cache
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
+
+
+class ProviderError(Exception):
+    """
+    A model call failure reported by a provider
+    retry_after is the server's suggested delay in seconds, if any
+    """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderRateLimitError(ProviderError):
+    """
+    Rate limited or out of quota (HTTP 429)
+    """
+
+
+class ProviderUnavailableError(ProviderError):
+    """
+    A transient server-side failure (HTTP 500/502/503/504)
+    """
+
+
+class LLMProvider(ABC):
+    """
+    Creates models for ai_service
+
+    Models follow the google-generativeai surface ai_service relies on:
+    generate_content_async(contents, stream=False) returning a response with
+    .text, .usage_metadata (prompt_token_count, candidates_token_count,
+    total_token_count, cached_content_token_count) and
+    .candidates[0].finish_reason; with stream=True an async iterable of
+    chunks shaped the same way.
+    """
+    name = "base"
+    supports_context_cache = False
+
+    @abstractmethod
+    def generation_config(self, temperature: float, top_p: float, top_k: int, max_output_tokens: int):
+        ...
+
+    @abstractmethod
+    def model(self, model_name: str, system_instruction: Optional[str] = None, generation_config=None):
+        ...
+
+    @abstractmethod
+    def cached_model(self, cached_content, generation_config=None):
+        """
+        Model serving from a context cache, or None when the provider has
+        none (callers then send the context with an uncached model)
+        """
+
+    def create_context_cache(self, model_name: str, system_instruction: str, ttl: timedelta):
+        """
+        Create a context cache holding system_instruction (blocking)
+        Returns a handle with .name and .expire_time for cached_model
+        """
+        raise NotImplementedError(f"{self.name} provider has no context cache")
+
+    def extend_context_cache(self, cached_content, ttl: timedelta) -> None:
+        """
+        Push a context cache's expiry to ttl from now (blocking)
+        """
+        raise NotImplementedError(f"{self.name} provider has no context cache")
+
+    def translate_error(self, error: Exception) -> Exception:
+        """
+        Map a client exception to a ProviderError where one applies
+        """
+        return error
+
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+    supports_context_cache = True
+
+    def __init__(self):
+        import google.generativeai as genai
+        self._genai = genai
+        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+    def generation_config(self, temperature: float, top_p: float, top_k: int, max_output_tokens: int):
+        return self._genai.types.GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            max_output_tokens=max_output_tokens,
+        )
+
+    def model(self, model_name: str, system_instruction: Optional[str] = None, generation_config=None):
+        return self._genai.GenerativeModel(
+            model_name=model_name,
+            system_instruction=system_instruction,
+            generation_config=generation_config
+        )
+
+    def cached_model(self, cached_content, generation_config=None):
+        return self._genai.GenerativeModel.from_cached_content(
+            cached_content=cached_content,
+            generation_config=generation_config
+        )
+
+    def create_context_cache(self, model_name: str, system_instruction: str, ttl: timedelta):
+        return self._genai.caching.CachedContent.create(
+            model=model_name,
+            system_instruction=system_instruction,
+            ttl=ttl,
+        )
+
+    def extend_context_cache(self, cached_content, ttl: timedelta) -> None:
+        cached_content.update(ttl=ttl)
+
+    def translate_error(self, error: Exception) -> Exception:
+        from google.api_core import exceptions as google_exceptions
+
+        if isinstance(error, google_exceptions.ResourceExhausted):
+            translated = ProviderRateLimitError(str(error))
+        elif isinstance(error, (
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.InternalServerError,
+            google_exceptions.BadGateway,
+            google_exceptions.DeadlineExceeded,
+        )):
+            translated = ProviderUnavailableError(str(error))
+        else:
+            return error
+        translated.retry_after = _retry_delay(error)
+        return translated
+
+
+def _retry_delay(error: Exception) -> Optional[float]:
+    """
+    The delay from a Google API error's RetryInfo details, if present
+    """
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_provider() -> LLMProvider:
+    """
+    Get the configured provider (created once)
+    """
+    if LLM_PROVIDER == "local":
+        from services.local_llm import LocalProvider
+        logger.warning("Using the local simulated LLM provider - responses are synthetic")
+        return LocalProvider()
+
+    if LLM_PROVIDER != "gemini":
+        raise ValueError(f"Unknown LLM_PROVIDER: {LLM_PROVIDER}")
+
+    return GeminiProvider()
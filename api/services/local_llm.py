@@ -0,0 +1,167 @@
+"""
+Local LLM Backend - Deterministic simulated model for load testing
+Same prompt, same response, latency and token counts; no network or API key.
+Simulated failures are drawn per call, so a retry can succeed
+"""
+import asyncio
+import hashlib
+import math
+import os
+import random
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from services.llm_provider import LLMProvider, ProviderUnavailableError
+from utils.helpers import estimate_tokens
+
+# Time to first token: log-normal around the median
+LOCAL_LLM_FIRST_TOKEN_MS = float(os.getenv("LOCAL_LLM_FIRST_TOKEN_MS", "400"))
+LOCAL_LLM_LATENCY_SIGMA = float(os.getenv("LOCAL_LLM_LATENCY_SIGMA", "0.5"))
+
+# Output length (normal, capped by max_output_tokens) and generation speed
+LOCAL_LLM_OUTPUT_TOKENS = int(os.getenv("LOCAL_LLM_OUTPUT_TOKENS", "700"))
+LOCAL_LLM_TOKENS_PER_SECOND = float(os.getenv("LOCAL_LLM_TOKENS_PER_SECOND", "120"))
+LOCAL_LLM_STREAM_CHUNK_TOKENS = int(os.getenv("LOCAL_LLM_STREAM_CHUNK_TOKENS", "20"))
+
+# Share of calls failing with a 503, to exercise retries
+LOCAL_LLM_ERROR_RATE = float(os.getenv("LOCAL_LLM_ERROR_RATE", "0"))
+
+# Unseeded: failures must not follow the prompt, or retries would repeat them
+_failure_rng = random.Random()
+
+LOCAL_LLM_SEED = os.getenv("LOCAL_LLM_SEED", "0")
+
+# Rough tokens per filler line, used to size responses
+_TOKENS_PER_LINE = 12
+
+
+@dataclass
+class _Usage:
+    prompt_token_count: int
+    candidates_token_count: int
+    total_token_count: int
+    cached_content_token_count: int = 0
+
+
+@dataclass
+class _Candidate:
+    finish_reason: str
+
+
+@dataclass
+class _Response:
+    text: str
+    usage_metadata: Optional[_Usage] = None
+    candidates: List[_Candidate] = field(default_factory=list)
+
+
+class _Stream:
+    """
+    Async iterable of response chunks, paced at the configured token rate
+    """
+
+    def __init__(self, chunks: List[_Response], chunk_delay: float):
+        self._chunks = chunks
+        self._chunk_delay = chunk_delay
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            await asyncio.sleep(self._chunk_delay)
+            yield chunk
+
+
+def _code_response(digest: str, lines: int) -> str:
+    body = [
+        "```pinescript",
+        "//@version=6",
+        f'indicator("Local {digest[:8]}", overlay=true)',
+        'length = input.int(14, "Length", minval=1)',
+        "basis = ta.sma(close, length)",
+        'plot(basis, "Basis", color=color.blue)',
+    ]
+    body += [f"// Simulated line {i + 1} of the local backend, used to size this response" for i in range(lines)]
+    body.append("```")
+    return "\n".join(body)
+
+
+def _prose_response(digest: str, lines: int) -> str:
+    body = [f"This is a simulated explanation ({digest[:8]}) from the local backend."]
+    body += [f"{i + 1}. The script computes a value and plots it for the chart being analysed." for i in range(lines)]
+    return "\n".join(body)
+
+
+class LocalModel:
+    def __init__(self, model_name: str, system_instruction: Optional[str], generation_config: Optional[Dict]):
+        self.model_name = model_name
+        self._system_instruction = system_instruction or ""
+        self._config = generation_config or {}
+
+    def _plan(self, contents: str):
+        """
+        Derive the response, latency and usage from the request content;
+        whether this attempt fails is drawn independently
+        """
+        if _failure_rng.random() < LOCAL_LLM_ERROR_RATE:
+            raise ProviderUnavailableError("503 Simulated local backend outage")
+
+        digest = hashlib.sha256(f"{LOCAL_LLM_SEED}:{self.model_name}:{contents}".encode("utf-8")).hexdigest()
+        rng = random.Random(int(digest[:16], 16))
+
+        first_token = LOCAL_LLM_FIRST_TOKEN_MS / 1000 * math.exp(rng.gauss(0, LOCAL_LLM_LATENCY_SIGMA))
+        wanted = max(50, int(rng.gauss(LOCAL_LLM_OUTPUT_TOKENS, LOCAL_LLM_OUTPUT_TOKENS * 0.25)))
+        max_tokens = self._config.get("max_output_tokens") or wanted
+        output_tokens = min(wanted, max_tokens)
+
+        lines = max(1, output_tokens // _TOKENS_PER_LINE)
+        if contents.lstrip().startswith("Explain"):
+            text = _prose_response(digest, lines)
+        else:
+            text = _code_response(digest, lines)
+
+        usage = _Usage(
+            prompt_token_count=estimate_tokens(self._system_instruction + contents),
+            candidates_token_count=output_tokens,
+            total_token_count=0
+        )
+        usage.total_token_count = usage.prompt_token_count + usage.candidates_token_count
+        finish_reason = "MAX_TOKENS" if wanted > max_tokens else "STOP"
+        return text, usage, first_token, finish_reason
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        text, usage, first_token, finish_reason = self._plan(str(contents))
+        await asyncio.sleep(first_token)
+
+        if not stream:
+            await asyncio.sleep(usage.candidates_token_count / LOCAL_LLM_TOKENS_PER_SECOND)
+            return _Response(text=text, usage_metadata=usage, candidates=[_Candidate(finish_reason)])
+
+        pieces = max(1, usage.candidates_token_count // LOCAL_LLM_STREAM_CHUNK_TOKENS)
+        size = math.ceil(len(text) / pieces)
+        chunks = [_Response(text=text[i:i + size]) for i in range(0, len(text), size)]
+        chunks[-1].usage_metadata = usage
+        chunks[-1].candidates = [_Candidate(finish_reason)]
+
+        chunk_delay = usage.candidates_token_count / LOCAL_LLM_TOKENS_PER_SECOND / len(chunks)
+        return _Stream(chunks, chunk_delay)
+
+
+class LocalProvider(LLMProvider):
+    name = "local"
+    supports_context_cache = False
+
+    def generation_config(self, temperature: float, top_p: float, top_k: int, max_output_tokens: int):
+        return {
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "max_output_tokens": max_output_tokens,
+        }
+
+    def model(self, model_name: str, system_instruction: Optional[str] = None, generation_config=None):
+        return LocalModel(model_name, system_instruction, generation_config)
+
+    def cached_model(self, cached_content, generation_config=None):
+        # No context cache: ai_service sends the context with an uncached model
+        return None
@@ -0,0 +1,157 @@
+"""
+Model Router - Complexity-based model tier selection for generation
+Simple prompts go to the fast tier with a small output budget, complex ones
+(strategies, multi-timeframe, libraries) to the heavy tier
+"""
+import logging
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+ROUTER_ENABLED = os.getenv("MODEL_ROUTER_ENABLED", "true").lower() == "true"
+
+# Prompts scoring at or above this go to the heavy tier
+ROUTER_HEAVY_THRESHOLD = int(os.getenv("MODEL_ROUTER_HEAVY_THRESHOLD", "3"))
+
+# Output budget: base + per complexity point + per prompt word, clamped
+ROUTER_MIN_OUTPUT_TOKENS = int(os.getenv("MODEL_ROUTER_MIN_OUTPUT_TOKENS", "2048"))
+ROUTER_MAX_OUTPUT_TOKENS = int(os.getenv("MODEL_ROUTER_MAX_OUTPUT_TOKENS", "8192"))
+OUTPUT_TOKENS_PER_POINT = 512
+OUTPUT_TOKENS_PER_WORD = 8
+OUTPUT_TOKENS_STEP = 512
+
+FAST_TIER = "fast"
+HEAVY_TIER = "heavy"
+
+# (pattern, points, reason) - each feature counts once per prompt
+COMPLEXITY_FEATURES = [
+    (r"\bstrateg(?:y|ies)\b|\bbacktest", 2, "strategy"),
+    (r"\bstop[\s-]?loss\b|\btake[\s-]?profit\b|\btrailing\b|\bpyramiding\b", 1, "order_management"),
+    (r"\bposition siz|\brisk\b|\bcommission\b|\bslippage\b", 1, "risk_model"),
+    (r"request\.security|\bmtf\b|\bhtf\b|multi[\s-]?time[\s-]?frame|higher time[\s-]?frame|\bother timeframe", 3, "multi_timeframe"),
+    (r"request\.\w+|\blower timeframe|\bltf\b", 2, "requests"),
+    (r"\blibrary\b|\bexport\b", 3, "library"),
+    (r"\barrays?\b|\bmatrix\b|\bmatrices\b|\bmaps?\b|\btype\b|\budt\b|\bmethods?\b", 2, "data_structures"),
+    (r"\btables?\b|\bdashboard\b|\bpanel\b", 1, "table"),
+    (r"\blabels?\b|\blines?\b|\bboxes\b|\bpolyline", 1, "drawings"),
+    (r"\balerts?\b|\bnotification|\bwebhook", 1, "alerts"),
+    (r"\bdivergence|\bpivots?\b|\bsupport\b|\bresistance\b|\bzones?\b|\border blocks?\b", 2, "pattern_detection"),
+    (r"\bsessions?\b|\bvolume profile\b|\bfibonacci\b|\bfib\b", 1, "analysis_tools"),
+]
+
+# Counted together: each indicator beyond the second adds a point
+INDICATOR_PATTERN = re.compile(
+    r"\b(?:rsi|ema|sma|wma|vwma|hma|macd|atr|adx|dmi|bollinger|bb|stoch(?:astic)?|vwap|"
+    r"supertrend|ichimoku|cci|mfi|obv|keltner|donchian|psar|sar)\b"
+)
+
+_COMPILED_FEATURES = [(re.compile(pattern), points, reason) for pattern, points, reason in COMPLEXITY_FEATURES]
+
+
+@dataclass
+class RouteDecision:
+    tier: str
+    score: int
+    max_output_tokens: int
+    reasons: List[str] = field(default_factory=list)
+
+
+def classify_prompt(prompt: str) -> RouteDecision:
+    """
+    Score a prompt's complexity and pick a tier and output budget
+    Pure string checks, no model call
+    """
+    text = prompt.lower()
+    words = len(text.split())
+    score = 0
+    reasons = []
+
+    for pattern, points, reason in _COMPILED_FEATURES:
+        if pattern.search(text):
+            score += points
+            reasons.append(reason)
+
+    indicators = len(set(INDICATOR_PATTERN.findall(text)))
+    if indicators > 2:
+        score += indicators - 2
+        reasons.append(f"indicators:{indicators}")
+
+    if words > 60:
+        score += 1 if words <= 150 else 2
+        reasons.append(f"words:{words}")
+
+    tier = HEAVY_TIER if score >= ROUTER_HEAVY_THRESHOLD or not ROUTER_ENABLED else FAST_TIER
+
+    budget = ROUTER_MIN_OUTPUT_TOKENS + score * OUTPUT_TOKENS_PER_POINT + words * OUTPUT_TOKENS_PER_WORD
+    budget = -(-budget // OUTPUT_TOKENS_STEP) * OUTPUT_TOKENS_STEP
+    max_output_tokens = ROUTER_MAX_OUTPUT_TOKENS if not ROUTER_ENABLED else min(budget, ROUTER_MAX_OUTPUT_TOKENS)
+
+    return RouteDecision(tier=tier, score=score, max_output_tokens=max_output_tokens, reasons=reasons)
+
+
+class RouterStats:
+    """
+    Per-tier outcome counters for tuning the thresholds
+    """
+
+    def __init__(self):
+        self._tiers: Dict[str, Dict] = {}
+        self._scores: Counter = Counter()
+
+    def record(
+        self,
+        decision: RouteDecision,
+        model_name: str,
+        latency_ms: float,
+        input_tokens: int,
+        output_tokens: int,
+        truncated: bool
+    ) -> None:
+        """
+        Record and log the outcome of a routed generation
+        """
+        stats = self._tiers.setdefault(decision.tier, {
+            "requests": 0,
+            "latency_ms_total": 0.0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "output_budget": 0,
+            "truncated": 0,
+        })
+        stats["requests"] += 1
+        stats["latency_ms_total"] += latency_ms
+        stats["input_tokens"] += input_tokens
+        stats["output_tokens"] += output_tokens
+        stats["output_budget"] += decision.max_output_tokens
+        stats["truncated"] += int(truncated)
+        self._scores[decision.score] += 1
+
+        logger.info(
+            f"Model route: tier={decision.tier} model={model_name} score={decision.score} "
+            f"reasons={','.join(decision.reasons) or '-'} budget={decision.max_output_tokens} "
+            f"latency_ms={latency_ms:.0f} input={input_tokens} output={output_tokens} truncated={truncated}"
+        )
+
+    def get_stats(self) -> Dict:
+        tiers = {}
+        for tier, stats in self._tiers.items():
+            requests = stats["requests"]
+            tiers[tier] = {
+                "requests": requests,
+                "avg_latency_ms": round(stats["latency_ms_total"] / requests, 1),
+                "avg_input_tokens": round(stats["input_tokens"] / requests, 1),
+                "avg_output_tokens": round(stats["output_tokens"] / requests, 1),
+                "budget_utilization": round(stats["output_tokens"] / stats["output_budget"], 4) if stats["output_budget"] else 0.0,
+                "truncation_rate": round(stats["truncated"] / requests, 4),
+            }
+
+        return {
+            "enabled": ROUTER_ENABLED,
+            "heavy_threshold": ROUTER_HEAVY_THRESHOLD,
+            "tiers": tiers,
+            "score_histogram": dict(sorted(self._scores.items())),
+        }
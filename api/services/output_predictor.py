@@ -0,0 +1,178 @@
+"""
+Output Length Predictor
+Predicts expected and p90 output tokens per action from observed usage,
+for balance checks, capacity reservation and /estimate
+"""
+import asyncio
+import logging
+import math
+import os
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List
+from services.model_router import classify_prompt
+from utils.helpers import estimate_tokens
+from utils.supabase_client import get_db
+
+logger = logging.getLogger(__name__)
+
+# Samples kept per bucket, and needed before a bucket is trusted
+OUTPUT_SAMPLES_PER_BUCKET = 500
+MIN_BUCKET_SAMPLES = 20
+
+# Assistant messages read on a process's first prediction to seed the buckets
+OUTPUT_HISTORY_LIMIT = int(os.getenv("OUTPUT_HISTORY_LIMIT", "1000"))
+
+# Used until an action has enough samples (the previous fixed estimates)
+DEFAULT_OUTPUT_TOKENS = {
+    "generate": lambda input_tokens: input_tokens * 3,
+    "explain": lambda input_tokens: 500,
+    "refine": lambda input_tokens: 1000,
+}
+
+# Code size bands for explain/refine, in estimated input tokens
+CODE_SIZE_BANDS = ((500, "small"), (2000, "medium"))
+
+
+@dataclass
+class OutputPrediction:
+    expected: int
+    p90: int
+    samples: int
+    bucket: str
+
+
+def _bucket(action: str, text: str, input_tokens: int) -> str:
+    """
+    Generations are bucketed by model tier, explain/refine by code size
+    """
+    if action == "generate":
+        return f"generate:{classify_prompt(text).tier}"
+    for limit, band in CODE_SIZE_BANDS:
+        if input_tokens < limit:
+            return f"{action}:{band}"
+    return f"{action}:large"
+
+
+def _percentile(ordered: List[int], fraction: float) -> int:
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+class OutputPredictor:
+    """
+    Rolling output token samples per (action, feature) bucket
+    """
+
+    def __init__(self):
+        self._samples: Dict[str, Deque[int]] = {}
+        self._history_loaded = False
+        self._history_lock = asyncio.Lock()
+
+    def record(self, action: str, text: str, output_tokens: int) -> None:
+        """
+        Record the output size of a completed call
+        text is the prompt (generate) or the code (explain/refine)
+        """
+        if output_tokens <= 0:
+            return
+        bucket = _bucket(action, text, estimate_tokens(text))
+        self._samples.setdefault(bucket, deque(maxlen=OUTPUT_SAMPLES_PER_BUCKET)).append(output_tokens)
+
+    def predict(self, action: str, text: str) -> OutputPrediction:
+        """
+        Predict output tokens from the bucket, then all of the action's
+        buckets, then the fixed default
+        """
+        input_tokens = estimate_tokens(text)
+        bucket = _bucket(action, text, input_tokens)
+
+        samples = list(self._samples.get(bucket, ()))
+        if len(samples) < MIN_BUCKET_SAMPLES:
+            bucket = action
+            samples = [
+                tokens
+                for key, values in self._samples.items() if key.startswith(f"{action}:")
+                for tokens in values
+            ]
+
+        if len(samples) < MIN_BUCKET_SAMPLES:
+            default = DEFAULT_OUTPUT_TOKENS[action](input_tokens)
+            return OutputPrediction(expected=default, p90=default, samples=0, bucket="default")
+
+        ordered = sorted(samples)
+        return OutputPrediction(
+            expected=round(sum(ordered) / len(ordered)),
+            p90=_percentile(ordered, 0.9),
+            samples=len(ordered),
+            bucket=bucket
+        )
+
+    async def load_history(self, db) -> int:
+        """
+        Seed generation buckets from stored generations
+        The generation_output_history RPC pairs each recent assistant
+        message's output_tokens with the user prompt before it, so no
+        assistant bodies are read. Samples already recorded stay the
+        newest. Returns the number of samples
+        """
+        response = await db.rpc("generation_output_history", {"p_limit": OUTPUT_HISTORY_LIMIT}).execute()
+
+        live, self._samples = self._samples, {}
+        loaded = 0
+        # Rows come newest first
+        for row in reversed(response.data or []):
+            self.record("generate", row['prompt'], row['output_tokens'])
+            loaded += 1
+        for bucket, values in live.items():
+            self._samples.setdefault(bucket, deque(maxlen=OUTPUT_SAMPLES_PER_BUCKET)).extend(values)
+
+        return loaded
+
+    async def ensure_history(self) -> None:
+        """
+        Load the stored history once per process
+        Serverless invocations re-enter the app lifespan, so this runs on
+        first use instead; a failed load is not retried
+        """
+        if self._history_loaded:
+            return
+        async with self._history_lock:
+            if self._history_loaded:
+                return
+            try:
+                loaded = await self.load_history(get_db())
+                logger.info(f"Output predictor seeded with {loaded} samples")
+            except Exception as e:
+                logger.warning(f"Output predictor history unavailable: {e}")
+            self._history_loaded = True
+
+    def get_stats(self) -> Dict:
+        stats = {}
+        for bucket, values in sorted(self._samples.items()):
+            ordered = sorted(values)
+            stats[bucket] = {
+                "samples": len(ordered),
+                "mean": round(sum(ordered) / len(ordered)),
+                "p50": _percentile(ordered, 0.5),
+                "p90": _percentile(ordered, 0.9),
+            }
+        return stats
+
+
+output_predictor = OutputPredictor()
+
+
+async def predict_output(action: str, text: str) -> OutputPrediction:
+    await output_predictor.ensure_history()
+    return output_predictor.predict(action, text)
+
+
+def record_output(action: str, text: str, output_tokens: int) -> None:
+    output_predictor.record(action, text, output_tokens)
+
+
+def get_output_predictor_stats() -> Dict:
+    """
+    Get sample counts and output percentiles per bucket
+    """
+    return output_predictor.get_stats()
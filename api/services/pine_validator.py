@@ -0,0 +1,403 @@
+"""
+Pine Script v6 Validator
+Lexer plus mechanical rule checks for generated code
+"""
+import re
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+# ============================================
+# LEXER
+# ============================================
+
+_TOKEN_SPEC = [
+    ("comment", r"//[^\n]*"),
+    ("string", r"\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*'"),
+    ("color", r"#[0-9a-fA-F]{6}(?:[0-9a-fA-F]{2})?\b"),
+    ("number", r"\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?"),
+    ("name", r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*"),
+    ("op", r":=|==|!=|<=|>=|=>|\+=|-=|\*=|/=|%=|[-+*/%<>=?:()\[\],]"),
+    ("unknown", r"[^\s]"),
+]
+_TOKEN_PATTERN = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in _TOKEN_SPEC))
+
+
+@dataclass
+class Token:
+    kind: str
+    value: str
+    line: int
+    column: int
+
+
+@dataclass
+class Line:
+    number: int
+    indent: int
+    tokens: List[Token]
+    comment: Optional[str]
+    continuation: bool
+
+
+def tokenize(code: str) -> List[Token]:
+    """
+    Split Pine Script into tokens (comments and strings included)
+    Lines and columns are 1-based
+    """
+    tokens = []
+    for line_number, text in enumerate(code.splitlines(), start=1):
+        for match in _TOKEN_PATTERN.finditer(text):
+            tokens.append(Token(match.lastgroup, match.group(), line_number, match.start() + 1))
+    return tokens
+
+
+def _indent_width(text: str) -> int:
+    width = 0
+    for char in text:
+        if char == " ":
+            width += 1
+        elif char == "\t":
+            width += 4
+        else:
+            break
+    return width
+
+
+def split_lines(code: str) -> List[Line]:
+    """
+    Group tokens into source lines, marking wrapped continuation lines
+    (open brackets from a previous line, or indentation that is not a
+    multiple of 4, which Pine reserves for line wrapping)
+    """
+    by_line: Dict[int, List[Token]] = {}
+    for token in tokenize(code):
+        by_line.setdefault(token.line, []).append(token)
+
+    lines = []
+    depth = 0
+    for number, text in enumerate(code.splitlines(), start=1):
+        tokens = by_line.get(number, [])
+        comment = next((t.value for t in tokens if t.kind == "comment"), None)
+        tokens = [t for t in tokens if t.kind != "comment"]
+        if not tokens:
+            lines.append(Line(number, 0, [], comment, False))
+            continue
+
+        indent = _indent_width(text)
+        continuation = depth > 0 or (indent % 4 != 0)
+        lines.append(Line(number, indent, tokens, comment, continuation))
+
+        for token in tokens:
+            if token.value in ("(", "["):
+                depth += 1
+            elif token.value in (")", "]"):
+                depth = max(0, depth - 1)
+
+    return lines
+
+
+# ============================================
+# RULES
+# ============================================
+
+@dataclass
+class Diagnostic:
+    rule: str
+    severity: str  # "error" | "warning"
+    message: str
+    line: int
+    column: int = 1
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+DECLARATIONS = {"indicator", "strategy", "library"}
+
+# Cannot be called inside local blocks (if/for/while/switch/functions)
+GLOBAL_ONLY_FUNCTIONS = {
+    "plot", "plotshape", "plotchar", "plotarrow", "plotcandle", "plotbar",
+    "hline", "fill", "barcolor", "bgcolor", "alertcondition",
+    "indicator", "strategy", "library",
+}
+
+# v4 names that no longer exist in v6
+REMOVED_FUNCTIONS = {
+    "study": "Use indicator() instead of study()",
+    "security": "Use request.security() instead of security()",
+    "iff": "iff() was removed, use the ternary operator ?: instead",
+    "sma": "Use ta.sma()",
+    "ema": "Use ta.ema()",
+    "wma": "Use ta.wma()",
+    "rma": "Use ta.rma()",
+    "rsi": "Use ta.rsi()",
+    "atr": "Use ta.atr()",
+    "macd": "Use ta.macd()",
+    "stdev": "Use ta.stdev()",
+    "crossover": "Use ta.crossover()",
+    "crossunder": "Use ta.crossunder()",
+    "cross": "Use ta.cross()",
+    "highest": "Use ta.highest()",
+    "lowest": "Use ta.lowest()",
+    "change": "Use ta.change()",
+    "tostring": "Use str.tostring()",
+}
+
+REMOVED_PARAMETERS = {
+    "transp": "The transp parameter was removed, use color.new(color, transparency)",
+    "when": "The when parameter was removed from strategy.* functions in v6, wrap the call in an if block",
+}
+
+NUMERIC_BUILTINS = {
+    "open", "high", "low", "close", "volume", "hl2", "hlc3", "ohlc4", "hlcc4",
+    "bar_index", "time", "time_close", "last_bar_index", "timenow",
+    "strategy.position_size", "strategy.equity", "strategy.netprofit",
+    "strategy.opentrades", "strategy.closedtrades",
+}
+
+NUMERIC_FUNCTIONS = {
+    "ta.sma", "ta.ema", "ta.wma", "ta.rma", "ta.vwma", "ta.hma", "ta.rsi", "ta.atr", "ta.tr",
+    "ta.stdev", "ta.highest", "ta.lowest", "ta.change", "ta.mom", "ta.cci", "ta.mfi",
+    "ta.wpr", "ta.vwap", "ta.stoch", "ta.cum", "ta.barssince", "ta.valuewhen",
+    "math.abs", "math.max", "math.min", "math.round", "math.floor", "math.ceil",
+    "math.sqrt", "math.pow", "math.log", "math.avg", "math.sum",
+    "nz", "input.int", "input.float", "array.size", "array.get", "str.length",
+}
+
+NON_NUMERIC_TOKENS = {"==", "!=", "<", ">", "<=", ">=", "and", "or", "not", "?", "true", "false"}
+
+
+def _is_numeric_literal(token: Token) -> bool:
+    return token.kind == "number"
+
+
+def _call_arguments(tokens: List[Token], start: int) -> List[Token]:
+    """
+    Tokens of the call whose name is at tokens[start], up to the closing paren
+    """
+    depth = 0
+    for i in range(start + 1, len(tokens)):
+        if tokens[i].value == "(":
+            depth += 1
+        elif tokens[i].value == ")":
+            depth -= 1
+            if depth == 0:
+                return tokens[start + 2:i]
+    return tokens[start + 2:]
+
+
+class _Checker:
+    def __init__(self, code: str):
+        self.lines = split_lines(code)
+        self.diagnostics: List[Diagnostic] = []
+        self.numeric_names = set(NUMERIC_BUILTINS)
+        self.declaration: Optional[str] = None
+        self.dynamic_requests = True
+
+    def report(self, rule: str, severity: str, message: str, line: int, column: int = 1) -> None:
+        self.diagnostics.append(Diagnostic(rule, severity, message, line, column))
+
+    def run(self) -> List[Diagnostic]:
+        self.check_version()
+        self.check_declaration()
+        self.check_brackets()
+
+        for line in self.lines:
+            if not line.tokens:
+                continue
+            self.track_types(line)
+            self.check_local_scope(line)
+            self.check_removed_names(line)
+            self.check_conditions(line)
+            self.check_bool_na(line)
+            self.check_request_security(line)
+            self.check_strategy_calls(line)
+
+        return sorted(self.diagnostics, key=lambda d: (d.line, d.column))
+
+    # ---- script header ----
+
+    def check_version(self) -> None:
+        for line in self.lines:
+            if line.tokens:
+                break
+            if line.comment and line.comment.replace(" ", "").startswith("//@version="):
+                version = line.comment.replace(" ", "")[len("//@version="):]
+                if version != "6":
+                    self.report("version", "error", f"Script declares //@version={version}, it must be //@version=6", line.number)
+                return
+
+        self.report("version", "error", "Script must start with //@version=6 (only comments may precede it)", 1)
+
+    def check_declaration(self) -> None:
+        found = []
+        for line in self.lines:
+            for i, token in enumerate(line.tokens):
+                if token.value in DECLARATIONS and i + 1 < len(line.tokens) and line.tokens[i + 1].value == "(":
+                    found.append((line, i))
+
+        if not found:
+            self.report("declaration", "error", "Script must contain exactly one indicator(), strategy() or library() declaration", 1)
+            return
+
+        if len(found) > 1:
+            for line, i in found[1:]:
+                self.report("declaration", "error", "Only one indicator(), strategy() or library() declaration is allowed", line.number, line.tokens[i].column)
+
+        line, i = found[0]
+        self.declaration = line.tokens[i].value
+
+        arguments = []
+        for candidate in self.lines[self.lines.index(line):]:
+            arguments.extend(candidate.tokens)
+            if candidate is not line and not candidate.continuation:
+                break
+        for j, token in enumerate(arguments):
+            if token.value == "dynamic_requests" and j + 2 < len(arguments) and arguments[j + 2].value == "false":
+                self.dynamic_requests = False
+
+        code_before = [l for l in self.lines if l.tokens and l.number < line.number]
+        if code_before:
+            self.report("declaration", "error", f"{self.declaration}() must come right after //@version=6", line.number)
+
+    def check_brackets(self) -> None:
+        stack = []
+        pairs = {")": "(", "]": "["}
+        for line in self.lines:
+            for token in line.tokens:
+                if token.value in ("(", "["):
+                    stack.append(token)
+                elif token.value in pairs:
+                    if not stack or stack[-1].value != pairs[token.value]:
+                        self.report("brackets", "error", f"Unmatched '{token.value}'", token.line, token.column)
+                        return
+                    stack.pop()
+        if stack:
+            token = stack[-1]
+            self.report("brackets", "error", f"Unclosed '{token.value}'", token.line, token.column)
+
+    # ---- per line ----
+
+    def track_types(self, line: Line) -> None:
+        """
+        Remember variables that are numeric so bare uses as conditions can be flagged
+        """
+        if line.continuation:
+            return
+        tokens = [t for t in line.tokens if t.value not in ("var", "varip", "const", "simple", "series", "input")]
+        if len(tokens) < 3:
+            return
+
+        if tokens[0].value in ("int", "float", "bool") and tokens[1].kind == "name" and tokens[2].value == "=":
+            if tokens[0].value == "bool":
+                self.numeric_names.discard(tokens[1].value)
+            else:
+                self.numeric_names.add(tokens[1].value)
+            return
+
+        if tokens[0].kind == "name" and tokens[1].value in ("=", ":="):
+            rhs = tokens[2:]
+            if any(t.value in NON_NUMERIC_TOKENS for t in rhs):
+                if tokens[1].value == "=":
+                    self.numeric_names.discard(tokens[0].value)
+                return
+            first = rhs[0]
+            if _is_numeric_literal(first) or first.value in self.numeric_names or first.value in NUMERIC_FUNCTIONS:
+                self.numeric_names.add(tokens[0].value)
+
+    def check_local_scope(self, line: Line) -> None:
+        if line.continuation or line.indent == 0:
+            return
+        for i, token in enumerate(line.tokens):
+            if token.value in GLOBAL_ONLY_FUNCTIONS and i + 1 < len(line.tokens) and line.tokens[i + 1].value == "(":
+                self.report(
+                    "global_scope_only", "error",
+                    f"{token.value}() cannot be called inside a local block; compute the value in the block and call {token.value}() in global scope",
+                    line.number, token.column
+                )
+            if token.value.startswith("request.") and not self.dynamic_requests:
+                self.report(
+                    "request_scope", "error",
+                    f"{token.value}() cannot be used in a local block when dynamic_requests=false",
+                    line.number, token.column
+                )
+
+    def check_removed_names(self, line: Line) -> None:
+        tokens = line.tokens
+        for i, token in enumerate(tokens):
+            is_call = i + 1 < len(tokens) and tokens[i + 1].value == "("
+            is_definition = is_call and (i == 0 or tokens[i - 1].value == "method") and tokens[-1].value == "=>"
+            if is_call and not is_definition and token.value in REMOVED_FUNCTIONS:
+                self.report("removed_function", "error", REMOVED_FUNCTIONS[token.value], line.number, token.column)
+
+            is_keyword_argument = i + 1 < len(tokens) and tokens[i + 1].value == "=" and i > 0 and tokens[i - 1].value in ("(", ",")
+            if is_keyword_argument and token.value in REMOVED_PARAMETERS:
+                self.report("removed_parameter", "error", REMOVED_PARAMETERS[token.value], line.number, token.column)
+
+    def check_conditions(self, line: Line) -> None:
+        tokens = line.tokens
+        if tokens[0].value in ("if", "while") and len(tokens) == 2:
+            self._check_bool_operand(tokens[1], line)
+
+        for i, token in enumerate(tokens):
+            if token.value != "?" or i == 0:
+                continue
+            before = tokens[i - 2].value if i >= 2 else None
+            if before in (None, "=", ":=", "(", ",", "=>"):
+                self._check_bool_operand(tokens[i - 1], line)
+
+    def _check_bool_operand(self, token: Token, line: Line) -> None:
+        if _is_numeric_literal(token) or token.value in self.numeric_names:
+            self.report(
+                "implicit_bool_cast", "error",
+                f"'{token.value}' is numeric; v6 does not cast int/float to bool implicitly, use bool({token.value}) or a comparison",
+                line.number, token.column
+            )
+
+    def check_bool_na(self, line: Line) -> None:
+        values = [t.value for t in line.tokens if t.value not in ("var", "varip")]
+        if len(values) >= 4 and values[0] == "bool" and values[2] == "=" and values[3] == "na":
+            self.report("bool_na", "error", "bool values can never be na in v6, initialize with true or false", line.number)
+
+        for i, token in enumerate(line.tokens):
+            if token.value in ("na", "nz", "fixnan") and i + 1 < len(line.tokens) and line.tokens[i + 1].value == "(":
+                arguments = _call_arguments(line.tokens, i)
+                if len(arguments) == 1 and arguments[0].value in ("true", "false"):
+                    self.report("bool_na", "error", f"{token.value}() does not accept bool arguments in v6", line.number, token.column)
+
+    def check_request_security(self, line: Line) -> None:
+        tokens = line.tokens
+        for i, token in enumerate(tokens):
+            if token.value != "request.security":
+                continue
+            arguments = _call_arguments(tokens, i)
+            values = [t.value for t in arguments]
+            if "barmerge.lookahead_on" in values and "[" not in values:
+                self.report(
+                    "lookahead_repaint", "warning",
+                    "request.security() with lookahead_on repaints unless the expression is offset, e.g. close[1]",
+                    line.number, token.column
+                )
+
+    def check_strategy_calls(self, line: Line) -> None:
+        if self.declaration == "strategy":
+            return
+        for i, token in enumerate(line.tokens):
+            if token.value.startswith("strategy.") and i + 1 < len(line.tokens) and line.tokens[i + 1].value == "(":
+                self.report(
+                    "strategy_in_indicator", "error",
+                    f"{token.value}() can only be used in scripts declared with strategy()",
+                    line.number, token.column
+                )
+
+
+def validate(code: str) -> List[Diagnostic]:
+    """
+    Check Pine Script code against the mechanical v6 rules
+    Returns diagnostics sorted by position
+    """
+    return _Checker(code).run()
+
+
+def has_errors(diagnostics: List[Diagnostic]) -> bool:
+    return any(d.severity == "error" for d in diagnostics)
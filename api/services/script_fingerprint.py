@@ -0,0 +1,212 @@
+"""
+Script Fingerprints
+Winnowed k-gram hashes of normalized Pine Script tokens (as in MOSS),
+stored on each saved script to find near-duplicates of new code
+
+Normalization drops comments and layout and replaces literals and
+user-chosen variable names, so a copy with different inputs or renamed
+variables still matches. Built-ins (namespaced names like ta.rsi) and
+called functions are kept
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Set
+from services.pine_validator import tokenize
+from utils.supabase_client import get_db
+
+logger = logging.getLogger(__name__)
+
+# Tokens per k-gram, and k-grams per winnowing window: any shared run of
+# at least K + W - 1 tokens is guaranteed to share a fingerprint
+FINGERPRINT_K = 5
+FINGERPRINT_WINDOW = 8
+
+# Hashes stored per script; the smallest are kept (a bottom-k sketch),
+# and similar_scripts estimates Jaccard over the smallest
+# FINGERPRINT_MAX_HASHES of the union, which matches the full sets'
+# Jaccard in expectation. The SQL repeats this number
+FINGERPRINT_MAX_HASHES = 256
+
+# Jaccard similarity from which scripts count as near-duplicates
+SIMILARITY_THRESHOLD = float(os.getenv("SCRIPT_SIMILARITY_THRESHOLD", "0.5"))
+
+# Scripts saved before fingerprints existed are fingerprinted in the
+# background after a user's first lookup: this many per pass, and at most
+# FINGERPRINT_BACKFILL_MAX_BATCHES passes per run (a later lookup resumes)
+FINGERPRINT_BACKFILL_BATCH = 100
+FINGERPRINT_BACKFILL_MAX_BATCHES = 5
+
+# Updates in flight at once while backfilling
+FINGERPRINT_BACKFILL_CONCURRENCY = 8
+
+_KEYWORDS = frozenset({
+    "if", "else", "for", "to", "by", "in", "while", "switch", "and", "or", "not",
+    "var", "varip", "true", "false", "na", "import", "export", "method", "type",
+    "int", "float", "bool", "string", "color", "series", "simple", "const",
+    "break", "continue", "strategy", "indicator", "library", "open", "high",
+    "low", "close", "volume", "time", "hl2", "hlc3", "ohlc4", "bar_index",
+})
+
+_backfilled_users: Set[str] = set()
+# Running backfills by user, so a user has at most one
+_backfill_tasks: Dict[str, asyncio.Task] = {}
+
+_fingerprint_stats = {
+    "computed": 0,
+    "lookups": 0,
+    "matches": 0,
+    "backfilled": 0
+}
+
+
+def _normalized_tokens(code: str) -> List[str]:
+    tokens = [t for t in tokenize(code) if t.kind != "comment"]
+    normalized = []
+    for i, token in enumerate(tokens):
+        if token.kind == "string":
+            normalized.append("S")
+        elif token.kind == "number":
+            normalized.append("N")
+        elif token.kind == "color":
+            normalized.append("C")
+        elif token.kind == "name":
+            is_call = i + 1 < len(tokens) and tokens[i + 1].value == "("
+            if "." in token.value or is_call or token.value in _KEYWORDS:
+                normalized.append(token.value)
+            else:
+                normalized.append("V")
+        else:
+            normalized.append(token.value)
+    return normalized
+
+
+def _hash(gram: Sequence[str]) -> int:
+    """
+    Signed 32-bit hash, the range of a Postgres int
+    """
+    digest = hashlib.blake2b("\x1f".join(gram).encode("utf-8"), digest_size=4).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def fingerprint(code: str) -> List[int]:
+    """
+    Sorted, de-duplicated winnowed hashes of code (at most
+    FINGERPRINT_MAX_HASHES)
+    """
+    tokens = _normalized_tokens(code)
+    if not tokens:
+        return []
+
+    k = min(FINGERPRINT_K, len(tokens))
+    hashes = [_hash(tokens[i:i + k]) for i in range(len(tokens) - k + 1)]
+
+    # Winnowing: keep the minimum hash of every window
+    window = min(FINGERPRINT_WINDOW, len(hashes))
+    selected = {min(hashes[start:start + window]) for start in range(len(hashes) - window + 1)}
+
+    _fingerprint_stats["computed"] += 1
+    return sorted(selected)[:FINGERPRINT_MAX_HASHES]
+
+
+async def _backfill(user_id: str) -> bool:
+    """
+    Fingerprint a user's scripts that were saved without one, at most
+    FINGERPRINT_BACKFILL_MAX_BATCHES passes; returns whether it finished
+    Code that cannot be fingerprinted is stored with an empty fingerprint
+    so it is not picked up again; a pass with a failed update ends the
+    backfill rather than retrying the same rows
+    """
+    db = get_db()
+    semaphore = asyncio.Semaphore(FINGERPRINT_BACKFILL_CONCURRENCY)
+
+    async def update(row: Dict) -> bool:
+        async with semaphore:
+            try:
+                hashes = await asyncio.to_thread(fingerprint, row.get('code') or "")
+            except Exception as e:
+                logger.warning(f"Could not fingerprint script {row['id']}: {e}")
+                hashes = []
+            try:
+                await db.table("scripts").update({"fingerprint": hashes}).eq("id", row['id']).execute()
+                return True
+            except Exception as e:
+                logger.warning(f"Fingerprint backfill failed for script {row['id']}: {e}")
+                return False
+
+    for _ in range(FINGERPRINT_BACKFILL_MAX_BATCHES):
+        res = await db.table("scripts").select("id, code").eq(
+            "user_id", user_id
+        ).is_("fingerprint", "null").limit(FINGERPRINT_BACKFILL_BATCH).execute()
+        rows = res.data or []
+
+        updated = sum(await asyncio.gather(*(update(row) for row in rows)))
+        _fingerprint_stats["backfilled"] += updated
+
+        if len(rows) < FINGERPRINT_BACKFILL_BATCH or updated < len(rows):
+            return True
+    return False
+
+
+async def _run_backfill(user_id: str) -> None:
+    try:
+        if await _backfill(user_id):
+            _backfilled_users.add(user_id)
+    except Exception as e:
+        logger.warning(f"Fingerprint backfill failed for user {user_id}: {e}")
+
+
+def _schedule_backfill(user_id: str) -> None:
+    """
+    Start a background backfill for the user unless one ran to the end
+    or is still running; lookups meanwhile miss the unfingerprinted scripts
+    """
+    if user_id in _backfilled_users or user_id in _backfill_tasks:
+        return
+    task = asyncio.create_task(_run_backfill(user_id))
+    _backfill_tasks[user_id] = task
+    task.add_done_callback(lambda _: _backfill_tasks.pop(user_id, None))
+
+
+async def find_similar_scripts(
+    user_id: str,
+    hashes: List[int],
+    exclude_id: Optional[str] = None,
+    limit: int = 5,
+    min_similarity: float = SIMILARITY_THRESHOLD
+) -> List[Dict]:
+    """
+    The user's saved scripts whose fingerprint overlaps hashes by at
+    least min_similarity, most similar first
+    """
+    if not hashes:
+        return []
+
+    _fingerprint_stats["lookups"] += 1
+
+    _schedule_backfill(user_id)
+
+    res = await get_db().rpc("similar_scripts", {
+        "p_user_id": user_id,
+        "p_fingerprint": hashes,
+        "p_exclude_id": exclude_id,
+        "p_min_similarity": min_similarity,
+        "p_limit": limit
+    }).execute()
+
+    matches = res.data or []
+    _fingerprint_stats["matches"] += len(matches)
+    return matches
+
+
+def get_fingerprint_stats() -> Dict:
+    """
+    Get fingerprint and lookup counters
+    """
+    return {
+        **_fingerprint_stats,
+        "threshold": SIMILARITY_THRESHOLD,
+        "backfilled_users": len(_backfilled_users),
+        "backfills_running": len(_backfill_tasks)
+    }
@@ -0,0 +1,369 @@
+"""
+Library Search
+Ranked full-text search over a user's scripts (name, description, code
+identifiers) and threads (title, message text)
+
+Served by the Postgres full-text indexes through the search_library RPC.
+SEARCH_BACKEND=memory uses an in-process inverted index instead, built
+per user from their rows, for local runs and tests without the search
+migration
+"""
+import logging
+import math
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+from utils.supabase_client import get_db
+
+logger = logging.getLogger(__name__)
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "postgres").lower()
+
+SEARCH_KINDS = ("script", "thread")
+
+# In-memory backend: seconds a user's index is reused before a rebuild,
+# and how many users' indexes a worker keeps
+SEARCH_MEMORY_TTL = float(os.getenv("SEARCH_MEMORY_TTL", "30"))
+SEARCH_MEMORY_MAX_USERS = int(os.getenv("SEARCH_MEMORY_MAX_USERS", "100"))
+
+# Same field weights as the tsvector setweight() labels A-D (ts_rank_cd defaults)
+WEIGHT_TITLE = 1.0
+WEIGHT_DESCRIPTION = 0.4
+WEIGHT_CODE = 0.2
+WEIGHT_MESSAGE = 0.1
+
+SNIPPET_CHARS = 160
+
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have i if in into is it its of on or "
+    "that the their then there these this to was we were what when which will with you your".split()
+)
+
+_WORD = re.compile(r"[0-9a-z]+")
+_QUERY_PART = re.compile(r'(-?)"([^"]*)"|(-?)(\S+)')
+
+_search_stats = {
+    "queries": 0,
+    "results": 0,
+    "errors": 0,
+    "index_builds": 0
+}
+
+_latencies: Deque[float] = deque(maxlen=500)
+
+
+def _normalize(word: str) -> str:
+    """
+    Light plural folding, applied to documents and queries alike
+    """
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def _terms(text: Optional[str]) -> List[str]:
+    """
+    Index terms of a text: identifiers split on punctuation and
+    underscores (ta.crossover -> ta, crossover), stopwords dropped
+    """
+    return [
+        _normalize(word)
+        for word in _WORD.findall((text or "").lower())
+        if word not in _STOPWORDS
+    ]
+
+
+def _parse_query(query: str) -> Tuple[List[str], List[str]]:
+    """
+    Split a web-search style query into required and excluded terms
+    Quoted phrases count as their words; "or" is ignored, so all terms
+    are required
+    """
+    required: List[str] = []
+    excluded: List[str] = []
+    for match in _QUERY_PART.finditer(query):
+        negate = match.group(1) or match.group(3)
+        text = match.group(2) if match.group(2) is not None else match.group(4)
+        (excluded if negate else required).extend(_terms(text))
+    return list(dict.fromkeys(required)), list(dict.fromkeys(excluded))
+
+
+def _snippet(text: str, terms: Sequence[str]) -> str:
+    """
+    A window of text around the first matching word, matches in **bold**
+    """
+    if not text:
+        return ""
+    wanted = set(terms)
+    words = list(re.finditer(r"[0-9A-Za-z]+", text))
+    hits = [w for w in words if _normalize(w.group().lower()) in wanted]
+
+    start = max(0, hits[0].start() - SNIPPET_CHARS // 3) if hits else 0
+    end = min(len(text), start + SNIPPET_CHARS)
+    window = text[start:end]
+    for word in sorted({w.group() for w in hits if start <= w.start() and w.end() <= end}, key=len, reverse=True):
+        window = re.sub(rf"(?<![0-9A-Za-z*]){re.escape(word)}(?![0-9A-Za-z*])", f"**{word}**", window)
+    return " ".join(window.split())
+
+
+@dataclass
+class _Document:
+    kind: str
+    id: str
+    title: str
+    text: str
+    updated_at: str
+    thread_id: Optional[str] = None
+    terms: Dict[str, float] = field(default_factory=dict)
+
+
+class InvertedIndex:
+    """
+    In-process inverted index over one user's library
+    Postings map a term to the documents containing it with a weighted
+    term frequency; messages are indexed on their own and roll up into
+    their thread, like the SQL function
+    """
+
+    def __init__(self):
+        self._documents: Dict[Tuple[str, str], _Document] = {}
+        self._postings: Dict[str, Dict[Tuple[str, str], float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add(
+        self,
+        kind: str,
+        doc_id: str,
+        title: str,
+        fields: Sequence[Tuple[Optional[str], float]],
+        updated_at: str = "",
+        text: str = "",
+        thread_id: Optional[str] = None
+    ) -> None:
+        """
+        Index a document from (text, weight) fields, replacing any
+        previous version; text is what snippets are cut from
+        """
+        key = (kind, doc_id)
+        self.remove(kind, doc_id)
+
+        document = _Document(kind, doc_id, title, text, updated_at, thread_id)
+        for field_text, weight in fields:
+            for term in _terms(field_text):
+                document.terms[term] = document.terms.get(term, 0.0) + weight
+
+        self._documents[key] = document
+        for term, weight in document.terms.items():
+            self._postings.setdefault(term, {})[key] = weight
+
+    def remove(self, kind: str, doc_id: str) -> None:
+        document = self._documents.pop((kind, doc_id), None)
+        if not document:
+            return
+        for term in document.terms:
+            postings = self._postings.get(term)
+            if postings:
+                postings.pop((kind, doc_id), None)
+                if not postings:
+                    del self._postings[term]
+
+    def _score(self, required: List[str], excluded: List[str]) -> Dict[Tuple[str, str], float]:
+        """
+        tf-idf score of every document holding all required terms and
+        none of the excluded ones
+        """
+        if not required:
+            return {}
+
+        candidates = None
+        for term in sorted(required, key=lambda t: len(self._postings.get(t, ()))):
+            postings = self._postings.get(term)
+            if not postings:
+                return {}
+            candidates = set(postings) if candidates is None else candidates & set(postings)
+            if not candidates:
+                return {}
+
+        for term in excluded:
+            candidates -= set(self._postings.get(term, ()))
+
+        total = len(self._documents)
+        scores: Dict[Tuple[str, str], float] = {}
+        for key in candidates:
+            score = 0.0
+            for term in required:
+                postings = self._postings[term]
+                tf = postings[key]
+                score += tf / (1.0 + tf) * math.log(1.0 + total / len(postings))
+            scores[key] = score
+        return scores
+
+    def search(self, query: str, kinds: Sequence[str], limit: int, offset: int) -> List[Dict]:
+        """
+        Ranked matches shaped like search_library rows
+        """
+        required, excluded = _parse_query(query)
+        scores = self._score(required, excluded)
+
+        hits: Dict[Tuple[str, str], Dict] = {}
+        for (kind, doc_id), score in scores.items():
+            document = self._documents[(kind, doc_id)]
+            if kind == "message":
+                if "thread" not in kinds or ("thread", document.thread_id) not in self._documents:
+                    continue
+                thread = self._documents[("thread", document.thread_id)]
+                hit = hits.get(("thread", thread.id))
+                if hit is None:
+                    hit = hits[("thread", thread.id)] = self._hit(thread, 0.0)
+                if score > hit["_message_rank"]:
+                    hit.update(message_id=doc_id, _message_rank=score, _source=document.text)
+                hit["rank"] = max(hit["rank"], score)
+            elif kind in kinds:
+                hit = hits.get((kind, doc_id))
+                if hit is None:
+                    hits[(kind, doc_id)] = self._hit(document, score)
+                elif score > hit["rank"]:
+                    hit["rank"] = score
+
+        ranked = sorted(hits.values(), key=lambda h: (h["updated_at"], h["id"]), reverse=True)
+        ranked.sort(key=lambda h: h["rank"], reverse=True)
+
+        page = ranked[offset:offset + limit]
+        for hit in page:
+            del hit["_message_rank"]
+            hit["snippet"] = _snippet(hit.pop("_source"), required)
+            hit["rank"] = round(hit["rank"], 6)
+        return page
+
+    @staticmethod
+    def _hit(document: _Document, score: float) -> Dict:
+        return {
+            "kind": document.kind,
+            "id": document.id,
+            "title": document.title,
+            "snippet": "",
+            "message_id": None,
+            "rank": score,
+            "updated_at": document.updated_at,
+            "_source": document.text,
+            "_message_rank": 0.0,
+        }
+
+
+_indexes: "OrderedDict[str, Tuple[float, InvertedIndex]]" = OrderedDict()
+
+
+async def _build_index(user_id: str) -> InvertedIndex:
+    """
+    Index a user's scripts, threads and messages
+    """
+    db = get_db()
+    index = InvertedIndex()
+
+    scripts = await db.table("scripts").select(
+        "id, name, description, code, created_at"
+    ).eq("user_id", user_id).execute()
+    for s in scripts.data or []:
+        index.add(
+            "script", s['id'], s['name'],
+            [(s['name'], WEIGHT_TITLE), (s.get('description'), WEIGHT_DESCRIPTION), (s['code'], WEIGHT_CODE)],
+            updated_at=s['created_at'],
+            text=f"{s.get('description') or ''} {s['code'][:5000]}"
+        )
+
+    threads = await db.table("threads").select(
+        "id, title, preview, last_activity"
+    ).eq("user_id", user_id).execute()
+    thread_ids = []
+    for t in threads.data or []:
+        thread_ids.append(t['id'])
+        index.add(
+            "thread", t['id'], t['title'], [(t['title'], WEIGHT_TITLE)],
+            updated_at=t['last_activity'], text=t.get('preview') or t['title']
+        )
+
+    # Batched so the in=() filter stays within URL limits
+    for i in range(0, len(thread_ids), 100):
+        messages = await db.table("messages").select(
+            "id, thread_id, content"
+        ).in_("thread_id", thread_ids[i:i + 100]).execute()
+        for m in messages.data or []:
+            index.add(
+                "message", m['id'], "", [(m['content'], WEIGHT_MESSAGE)],
+                text=m['content'][:5000], thread_id=m['thread_id']
+            )
+
+    _search_stats["index_builds"] += 1
+    return index
+
+
+async def _get_index(user_id: str) -> InvertedIndex:
+    entry = _indexes.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        _indexes.move_to_end(user_id)
+        return entry[1]
+
+    index = await _build_index(user_id)
+    _indexes[user_id] = (time.monotonic() + SEARCH_MEMORY_TTL, index)
+    _indexes.move_to_end(user_id)
+    while len(_indexes) > SEARCH_MEMORY_MAX_USERS:
+        _indexes.popitem(last=False)
+    return index
+
+
+async def search_library(
+    user_id: str,
+    query: str,
+    kinds: Sequence[str] = SEARCH_KINDS,
+    limit: int = 20,
+    offset: int = 0
+) -> List[Dict]:
+    """
+    Search a user's scripts and threads, best match first
+    Each result has kind, id, title, snippet (matches in **bold**),
+    message_id (a thread's best matching message) and rank
+    """
+    start = time.monotonic()
+    _search_stats["queries"] += 1
+
+    try:
+        if SEARCH_BACKEND == "memory":
+            index = await _get_index(user_id)
+            results = index.search(query, kinds, limit, offset)
+        else:
+            res = await get_db().rpc("search_library", {
+                "p_user_id": user_id,
+                "p_query": query,
+                "p_kinds": list(kinds),
+                "p_limit": limit,
+                "p_offset": offset
+            }).execute()
+            results = res.data or []
+    except Exception:
+        _search_stats["errors"] += 1
+        raise
+
+    _latencies.append(time.monotonic() - start)
+    _search_stats["results"] += len(results)
+    return results
+
+
+def get_search_stats() -> Dict:
+    """
+    Get the backend, query counters and latency
+    """
+    latencies = sorted(_latencies)
+    return {
+        **_search_stats,
+        "backend": SEARCH_BACKEND,
+        "indexed_users": len(_indexes),
+        "latency_ms": {
+            "p50": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else 0.0,
+            "p95": round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else 0.0,
+        }
+    }
@@ -0,0 +1,262 @@
+"""
+Semantic Prompt Index - MinHash sketches with LSH banding
+Finds near-duplicate cached prompts ("rsi strategy, period 14" ~ "RSI strategy with 14 period")
+"""
+import hashlib
+import re
+import time
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+
+# Candidates must collide in at least this many bands, and at most
+# MAX_CANDIDATES of them (most collisions first) are compared in full
+MIN_BAND_MATCHES = 2
+MAX_CANDIDATES = 64
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Fixed permutation coefficients so sketches are stable across processes
+_PERMUTATIONS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (_MERSENNE_PRIME - 1) + 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME,
+    )
+    for i in range(NUM_PERMUTATIONS)
+]
+
+_STOPWORDS = frozenset({
+    "a", "an", "and", "the", "with", "for", "to", "of", "in", "on", "at", "by", "is", "it",
+    "that", "this", "me", "my", "i", "please", "can", "you", "using", "use", "create", "make",
+    "write", "generate", "give", "show", "pine", "script", "pinescript", "code",
+})
+
+_WORD_PATTERN = re.compile(r"[a-z0-9_.]+")
+
+# Terms that decide which script a prompt asks for. Prompts only match
+# when they use the same ones, however similar the rest is. Polarity
+# words flip the logic ("with" is the unmarked case of "without", so only
+# the latter counts); script type, moving-average family and indicator
+# names pick a different script outright
+_KEY_TERMS = {
+    "buy": "buy", "buys": "buy", "buying": "buy",
+    "sell": "sell", "sells": "sell", "selling": "sell",
+    "long": "long", "longs": "long",
+    "short": "short", "shorts": "short", "shorting": "short",
+    "above": "above", "over": "over",
+    "below": "below", "under": "under",
+    "crossover": "crossover", "crossovers": "crossover",
+    "crossunder": "crossunder", "crossunders": "crossunder",
+    "bullish": "bullish", "bearish": "bearish",
+    "without": "without", "no": "no", "not": "not",
+    "indicator": "indicator", "indicators": "indicator", "study": "indicator",
+    "strategy": "strategy", "strategies": "strategy", "backtest": "strategy",
+    "library": "library",
+    "sma": "sma", "ema": "ema", "exponential": "ema", "wma": "wma", "weighted": "wma",
+    "vwma": "vwma", "hma": "hma", "hull": "hma", "rma": "rma", "smma": "rma",
+    "dema": "dema", "tema": "tema", "alma": "alma", "lsma": "lsma", "linreg": "lsma",
+    "rsi": "rsi", "macd": "macd", "atr": "atr", "adx": "adx", "dmi": "dmi",
+    "bollinger": "bb", "bb": "bb", "stoch": "stoch", "stochastic": "stoch",
+    "vwap": "vwap", "supertrend": "supertrend", "ichimoku": "ichimoku", "cci": "cci",
+    "mfi": "mfi", "obv": "obv", "keltner": "keltner", "donchian": "donchian",
+    "psar": "psar", "sar": "psar", "momentum": "momentum", "roc": "roc",
+}
+
+# Key terms and numbers are read from letter and digit runs, so
+# ta.crossover, ema200 and 2% still count
+_KEY_PATTERN = re.compile(r"\d+(?:\.\d+)?|[a-z]+")
+
+
+def _number(word: str) -> str:
+    """
+    Numbers in one spelling ("2.0" -> "2"), other words unchanged
+    """
+    if "." in word and word.replace(".", "", 1).isdigit():
+        return word.rstrip("0").rstrip(".") or "0"
+    return word
+
+
+def prompt_features(prompt: str) -> Set[str]:
+    """
+    Order-insensitive words of a prompt, plus number bindings
+    Each number is bound to its neighbouring words so "rsi 14 ema 50" and
+    "rsi 50 ema 14" stay apart while "period 14" and "14 period" match
+    """
+    words = [w.strip(".") for w in _WORD_PATTERN.findall(prompt.lower())]
+    words = [_number(w) for w in words if w and w not in _STOPWORDS]
+
+    features = set(words)
+    for i, word in enumerate(words):
+        if not word.replace(".", "").isdigit():
+            continue
+        for j in (i - 1, i + 1):
+            if 0 <= j < len(words) and not words[j].replace(".", "").isdigit():
+                features.add(f"{words[j]}~{word}")
+
+    return features
+
+
+def prompt_key_terms(prompt: str) -> frozenset:
+    """
+    The key terms and numeric literals of a prompt ("2" and "2.0" are the
+    same number)
+    """
+    terms = set()
+    for part in _KEY_PATTERN.findall(prompt.lower()):
+        if part[0].isdigit():
+            terms.add(f"#{_number(part)}")
+        elif part in _KEY_TERMS:
+            terms.add(_KEY_TERMS[part])
+    return frozenset(terms)
+
+
+def minhash(features: Set[str]) -> array:
+    """
+    Compute a 64-value MinHash sketch (256 bytes) of a feature set
+    """
+    signature = array("I", [_MAX_HASH] * NUM_PERMUTATIONS)
+    for feature in features:
+        value = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest(), "big")
+        for i, (a, b) in enumerate(_PERMUTATIONS):
+            hashed = ((a * value + b) % _MERSENNE_PRIME) & _MAX_HASH
+            if hashed < signature[i]:
+                signature[i] = hashed
+    return signature
+
+
+def estimate_similarity(left: array, right: array) -> float:
+    """
+    Estimate Jaccard similarity from two sketches
+    """
+    return sum(1 for x, y in zip(left, right) if x == y) / NUM_PERMUTATIONS
+
+
+class SemanticPromptIndex:
+    """
+    In-process LSH index from prompt sketches to cache keys
+
+    Lookups touch BANDS buckets and compare only the best-colliding
+    candidates found there, so cost stays bounded as the index grows.
+    """
+
+    def __init__(self, max_entries: int = 100_000):
+        self.max_entries = max_entries
+        # key -> (signature, key_terms, expires_at), in LRU order
+        self._entries: "OrderedDict[str, Tuple[array, frozenset, float]]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, bytes], Set[str]] = defaultdict(set)
+        self._stats = {
+            "lookups": 0,
+            "hits": 0,
+            "misses": 0,
+            "candidates": 0,
+            "evictions": 0,
+            "lookup_ms_total": 0.0,
+            "lookup_ms_max": 0.0,
+        }
+        # Best similarity seen per lookup, in 0.1 wide buckets
+        self._similarity_histogram = [0] * 10
+
+    @staticmethod
+    def _band_keys(signature: array) -> List[Tuple[int, bytes]]:
+        return [
+            (band, signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes())
+            for band in range(BANDS)
+        ]
+
+    def add(self, key: str, prompt: str, ttl: int) -> None:
+        """
+        Index a cached prompt under its cache key
+        """
+        if key in self._entries:
+            self.remove(key)
+
+        signature = minhash(prompt_features(prompt))
+        self._entries[key] = (signature, prompt_key_terms(prompt), time.time() + ttl)
+        for band_key in self._band_keys(signature):
+            self._buckets[band_key].add(key)
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self.remove(oldest)
+            self._stats["evictions"] += 1
+
+    def remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if not entry:
+            return
+        for band_key in self._band_keys(entry[0]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def lookup(self, prompt: str, threshold: float) -> Optional[Tuple[str, float]]:
+        """
+        Find the most similar indexed prompt at or above threshold with
+        the same key terms and numbers
+        Returns (key, similarity) or None
+        """
+        started = time.perf_counter()
+        signature = minhash(prompt_features(prompt))
+        key_terms = prompt_key_terms(prompt)
+        now = time.time()
+
+        band_matches: Counter = Counter()
+        for band_key in self._band_keys(signature):
+            band_matches.update(self._buckets.get(band_key, ()))
+
+        candidates = [
+            key for key, matches in band_matches.most_common(MAX_CANDIDATES)
+            if matches >= MIN_BAND_MATCHES
+        ]
+
+        best_key, best_similarity = None, 0.0
+        for key in candidates:
+            candidate_signature, candidate_terms, expires_at = self._entries[key]
+            if expires_at <= now:
+                self.remove(key)
+                continue
+            if candidate_terms != key_terms:
+                continue
+            similarity = estimate_similarity(signature, candidate_signature)
+            if similarity > best_similarity:
+                best_key, best_similarity = key, similarity
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._stats["lookups"] += 1
+        self._stats["candidates"] += len(candidates)
+        self._stats["lookup_ms_total"] += elapsed_ms
+        self._stats["lookup_ms_max"] = max(self._stats["lookup_ms_max"], elapsed_ms)
+        self._similarity_histogram[min(int(best_similarity * 10), 9)] += 1
+
+        if best_key and best_similarity >= threshold:
+            self._entries.move_to_end(best_key)
+            self._stats["hits"] += 1
+            return best_key, best_similarity
+
+        self._stats["misses"] += 1
+        return None
+
+    def get_stats(self) -> Dict:
+        lookups = self._stats["lookups"]
+        return {
+            "entries": len(self._entries),
+            "lookups": lookups,
+            "hits": self._stats["hits"],
+            "misses": self._stats["misses"],
+            "hit_rate": round(self._stats["hits"] / lookups, 4) if lookups else 0.0,
+            "evictions": self._stats["evictions"],
+            "avg_candidates": round(self._stats["candidates"] / lookups, 2) if lookups else 0.0,
+            "avg_lookup_ms": round(self._stats["lookup_ms_total"] / lookups, 3) if lookups else 0.0,
+            "max_lookup_ms": round(self._stats["lookup_ms_max"], 3),
+            "similarity_histogram": {
+                f"{i / 10:.1f}-{(i + 1) / 10:.1f}": count
+                for i, count in enumerate(self._similarity_histogram)
+            },
+        }
@@ -0,0 +1,192 @@
+"""
+Single-flight Request Coalescing
+Concurrent identical requests share one in-flight computation,
+within a worker (shared future) and across workers (Redis lock + done flag)
+"""
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from services.cache_service import get_redis
+
+logger = logging.getLogger(__name__)
+
+# How long the cross-worker lock is held at most
+SINGLEFLIGHT_LOCK_SECONDS = int(os.getenv("SINGLEFLIGHT_LOCK_SECONDS", "120"))
+
+# How long a follower in another worker waits before running the work
+# itself, and how often it checks (each check is a Redis round trip off
+# the event loop)
+SINGLEFLIGHT_WAIT_SECONDS = float(os.getenv("SINGLEFLIGHT_WAIT_SECONDS", "30"))
+SINGLEFLIGHT_POLL_SECONDS = float(os.getenv("SINGLEFLIGHT_POLL_SECONDS", "0.5"))
+
+# Deletes the lock only if this worker still owns it
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_inflight: Dict[str, asyncio.Future] = {}
+
+_stats = {
+    "leaders": 0,
+    "local_followers": 0,
+    "remote_followers": 0,
+    "remote_fallbacks": 0
+}
+
+
+def _lock_key(key: str) -> str:
+    return f"singleflight:{key}:lock"
+
+
+def _done_key(key: str) -> str:
+    return f"singleflight:{key}:done"
+
+
+def _try_lock(key: str, token: str) -> bool:
+    """
+    Take the cross-worker lock; True when Redis is unavailable
+    """
+    redis = get_redis()
+    if not redis:
+        return True
+    try:
+        redis.delete(_done_key(key))
+        return bool(redis.set(_lock_key(key), token, nx=True, ex=SINGLEFLIGHT_LOCK_SECONDS))
+    except Exception as e:
+        logger.warning(f"Single-flight lock error: {e}")
+        return True
+
+
+def _release(key: str, token: str, succeeded: bool) -> None:
+    """
+    Notify waiting workers and release the lock
+    """
+    redis = get_redis()
+    if not redis:
+        return
+    try:
+        redis.set(_done_key(key), "1" if succeeded else "0", ex=30)
+        redis.eval(_RELEASE_SCRIPT, keys=[_lock_key(key)], args=[token])
+    except Exception as e:
+        logger.warning(f"Single-flight release error: {e}")
+
+
+def _remote_state(key: str) -> Tuple[Optional[str], bool]:
+    """
+    The leader's done flag and whether it still holds the lock
+    """
+    redis = get_redis()
+    return redis.get(_done_key(key)), bool(redis.exists(_lock_key(key)))
+
+
+async def _wait_for_remote(key: str, poll: Callable[[], Awaitable[Optional[Any]]]) -> Optional[Any]:
+    """
+    Wait for another worker's result
+    Returns None if that worker failed, released the lock without a result,
+    or did not finish within SINGLEFLIGHT_WAIT_SECONDS
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SINGLEFLIGHT_WAIT_SECONDS
+
+    while loop.time() < deadline:
+        await asyncio.sleep(SINGLEFLIGHT_POLL_SECONDS)
+        try:
+            # The Redis client is synchronous
+            done, locked = await asyncio.to_thread(_remote_state, key)
+            if done is not None:
+                return await poll() if str(done) == "1" else None
+            if not locked:
+                return await poll()
+        except Exception as e:
+            logger.warning(f"Single-flight wait error: {e}")
+            return None
+
+    return None
+
+
+async def coalesce(
+    key: str,
+    work: Callable[[], Awaitable[Any]],
+    poll: Callable[[], Awaitable[Optional[Any]]]
+) -> Tuple[Any, bool]:
+    """
+    Run work once for all concurrent callers with the same key
+
+    The first caller (the leader) runs work. Callers in the same worker
+    await its future; callers in other workers poll() (e.g. the response
+    cache) once the leader signals completion through Redis.
+
+    Returns (result, is_leader). Errors of the leader propagate to
+    followers in the same worker; followers in other workers, and local
+    followers of a cancelled leader, fall back to running work themselves.
+    """
+    existing = _inflight.get(key)
+    if existing is not None and not existing.cancelled():
+        _stats["local_followers"] += 1
+        try:
+            return await asyncio.shield(existing), False
+        except asyncio.CancelledError:
+            if not existing.cancelled():
+                raise  # This caller was cancelled, not the leader
+            # The leader was cancelled (e.g. its client disconnected)
+            return await coalesce(key, work, poll)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+
+    try:
+        token = uuid.uuid4().hex
+
+        if not await asyncio.to_thread(_try_lock, key, token):
+            result = await _wait_for_remote(key, poll)
+            if result is not None:
+                _stats["remote_followers"] += 1
+                future.set_result(result)
+                return result, False
+
+            _stats["remote_fallbacks"] += 1
+            await asyncio.to_thread(_try_lock, key, token)
+
+        _stats["leaders"] += 1
+        succeeded = False
+        try:
+            result = await work()
+            succeeded = True
+            future.set_result(result)
+            return result, True
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            await asyncio.to_thread(_release, key, token, succeeded)
+    finally:
+        # A follower of this leader may have taken over the key after a cancel
+        if _inflight.get(key) is future:
+            del _inflight[key]
+        if not future.done():
+            future.cancel()
+        elif not future.cancelled():
+            # Mark a leader error as retrieved even if nobody else awaited it
+            future.exception()
+
+
+def get_singleflight_stats() -> Dict:
+    """
+    Get leader/follower counts and the number of requests currently in flight
+    """
+    total = _stats["leaders"] + _stats["local_followers"] + _stats["remote_followers"]
+    followers = _stats["local_followers"] + _stats["remote_followers"]
+
+    return {
+        **_stats,
+        "in_flight": len(_inflight),
+        "coalesced_ratio": round(followers / total, 4) if total else 0.0
+    }
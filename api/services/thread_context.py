@@ -0,0 +1,153 @@
+"""
+Thread Context Builder
+Assembles prior messages of a thread into bounded context for follow-ups:
+the latest code verbatim, recent turns as written, older turns summarized
+"""
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+from utils.helpers import estimate_tokens, extract_pine_script, truncate_text
+
+logger = logging.getLogger(__name__)
+
+# Most thread tokens sent with a follow-up, by plan
+THREAD_CONTEXT_BUDGETS = {
+    "hobby": 2000,
+    "starter": 4000,
+    "pro": 8000,
+    "business": 16000
+}
+
+# Messages read from the thread, and how many of the newest are kept verbatim
+THREAD_CONTEXT_MAX_MESSAGES = int(os.getenv("THREAD_CONTEXT_MAX_MESSAGES", "40"))
+THREAD_CONTEXT_RECENT_MESSAGES = 4
+RECENT_MESSAGE_MAX_CHARS = 1200
+SUMMARY_LINE_MAX_CHARS = 160
+
+class ThreadCodeTooLargeError(Exception):
+    """
+    The thread's current code alone exceeds the plan's context budget
+    """
+
+    def __init__(self, code_tokens: int, budget: int):
+        super().__init__(f"Thread code is {code_tokens} tokens, over the {budget} token budget")
+        self.code_tokens = code_tokens
+        self.budget = budget
+
+
+_DECLARATION_PATTERN = re.compile(r"\b(indicator|strategy|library)\s*\(\s*(?:title\s*=\s*)?[\"']([^\"']*)[\"']")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def _code_in(content: str) -> Optional[str]:
+    """
+    Pine Script in a message, None if it has none
+    """
+    code = extract_pine_script(content or "")
+    if "//@version" in code or _DECLARATION_PATTERN.search(code):
+        return code
+    return None
+
+
+def _summarize_message(message: Dict) -> str:
+    """
+    One extractive line per message: the first sentence of a request,
+    or the declaration of generated code
+    """
+    content = (message.get('content') or "").strip()
+    code = _code_in(content)
+
+    if message.get('role') == 'assistant':
+        if code:
+            match = _DECLARATION_PATTERN.search(code)
+            what = f'{match.group(1)} "{match.group(2)}"' if match else "a script"
+            return f"Assistant wrote {what} ({len(code.splitlines())} lines)"
+        return "Assistant: " + truncate_text(content.splitlines()[0] if content else "", SUMMARY_LINE_MAX_CHARS)
+
+    request = content.removeprefix("[Refinement Request]").strip()
+    if code:
+        request = request.replace(code, "").strip() or "(pasted code)"
+    first_sentence = _SENTENCE_END.split(request, maxsplit=1)[0]
+    return "User asked: " + truncate_text(" ".join(first_sentence.split()), SUMMARY_LINE_MAX_CHARS)
+
+
+async def build_thread_context(db, thread_id: str, plan: str) -> Optional[str]:
+    """
+    Build the history block sent ahead of a follow-up prompt
+
+    Within the plan's token budget, the latest code in the thread comes
+    first, then the newest messages as written, then summaries of older
+    messages (newest first) until the budget runs out.
+    Returns None for a thread without messages. The code is never cut,
+    since follow-ups ask for the complete updated script: if it alone
+    exceeds the budget, ThreadCodeTooLargeError is raised.
+    """
+    budget = THREAD_CONTEXT_BUDGETS.get(plan, THREAD_CONTEXT_BUDGETS["hobby"])
+
+    response = await db.table("messages").select(
+        "id, role, content, created_at"
+    ).eq("thread_id", thread_id).order("created_at", desc=True).limit(THREAD_CONTEXT_MAX_MESSAGES).execute()
+
+    messages = list(reversed(response.data or []))
+    if not messages:
+        return None
+
+    # Latest code artifact, verbatim; history is dropped to make room for it
+    code, code_message_id = None, None
+    for message in reversed(messages):
+        code = _code_in(message.get('content'))
+        if code:
+            code_message_id = message['id']
+            break
+
+    remaining = budget
+    code_block = None
+    if code:
+        code_block = f"```pine\n{code}\n```"
+        code_tokens = estimate_tokens(code_block)
+        if code_tokens > remaining:
+            raise ThreadCodeTooLargeError(code_tokens, budget)
+        remaining -= code_tokens
+
+    # Newest messages as written; generated code is represented by the code block
+    others = [m for m in messages if not (m['id'] == code_message_id and m['role'] == 'assistant')]
+    recent_candidates = others[-THREAD_CONTEXT_RECENT_MESSAGES:]
+    older = others[:-THREAD_CONTEXT_RECENT_MESSAGES]
+
+    recent: List[str] = []
+    for message in reversed(recent_candidates):
+        content = message.get('content') or ""
+        if _code_in(content):
+            line = _summarize_message(message)
+        else:
+            line = f"{message['role'].capitalize()}: {truncate_text(content.strip(), RECENT_MESSAGE_MAX_CHARS)}"
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        recent.insert(0, line)
+        remaining -= cost
+
+    summary: List[str] = []
+    # Summaries are cheap extracts, computed per request (newest first, until the budget runs out)
+    for message in reversed(older):
+        line = _summarize_message(message)
+        cost = estimate_tokens(line)
+        if cost > remaining:
+            break
+        summary.insert(0, f"- {line}")
+        remaining -= cost
+
+    sections = []
+    if summary:
+        sections.append("EARLIER IN THIS CONVERSATION (summarized):\n" + "\n".join(summary))
+    if recent:
+        sections.append("RECENT MESSAGES:\n" + "\n".join(recent))
+    if code_block:
+        sections.append("CURRENT CODE IN THIS CONVERSATION:\n" + code_block)
+
+    if not sections:
+        return None
+
+    logger.info(f"Thread context for {thread_id}: {budget - remaining}/{budget} tokens, {len(summary)} summarized")
+    return "\n\n".join(sections)
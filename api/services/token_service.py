@@ -3,8 +3,9 @@ Token Management Service
 Handles token tracking, deduction, and usage analytics
 """
 from datetime import datetime, timedelta
-from typing import Dict, List
-from utils.supabase_client import get_supabase
+from typing import Dict, List, Optional
+from utils.supabase_client import get_db
+from utils.profile_cache import invalidate_profile
 from utils.helpers import tokens_to_words, get_days_until_reset
 
 async def check_token_balance(user: Dict, tokens_needed: int) -> bool:
@@ -18,16 +19,19 @@ async def deduct_tokens(user_id: str, tokens_used: int, thread_id: str = None, a
     Deduct tokens from user's balance atomically via RPC
     Returns updated user profile
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Call the atomic SQL function
-    response = supabase.rpc("deduct_user_tokens", {
+    response = await db.rpc("deduct_user_tokens", {
         "p_user_id": user_id,
         "p_tokens_to_deduct": tokens_used,
         "p_thread_id": thread_id,
         "p_action": action
     }).execute()
     
+    # The balance changed (or the cached one was wrong), refetch next time
+    await invalidate_profile(user_id)
+    
     res_data = response.data
     
     if not res_data or not res_data.get('success'):
@@ -36,12 +40,60 @@ async def deduct_tokens(user_id: str, tokens_used: int, thread_id: str = None, a
     
     return res_data['data']
 
+async def record_generation(
+    user_id: str,
+    thread_id: Optional[str],
+    new_thread: Dict,
+    prompt: str,
+    prompt_tokens: int,
+    content: str,
+    input_tokens: int,
+    output_tokens: int,
+    total_tokens: int,
+    action: str = "generate"
+) -> Dict:
+    """
+    Save a generation exchange and charge for it in one transaction via RPC
+    Creates the thread from new_thread (title, is_saved, expires_at) when
+    thread_id is None. total_tokens=0 records a free (cached) exchange.
+    Returns thread_id, message (the assistant row), user (the updated
+    balance, None when nothing was charged) and shortfall (tokens beyond
+    the balance; it is clamped at 0 and the exchange is still saved)
+    """
+    db = get_db()
+    
+    response = await db.rpc("record_generation", {
+        "p_user_id": user_id,
+        "p_thread_id": thread_id,
+        "p_thread_title": new_thread['title'],
+        "p_thread_is_saved": new_thread['is_saved'],
+        "p_thread_expires_at": new_thread['expires_at'],
+        "p_prompt": prompt,
+        "p_prompt_tokens": prompt_tokens,
+        "p_content": content,
+        "p_input_tokens": input_tokens,
+        "p_output_tokens": output_tokens,
+        "p_total_tokens": total_tokens,
+        "p_action": action
+    }).execute()
+    
+    if total_tokens:
+        await invalidate_profile(user_id)
+    
+    res_data = response.data
+    
+    if not res_data or not res_data.get('success'):
+        error_msg = res_data.get('error', 'record_generation_failed') if res_data else 'rpc_failed'
+        raise Exception(f"Recording generation failed: {error_msg}")
+    
+    return res_data['data']
+
 async def get_token_balance(user_id: str) -> Dict:
     """
     Get detailed token balance information
     """
-    supabase = get_supabase()
-    user_response = supabase.table("user_profiles").select("*").eq("id", user_id).single().execute()
+    db = get_db()
+    user_response = await db.table("user_profiles").select("*").eq("id", user_id).single().execute()
     user = user_response.data
     
     usage_percentage = (user['tokens_used_this_month'] / user['tokens_monthly_limit']) * 100
@@ -64,7 +116,7 @@ async def get_usage_analytics(user_id: str, period: str = "month") -> Dict:
     """
     Get token usage analytics
     """
-    supabase = get_supabase()
+    db = get_db()
     
     # Calculate date range
     now = datetime.now()
@@ -76,7 +128,7 @@ async def get_usage_analytics(user_id: str, period: str = "month") -> Dict:
         start_date = now - timedelta(days=30)
     
     # Get usage data
-    usage_response = supabase.table("token_usage") \
+    usage_response = await db.table("token_usage") \
         .select("*") \
         .eq("user_id", user_id) \
         .gte("created_at", start_date.isoformat()) \
@@ -117,9 +169,9 @@ async def reset_monthly_tokens(user_id: str) -> None:
     Reset tokens at the start of new billing cycle
     Called by Stripe webhook on successful payment
     """
-    supabase = get_supabase()
+    db = get_db()
     
-    user_response = supabase.table("user_profiles").select("*").eq("id", user_id).single().execute()
+    user_response = await db.table("user_profiles").select("*").eq("id", user_id).single().execute()
     user = user_response.data
     
     update_data = {
@@ -129,4 +181,5 @@ async def reset_monthly_tokens(user_id: str) -> None:
         'updated_at': datetime.now().isoformat()
     }
     
-    supabase.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await db.table("user_profiles").update(update_data).eq("id", user_id).execute()
+    await invalidate_profile(user_id)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Tests import modules the way the app does (from the api directory)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# Importing services pulls in the app's settings; tests make no real calls
+os.environ.setdefault("SUPABASE_URL", "https://test.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "test-service-key")
+os.environ.setdefault("SUPABASE_JWT_SECRET", "test-jwt-secret")
+os.environ.setdefault("LLM_PROVIDER", "local")
@@ -0,0 +1,154 @@
+"""
+In-memory library search: ranking, exclusion, message to thread roll-up,
+pagination, query parsing and snippets
+"""
+import pytest
+from services.search_service import (
+    InvertedIndex, WEIGHT_CODE, WEIGHT_DESCRIPTION, WEIGHT_MESSAGE, WEIGHT_TITLE,
+    _parse_query, _snippet
+)
+
+KINDS = ("script", "thread")
+
+
+def _script(index, doc_id, name, description="", code="", updated_at="2026-01-01"):
+    index.add(
+        "script", doc_id, name,
+        [(name, WEIGHT_TITLE), (description, WEIGHT_DESCRIPTION), (code, WEIGHT_CODE)],
+        updated_at=updated_at, text=f"{description} {code}"
+    )
+
+
+def _thread(index, doc_id, title, updated_at="2026-01-01"):
+    index.add("thread", doc_id, title, [(title, WEIGHT_TITLE)], updated_at=updated_at, text=title)
+
+
+def _message(index, doc_id, thread_id, content):
+    index.add("message", doc_id, "", [(content, WEIGHT_MESSAGE)], text=content, thread_id=thread_id)
+
+
+@pytest.fixture
+def index():
+    index = InvertedIndex()
+    _script(index, "s1", "RSI divergence", "Bullish RSI divergence alerts", "plot(ta.rsi(close, 14))")
+    _script(index, "s2", "EMA crossover", "Trend strategy, RSI filter", "ta.crossover(ta.ema(close, 9), ta.ema(close, 21))")
+    _script(index, "s3", "Volume profile", "Session volume", "plot(volume)")
+    _thread(index, "t1", "Help with my strategy")
+    _message(index, "m1", "t1", "Can you add an RSI filter to the crossover?")
+    _message(index, "m2", "t1", "Make the RSI filter use 30 and 70 levels, RSI on the daily")
+    _thread(index, "t2", "Bollinger bands")
+    _message(index, "m3", "t2", "Bands with a 2 standard deviation width")
+    return index
+
+
+def test_title_match_outranks_code_match(index):
+    results = index.search("rsi", ["script"], limit=10, offset=0)
+    assert [r["id"] for r in results] == ["s1", "s2"]
+    assert results[0]["rank"] > results[1]["rank"]
+
+
+def test_all_terms_are_required(index):
+    results = index.search("rsi crossover", ["script"], limit=10, offset=0)
+    assert [r["id"] for r in results] == ["s2"]
+
+
+def test_unknown_term_matches_nothing(index):
+    assert index.search("rsi ichimoku", KINDS, limit=10, offset=0) == []
+
+
+def test_excluded_terms_drop_documents(index):
+    results = index.search("rsi -divergence", ["script"], limit=10, offset=0)
+    assert [r["id"] for r in results] == ["s2"]
+
+
+def test_exclusion_only_query_matches_nothing(index):
+    assert index.search("-rsi", KINDS, limit=10, offset=0) == []
+
+
+def test_messages_roll_up_into_their_thread(index):
+    results = index.search("rsi filter", ["thread"], limit=10, offset=0)
+    assert len(results) == 1
+    hit = results[0]
+    assert (hit["kind"], hit["id"], hit["title"]) == ("thread", "t1", "Help with my strategy")
+    # The message with more matches is the thread's best one
+    assert hit["message_id"] == "m2"
+    assert "**RSI**" in hit["snippet"]
+
+
+def test_messages_are_not_results_without_thread_kind(index):
+    assert index.search("bands deviation", ["script"], limit=10, offset=0) == []
+    results = index.search("deviation", KINDS, limit=10, offset=0)
+    assert [(r["kind"], r["id"]) for r in results] == [("thread", "t2")]
+
+
+def test_thread_title_and_message_matches_are_one_hit(index):
+    _message(index, "m4", "t2", "Bollinger bands squeeze")
+    results = index.search("bollinger", ["thread"], limit=10, offset=0)
+    assert [r["id"] for r in results] == ["t2"]
+    assert results[0]["message_id"] == "m4"
+
+
+def test_orphan_messages_are_skipped(index):
+    _message(index, "m5", "gone", "Ichimoku cloud")
+    assert index.search("ichimoku", KINDS, limit=10, offset=0) == []
+
+
+def test_pagination_is_stable_and_disjoint():
+    index = InvertedIndex()
+    for i in range(7):
+        _script(index, f"s{i}", "Supertrend", updated_at=f"2026-01-0{i + 1}")
+
+    pages = [index.search("supertrend", ["script"], limit=3, offset=offset) for offset in (0, 3, 6)]
+    ids = [r["id"] for page in pages for r in page]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    # Equal ranks fall back to newest first
+    assert ids == [f"s{i}" for i in reversed(range(7))]
+    assert index.search("supertrend", ["script"], limit=3, offset=9) == []
+
+
+def test_replacing_and_removing_documents(index):
+    _script(index, "s3", "Volume RSI", "Session volume", "plot(volume)")
+    assert "s3" in [r["id"] for r in index.search("rsi", ["script"], limit=10, offset=0)]
+
+    index.remove("script", "s3")
+    assert index.search("volume", ["script"], limit=10, offset=0) == []
+    assert len(index) == 7
+
+
+@pytest.mark.parametrize("query, required, excluded", [
+    ("rsi divergence", ["rsi", "divergence"], []),
+    ("RSI the divergence", ["rsi", "divergence"], []),
+    ('"moving averages" -sma', ["moving", "average"], ["sma"]),
+    ('ema -"simple moving"', ["ema"], ["simple", "moving"]),
+    ("ta.crossover", ["ta", "crossover"], []),
+    ("rsi rsi RSIs", ["rsi"], []),
+    ("cross", ["cross"], []),
+    ("", [], []),
+])
+def test_parse_query(query, required, excluded):
+    assert _parse_query(query) == (required, excluded)
+
+
+def test_snippet_bolds_matches():
+    text = "Plots the RSI with overbought and oversold levels and RSI divergences"
+    snippet = _snippet(text, ["rsi", "divergence"])
+    assert snippet.count("**RSI**") == 2
+    assert "**divergences**" in snippet
+
+
+def test_snippet_windows_around_first_match():
+    text = "x " * 200 + "the supertrend line " + "y " * 200
+    snippet = _snippet(text, ["supertrend"])
+    assert "**supertrend**" in snippet
+    assert len(snippet) <= 160 + 4
+    assert snippet.startswith("x")
+
+
+def test_snippet_without_match_starts_at_text():
+    assert _snippet("Plain   text\nhere", ["absent"]) == "Plain text here"
+    assert _snippet("", ["rsi"]) == ""
+
+
+def test_snippet_does_not_bold_inside_words():
+    snippet = _snippet("ema and emacs", ["ema"])
+    assert snippet == "**ema** and emacs"
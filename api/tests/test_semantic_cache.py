@@ -0,0 +1,57 @@
+"""
+Semantic prompt index: near-duplicate prompts match, opposite or
+differently parameterized ones don't
+"""
+import pytest
+from services.semantic_cache import SemanticPromptIndex
+
+THRESHOLD = 0.8
+
+OPPOSITE_PAIRS = [
+    (
+        "bollinger bands strategy buy when price crosses above upper band",
+        "bollinger bands strategy sell when price crosses above upper band",
+    ),
+    (
+        "bollinger bands strategy buy when price crosses above upper band",
+        "bollinger bands strategy buy when price crosses below upper band",
+    ),
+    ("RSI strategy with stop loss", "RSI strategy without stop loss"),
+    ("go long on ema 20 ema 50 crossover", "go short on ema 20 ema 50 crossover"),
+    ("alert on ta.crossover of macd and signal", "alert on ta.crossunder of macd and signal"),
+]
+
+DIFFERENT_PAIRS = [
+    ("ema crossover strategy with take profit 2%", "ema crossover strategy with take profit 10%"),
+    ("rsi strategy period 14 buy below 30", "rsi strategy period 14 buy below 25"),
+    ("rsi indicator", "rsi strategy"),
+    ("ema 200 trend filter", "sma 200 trend filter"),
+    ("ta.ema 200 trend filter", "ta.sma 200 trend filter"),
+    ("rsi divergence indicator with alerts", "macd divergence indicator with alerts"),
+]
+
+
+@pytest.mark.parametrize("cached, prompt", OPPOSITE_PAIRS)
+def test_opposite_prompts_do_not_match(cached, prompt):
+    index = SemanticPromptIndex()
+    index.add("cached", cached, ttl=60)
+    assert index.lookup(prompt, THRESHOLD) is None
+
+
+@pytest.mark.parametrize("cached, prompt", DIFFERENT_PAIRS)
+def test_different_parameters_do_not_match(cached, prompt):
+    index = SemanticPromptIndex()
+    index.add("cached", cached, ttl=60)
+    assert index.lookup(prompt, THRESHOLD) is None
+
+
+def test_rephrased_prompt_matches():
+    index = SemanticPromptIndex()
+    index.add("cached", "RSI strategy with period 14, buy below 30", ttl=60)
+    assert index.lookup("rsi strategy, 14 period, buy below 30", THRESHOLD) is not None
+
+
+def test_equal_numbers_match():
+    index = SemanticPromptIndex()
+    index.add("cached", "ema 200 trend filter indicator, take profit 2.0%", ttl=60)
+    assert index.lookup("EMA 200 trend filter indicator with take profit 2%", THRESHOLD) is not None
@@ -1,8 +1,11 @@
 from datetime import datetime, timedelta, timezone
+import base64
 import hashlib
+import json
 import re
 import html
 from typing import Optional
+from utils.token_estimator import token_estimator
 
 
 def tokens_to_words(tokens: int) -> str:
@@ -26,25 +29,13 @@ def tokens_to_words(tokens: int) -> str:
 def estimate_tokens(text: str) -> int:
     """
     Estimate token count from text
-    Uses a more accurate estimation based on GPT tokenization patterns
+    Counts prose and code pieces separately, scaled by factors calibrated
+    against Gemini's reported prompt_token_count (see utils.token_estimator)
     """
     if not text:
         return 0
     
-    # Base estimation: ~4 characters per token for English
-    char_estimate = len(text) // 4
-    
-    # Adjust for code (more tokens per character)
-    code_indicators = ['def ', 'function', 'class ', 'import ', '//@version', 'indicator(', 'strategy(']
-    if any(indicator in text for indicator in code_indicators):
-        char_estimate = int(char_estimate * 1.2)
-    
-    # Adjust for whitespace-heavy text (fewer tokens)
-    whitespace_ratio = len(re.findall(r'\s', text)) / max(len(text), 1)
-    if whitespace_ratio > 0.2:
-        char_estimate = int(char_estimate * 0.9)
-    
-    return max(1, char_estimate)
+    return token_estimator.estimate(text)
 
 
 def format_number(num: int) -> str:
@@ -239,3 +230,45 @@ def format_token_usage(tokens_used: int, tokens_remaining: int) -> dict:
         "tokens_used_display": tokens_to_words(tokens_used),
         "tokens_remaining_display": tokens_to_words(tokens_remaining)
     }
+
+
+def format_sse(event: str, data: dict) -> str:
+    """
+    Format a Server-Sent Events message with a JSON payload
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def encode_cursor(values: dict) -> str:
+    """
+    Encode the sort key of the last row of a page as an opaque cursor
+    """
+    raw = json.dumps(values, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, keys: tuple) -> dict:
+    """
+    Decode a cursor from encode_cursor
+    Raises ValueError unless it holds exactly the expected keys
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise ValueError("Malformed cursor")
+    
+    if not isinstance(values, dict) or set(values) != set(keys):
+        raise ValueError("Malformed cursor")
+    return values
+
+
+def keyset_filter(column: str, value, tiebreak_value, descending: bool = True) -> str:
+    """
+    PostgREST or=() filter selecting rows after (value, id) in a
+    (column, id) ordering
+    """
+    op = "lt" if descending else "gt"
+    value = json.dumps(str(value))
+    tiebreak_value = json.dumps(str(tiebreak_value))
+    return f"{column}.{op}.{value},and({column}.eq.{value},id.{op}.{tiebreak_value})"
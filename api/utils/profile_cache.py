@@ -0,0 +1,166 @@
+"""
+User Profile Cache
+Two tiers in front of user_profiles: a short-lived in-process map and a
+shared Redis copy. Anything that writes a profile calls invalidate_profile
+
+Invalidation bumps a per-user version in Redis (and a worker-wide local
+epoch), and a profile read from the database is only cached under the
+version seen before the read, so a read that raced a write cannot put
+the old profile back. Redis calls run in a thread (the client is
+synchronous)
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from .rate_limiter import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds a profile is served from worker memory / from Redis.
+# Invalidation only clears the local tier of the worker that made the
+# write, so the local TTL bounds how stale another worker can be
+PROFILE_LOCAL_TTL = float(os.getenv("PROFILE_LOCAL_TTL", "10"))
+PROFILE_REDIS_TTL = int(os.getenv("PROFILE_REDIS_TTL", "300"))
+PROFILE_LOCAL_MAX_ENTRIES = int(os.getenv("PROFILE_LOCAL_MAX_ENTRIES", "10000"))
+
+_local: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+# Bumped by every invalidation in this worker; a database read that
+# overlapped one is not stored locally
+_local_epoch = 0
+
+_profile_stats = {
+    "local_hits": 0,
+    "redis_hits": 0,
+    "misses": 0,
+    "invalidations": 0
+}
+
+
+def _redis_key(user_id: str) -> str:
+    return f"profile:{user_id}"
+
+
+def _version_key(user_id: str) -> str:
+    return f"profile_version:{user_id}"
+
+
+def _store_local(user_id: str, profile: Dict) -> None:
+    _local[user_id] = (time.monotonic() + PROFILE_LOCAL_TTL, profile)
+    _local.move_to_end(user_id)
+    while len(_local) > PROFILE_LOCAL_MAX_ENTRIES:
+        _local.popitem(last=False)
+
+
+def _read_redis(user_id: str) -> Tuple[Optional[Dict], int]:
+    """
+    The Redis copy if it was stored under the current version, and that version
+    """
+    redis = get_redis()
+    if not redis:
+        return None, 0
+    cached, version = redis.mget(_redis_key(user_id), _version_key(user_id))
+    version = int(version or 0)
+    if cached:
+        entry = json.loads(cached)
+        if entry.get("version") == version:
+            return entry["profile"], version
+    return None, version
+
+
+def _write_redis(user_id: str, profile: Dict, version: int) -> None:
+    redis = get_redis()
+    if redis:
+        entry = {"version": version, "profile": profile}
+        redis.setex(_redis_key(user_id), PROFILE_REDIS_TTL, json.dumps(entry, default=str))
+
+
+def _bump_redis(user_id: str) -> None:
+    redis = get_redis()
+    if redis:
+        # The version outlives every copy stored under an older one
+        pipe = redis.pipeline()
+        pipe.incr(_version_key(user_id))
+        pipe.expire(_version_key(user_id), PROFILE_REDIS_TTL * 2)
+        pipe.delete(_redis_key(user_id))
+        pipe.exec()
+
+
+async def get_cached_profile(user_id: str) -> Tuple[Optional[Dict], Tuple[int, int]]:
+    """
+    Get a profile from worker memory, then Redis
+    Returns a copy (None on a miss) and a stamp to pass to cache_profile
+    with the profile read from the database
+    """
+    epoch = _local_epoch
+    entry = _local.get(user_id)
+    if entry:
+        expires_at, profile = entry
+        if expires_at > time.monotonic():
+            _profile_stats["local_hits"] += 1
+            return dict(profile), (epoch, 0)
+        del _local[user_id]
+
+    version = 0
+    try:
+        profile, version = await asyncio.to_thread(_read_redis, user_id)
+        if profile:
+            if epoch == _local_epoch:
+                _store_local(user_id, profile)
+            _profile_stats["redis_hits"] += 1
+            return dict(profile), (epoch, version)
+    except Exception as e:
+        logger.warning(f"Profile cache read error: {e}")
+
+    _profile_stats["misses"] += 1
+    return None, (epoch, version)
+
+
+async def cache_profile(profile: Dict, stamp: Tuple[int, int]) -> None:
+    """
+    Store a profile freshly read from the database in both tiers, unless
+    it was invalidated since the stamp was taken
+    """
+    epoch, version = stamp
+    user_id = profile['id']
+    if epoch == _local_epoch:
+        _store_local(user_id, dict(profile))
+
+    try:
+        await asyncio.to_thread(_write_redis, user_id, profile, version)
+    except Exception as e:
+        logger.warning(f"Profile cache write error: {e}")
+
+
+async def invalidate_profile(user_id: str) -> None:
+    """
+    Drop a user's cached profile after a write to user_profiles
+    """
+    global _local_epoch
+
+    _profile_stats["invalidations"] += 1
+    _local_epoch += 1
+    _local.pop(user_id, None)
+
+    try:
+        await asyncio.to_thread(_bump_redis, user_id)
+    except Exception as e:
+        logger.warning(f"Profile cache invalidation error: {e}")
+
+
+def get_profile_cache_stats() -> Dict:
+    """
+    Get hit rates per tier and the local cache size
+    """
+    lookups = _profile_stats["local_hits"] + _profile_stats["redis_hits"] + _profile_stats["misses"]
+    hits = _profile_stats["local_hits"] + _profile_stats["redis_hits"]
+    return {
+        **_profile_stats,
+        "lookups": lookups,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "local_entries": len(_local)
+    }
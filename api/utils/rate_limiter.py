@@ -5,6 +5,9 @@ Prevents abuse and stays within Gemini API free tier limits
 from fastapi import HTTPException
 from datetime import datetime, timezone, timedelta
 from typing import Optional
+import asyncio
+import heapq
+import itertools
 import os
 import logging
 
@@ -47,6 +50,26 @@ def get_redis():
     return None
 
 
+_async_redis_client = None
+
+def get_async_redis():
+    """
+    Get the asyncio Redis client for calls made while requests wait
+    Returns None when Redis is not configured (same rules as get_redis)
+    """
+    global _async_redis_client
+    
+    if _async_redis_client is not None:
+        return _async_redis_client
+    
+    if get_redis() is None:
+        return None
+    
+    from upstash_redis.asyncio import Redis as AsyncRedis
+    _async_redis_client = AsyncRedis(url=os.getenv("UPSTASH_REDIS_URL"), token=os.getenv("UPSTASH_REDIS_TOKEN"))
+    return _async_redis_client
+
+
 # Fallback in-memory storage (for local development without Redis)
 _memory_storage = {}
 
@@ -87,7 +110,7 @@ def _incr_key(key: str, ttl: int = 60) -> int:
             pipe = redis.pipeline()
             pipe.incr(key)
             pipe.expire(key, ttl)
-            results = pipe.execute()
+            results = pipe.exec()
             return int(results[0])
         except Exception as e:
             logger.warning(f"Redis incr error: {e}")
@@ -98,6 +121,20 @@ def _incr_key(key: str, ttl: int = 60) -> int:
     return current + 1
 
 
+def _decr_key(key: str) -> None:
+    """Decrement key in Redis or memory"""
+    redis = get_redis()
+    if redis:
+        try:
+            redis.decr(key)
+            return
+        except Exception as e:
+            logger.warning(f"Redis decr error: {e}")
+    
+    # Fallback to memory
+    _memory_storage[key] = max(0, _memory_storage.get(key, 0) - 1)
+
+
 # Rate limits by plan (requests per minute)
 PLAN_RATE_LIMITS = {
     "hobby": 10,
@@ -110,6 +147,29 @@ PLAN_RATE_LIMITS = {
 GEMINI_DAILY_LIMIT = 1_200_000  # 1.2M tokens/day
 GEMINI_MINUTE_LIMIT = 12  # 12 requests/minute
 
+# Admission queue for Gemini capacity: when the minute budget is used up,
+# requests wait (higher plans first) instead of failing straight away
+PLAN_PRIORITY = {
+    "business": 0,
+    "pro": 1,
+    "starter": 2,
+    "hobby": 3
+}
+
+# Longest time a request waits for capacity before it is shed (seconds)
+PLAN_MAX_QUEUE_WAIT = {
+    "business": float(os.getenv("GEMINI_QUEUE_WAIT_BUSINESS", "20")),
+    "pro": float(os.getenv("GEMINI_QUEUE_WAIT_PRO", "15")),
+    "starter": float(os.getenv("GEMINI_QUEUE_WAIT_STARTER", "8")),
+    "hobby": float(os.getenv("GEMINI_QUEUE_WAIT_HOBBY", "5"))
+}
+
+GEMINI_MAX_QUEUE_LENGTH = int(os.getenv("GEMINI_MAX_QUEUE_LENGTH", "100"))
+
+# Lower plans retry this much later per priority step when a new minute
+# opens, so higher plans waiting in other workers get the slots first
+QUEUE_PRIORITY_STAGGER_SECONDS = 0.05
+
 
 def check_user_rate_limit(user_id: str, plan: str) -> None:
     """
@@ -139,31 +199,13 @@ def check_user_rate_limit(user_id: str, plan: str) -> None:
         )
 
 
-def check_gemini_limits(tokens_to_use: int) -> None:
+def _check_daily_limit(tokens_to_use: int) -> None:
     """
-    Check global Gemini API limits (free tier protection)
-    Prevents exceeding daily token limits and per-minute request limits
+    Raise 503 if the tokens would exceed the daily Gemini budget
     """
     now = datetime.now(timezone.utc)
-    
-    # Keys for tracking
-    minute_key = f"gemini:minute:{now.strftime('%Y%m%d%H%M')}"
     daily_key = f"gemini:daily:{now.strftime('%Y%m%d')}"
     
-    # Check minute request limit
-    minute_requests = _get_key(minute_key) or 0
-    if minute_requests >= GEMINI_MINUTE_LIMIT:
-        logger.warning("Gemini minute rate limit reached")
-        raise HTTPException(
-            status_code=503,
-            detail={
-                "error": "service_busy",
-                "message": "Service is experiencing high traffic. Please try again in 60 seconds.",
-                "retry_after": 60
-            }
-        )
-    
-    # Check daily token limit
     daily_tokens = _get_key(daily_key) or 0
     if daily_tokens + tokens_to_use > GEMINI_DAILY_LIMIT:
         logger.warning(f"Gemini daily limit reached: {daily_tokens}/{GEMINI_DAILY_LIMIT}")
@@ -175,9 +217,178 @@ def check_gemini_limits(tokens_to_use: int) -> None:
                 "retry_after": _seconds_until_midnight()
             }
         )
+
+
+async def _incr_key_async(key: str, ttl: int = 60) -> int:
+    """Increment key in Redis or memory without blocking the event loop"""
+    redis = get_async_redis()
+    if redis:
+        try:
+            pipe = redis.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, ttl)
+            results = await pipe.exec()
+            return int(results[0])
+        except Exception as e:
+            logger.warning(f"Redis incr error: {e}")
+    
+    current = _memory_storage.get(key, 0)
+    _memory_storage[key] = current + 1
+    return current + 1
+
+
+async def _decr_key_async(key: str) -> None:
+    """Decrement key in Redis or memory without blocking the event loop"""
+    redis = get_async_redis()
+    if redis:
+        try:
+            await redis.decr(key)
+            return
+        except Exception as e:
+            logger.warning(f"Redis decr error: {e}")
+    
+    _memory_storage[key] = max(0, _memory_storage.get(key, 0) - 1)
+
+
+async def _try_reserve_minute_slot() -> bool:
+    """
+    Take one request from the current minute's Gemini budget
+    The counter is incremented first and rolled back if over the limit, so
+    concurrent workers never admit more than GEMINI_MINUTE_LIMIT together
+    """
+    now = datetime.now(timezone.utc)
+    minute_key = f"gemini:minute:{now.strftime('%Y%m%d%H%M')}"
+    
+    if await _incr_key_async(minute_key, ttl=60) <= GEMINI_MINUTE_LIMIT:
+        return True
+    
+    await _decr_key_async(minute_key)
+    return False
+
+
+async def reserve_gemini_request() -> bool:
+    """
+    Take one request from the current minute's Gemini budget without
+    queueing, for the extra calls of an admitted request (retries, hedges)
+    """
+    return await _try_reserve_minute_slot()
+
+
+def _seconds_until_next_minute() -> float:
+    now = datetime.now(timezone.utc)
+    return 60 - now.second - now.microsecond / 1_000_000
+
+
+# Waiting requests in this worker as a heap of (priority, arrival) entries
+_waiters = []
+_arrivals = itertools.count()
+_queue_changed: Optional[asyncio.Event] = None
+
+_admission_stats = {
+    "admitted": 0,
+    "admitted_after_wait": 0,
+    "shed": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0
+}
+
+
+def _notify_queue_changed() -> None:
+    """
+    Wake every waiter so the new head of the queue can try for a slot
+    """
+    global _queue_changed
+    if _queue_changed is not None:
+        _queue_changed.set()
+    _queue_changed = asyncio.Event()
+
+
+def _shed(plan: str, reason: str) -> HTTPException:
+    _admission_stats["shed"] += 1
+    logger.warning(f"Gemini request shed for {plan} plan: {reason}")
+    return HTTPException(
+        status_code=503,
+        detail={
+            "error": "service_busy",
+            "message": "Service is experiencing high traffic. Please try again shortly.",
+            "retry_after": max(1, int(_seconds_until_next_minute()))
+        }
+    )
+
+
+async def acquire_gemini_capacity(tokens_to_use: int, plan: str) -> None:
+    """
+    Wait for global Gemini capacity (free tier protection)
     
-    # Increment minute counter (60 second TTL)
-    _incr_key(minute_key, ttl=60)
+    The daily token budget is checked immediately. When the per-minute
+    request budget is used up the request queues, ordered by plan
+    (business > pro > starter > hobby) then arrival, and is admitted as
+    soon as a new minute opens. The budget only refills when a minute
+    opens, so a request whose plan wait limit ends before that is shed
+    with 503 straight away instead of waiting for the same answer; it is
+    also shed when the queue is full.
+    """
+    _check_daily_limit(tokens_to_use)
+    
+    if len(_waiters) >= GEMINI_MAX_QUEUE_LENGTH:
+        raise _shed(plan, "queue full")
+    
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + PLAN_MAX_QUEUE_WAIT.get(plan, PLAN_MAX_QUEUE_WAIT["hobby"])
+    priority = PLAN_PRIORITY.get(plan, PLAN_PRIORITY["hobby"])
+    
+    entry = (priority, next(_arrivals))
+    heapq.heappush(_waiters, entry)
+    if _queue_changed is None:
+        _notify_queue_changed()
+    
+    try:
+        while True:
+            # Taken before the Redis call, so a change during it is not missed
+            changed = _queue_changed
+            is_head = _waiters[0] == entry
+            if is_head and await _try_reserve_minute_slot():
+                waited = loop.time() - started
+                _admission_stats["admitted"] += 1
+                if waited > 0.001:
+                    _admission_stats["admitted_after_wait"] += 1
+                    _admission_stats["wait_seconds_total"] += waited
+                    _admission_stats["wait_seconds_max"] = max(_admission_stats["wait_seconds_max"], waited)
+                return
+            
+            # Slots free up when the next minute opens, or the head changes.
+            # The head has found the budget used up, so it sheds at once if
+            # its wait limit ends before the next minute
+            remaining = deadline - loop.time()
+            delay = _seconds_until_next_minute() + priority * QUEUE_PRIORITY_STAGGER_SECONDS
+            if remaining <= 0 or (is_head and delay > remaining):
+                raise _shed(plan, f"waited {loop.time() - started:.1f}s, next window in {delay:.1f}s")
+            
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=min(delay, remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        _waiters.remove(entry)
+        heapq.heapify(_waiters)
+        _notify_queue_changed()
+
+
+def get_admission_queue_status() -> dict:
+    """
+    Get admission queue depth and wait statistics for this worker
+    """
+    waited = _admission_stats["admitted_after_wait"]
+    return {
+        **_admission_stats,
+        "queued": len(_waiters),
+        "queued_by_plan": {
+            plan: sum(1 for p, _ in _waiters if p == priority)
+            for plan, priority in PLAN_PRIORITY.items()
+        },
+        "avg_wait_seconds": round(_admission_stats["wait_seconds_total"] / waited, 3) if waited else 0.0
+    }
 
 
 def record_gemini_usage(tokens_used: int) -> None:
@@ -193,7 +404,7 @@ def record_gemini_usage(tokens_used: int) -> None:
             pipe = redis.pipeline()
             pipe.incrby(daily_key, tokens_used)
             pipe.expire(daily_key, 86400)  # 24 hour TTL
-            pipe.execute()
+            pipe.exec()
             return
         except Exception as e:
             logger.warning(f"Redis record error: {e}")
@@ -4,34 +4,114 @@ Security utilities for authentication and authorization
 from fastapi import HTTPException, Security, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import jwt
+import hashlib
+import logging
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional, Dict
-from .supabase_client import get_supabase
+from functools import lru_cache
+from typing import Optional, Dict, Tuple
+from .supabase_client import get_db
+from .profile_cache import get_cached_profile, cache_profile
 from config import get_settings
 
+logger = logging.getLogger(__name__)
+
 security = HTTPBearer()
-settings = get_settings()
 
 JWT_ALGORITHM = "HS256"
 
+# Projects on asymmetric signing keys publish them as a JWKS
+JWT_ASYMMETRIC_ALGORITHMS = ["RS256", "ES256"]
+# Defaults to the project's well-known endpoint (settings are read on first use)
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL")
+JWKS_CACHE_SECONDS = int(os.getenv("JWKS_CACHE_SECONDS", "600"))
+
+# Verified claims by token digest, kept until the token's exp
+JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", "10000"))
+
+_verified_tokens: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+
+_jwt_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "expired": 0,
+    "evictions": 0
+}
+
+@lru_cache(maxsize=1)
+def _jwks_client() -> jwt.PyJWKClient:
+    url = SUPABASE_JWKS_URL or f"{get_settings().supabase_url}/auth/v1/.well-known/jwks.json"
+    return jwt.PyJWKClient(url, cache_keys=True, lifespan=JWKS_CACHE_SECONDS)
+
+def _decode(token: str) -> Dict:
+    """
+    Check the signature and claims of a token
+    HS256 tokens use the project's JWT secret, RS256/ES256 tokens the
+    published key matching their kid
+    """
+    algorithm = jwt.get_unverified_header(token).get("alg")
+    
+    if algorithm in JWT_ASYMMETRIC_ALGORITHMS:
+        try:
+            key = _jwks_client().get_signing_key_from_jwt(token).key
+        except jwt.PyJWKClientError as e:
+            logger.warning(f"JWKS lookup failed: {e}")
+            raise jwt.InvalidTokenError("Unknown signing key")
+        algorithms = JWT_ASYMMETRIC_ALGORITHMS
+    else:
+        key = get_settings().supabase_jwt_secret
+        algorithms = [JWT_ALGORITHM]
+    
+    return jwt.decode(token, key, algorithms=algorithms, audience="authenticated")
+
 def verify_token(token: str) -> Dict:
     """
     Verify JWT token from Supabase
     Returns decoded token payload
+    Tokens already verified are served from a bounded LRU until they expire
     """
+    digest = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    
+    entry = _verified_tokens.get(digest)
+    if entry:
+        expires_at, payload = entry
+        if expires_at > time.time():
+            _verified_tokens.move_to_end(digest)
+            _jwt_cache_stats["hits"] += 1
+            return dict(payload)
+        # Past exp: decode again so the caller gets the usual expiry error
+        del _verified_tokens[digest]
+        _jwt_cache_stats["expired"] += 1
+    
+    _jwt_cache_stats["misses"] += 1
+    
     try:
-        payload = jwt.decode(
-            token,
-            settings.supabase_jwt_secret,
-            algorithms=[JWT_ALGORITHM],
-            audience="authenticated"
-        )
-        return payload
+        payload = _decode(token)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    
+    if isinstance(payload.get("exp"), (int, float)):
+        _verified_tokens[digest] = (payload["exp"], payload)
+        while len(_verified_tokens) > JWT_CACHE_MAX_ENTRIES:
+            _verified_tokens.popitem(last=False)
+            _jwt_cache_stats["evictions"] += 1
+    
+    return dict(payload)
+
+def get_jwt_cache_stats() -> Dict:
+    """
+    Get verified-token cache hits, misses and evictions
+    """
+    lookups = _jwt_cache_stats["hits"] + _jwt_cache_stats["misses"]
+    return {
+        **_jwt_cache_stats,
+        "hit_rate": round(_jwt_cache_stats["hits"] / lookups, 4) if lookups else 0.0,
+        "entries": len(_verified_tokens)
+    }
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Security(security)
@@ -47,13 +127,19 @@ async def get_current_user(
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid token payload")
     
+    # Profiles are cached briefly; writers call invalidate_profile
+    profile, stamp = await get_cached_profile(user_id)
+    if profile:
+        return profile
+    
     # Get user profile from database
-    supabase = get_supabase()
-    response = supabase.table("user_profiles").select("*").eq("id", user_id).single().execute()
+    db = get_db()
+    response = await db.table("user_profiles").select("*").eq("id", user_id).single().execute()
     
     if not response.data:
         raise HTTPException(status_code=404, detail="User not found")
     
+    await cache_profile(response.data, stamp)
     return response.data
 
 def require_plan(required_plans: list):
@@ -1,22 +1,46 @@
 """
 Supabase Client Configuration
 Provides database connection and authentication
+
+get_supabase() is the synchronous client (auth admin calls and scripts);
+request handlers query PostgREST through get_db(), an async client sharing
+one pooled HTTP/2 connection pool per worker
 """
 from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+import asyncio
+import httpx
+import logging
 import os
 from functools import lru_cache
+from typing import Dict, Optional
 from config import get_settings
 
+logger = logging.getLogger(__name__)
+
+# Connection pool shared by all requests of a worker
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_POOL_KEEPALIVE = int(os.getenv("DB_POOL_KEEPALIVE", "10"))
+DB_KEEPALIVE_EXPIRY = float(os.getenv("DB_KEEPALIVE_EXPIRY", "30"))
+
+# Seconds; the pool timeout bounds the wait for a free connection
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_READ_TIMEOUT = float(os.getenv("DB_READ_TIMEOUT", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+DB_HTTP2 = os.getenv("DB_HTTP2", "true").lower() == "true"
+
 @lru_cache(maxsize=1)
 def get_supabase_client() -> Client:
     """
     Get Supabase client (cached for reuse)
     """
     settings = get_settings()
-    
+
     if not settings.supabase_url or not settings.supabase_service_key:
         raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_KEY must be set")
-    
+
     return create_client(settings.supabase_url, settings.supabase_service_key)
 
 def get_supabase() -> Client:
@@ -24,3 +48,104 @@ def get_supabase() -> Client:
     Dependency function for FastAPI
     """
     return get_supabase_client()
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """
+    Async PostgREST client on a bounded, keep-alive HTTP/2 pool
+    Queries are built like the sync client and finished with
+    `await query.execute()`
+    """
+
+    def create_session(self, base_url, headers, timeout, *args, **kwargs) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(
+                DB_READ_TIMEOUT,
+                connect=DB_CONNECT_TIMEOUT,
+                pool=DB_POOL_TIMEOUT
+            ),
+            limits=httpx.Limits(
+                max_connections=DB_POOL_SIZE,
+                max_keepalive_connections=DB_POOL_KEEPALIVE,
+                keepalive_expiry=DB_KEEPALIVE_EXPIRY
+            ),
+            http2=DB_HTTP2,
+            follow_redirects=True
+        )
+
+
+_db: Optional[PooledPostgrestClient] = None
+_db_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_db() -> PooledPostgrestClient:
+    """
+    Get the async PostgREST client for the running event loop
+    The pool is bound to the loop it was created on, so a new loop
+    (e.g. a fresh serverless invocation) gets a new client
+    """
+    global _db, _db_loop
+
+    loop = asyncio.get_running_loop()
+    if _db is not None and _db_loop is loop:
+        return _db
+
+    settings = get_settings()
+    if not settings.supabase_url or not settings.supabase_service_key:
+        raise ValueError("SUPABASE_URL and SUPABASE_SERVICE_KEY must be set")
+
+    key = settings.supabase_service_key
+    _db = PooledPostgrestClient(
+        f"{settings.supabase_url}/rest/v1",
+        headers={**DEFAULT_POSTGREST_CLIENT_HEADERS, "apiKey": key, "Authorization": f"Bearer {key}"}
+    )
+    _db_loop = loop
+    logger.info(f"Database pool created (size={DB_POOL_SIZE}, http2={DB_HTTP2})")
+    return _db
+
+async def close_db() -> None:
+    """
+    Close the pooled connections (application shutdown)
+    """
+    global _db, _db_loop
+
+    if _db is not None:
+        try:
+            await _db.aclose()
+        except Exception as e:
+            logger.warning(f"Database pool close error: {e}")
+    _db, _db_loop = None, None
+
+def get_db_stats() -> Dict:
+    """
+    Get pool configuration and whether a pool is open
+    """
+    return {
+        "open": _db is not None,
+        "pool_size": DB_POOL_SIZE,
+        "keepalive": DB_POOL_KEEPALIVE,
+        "http2": DB_HTTP2,
+        "timeouts": {
+            "connect": DB_CONNECT_TIMEOUT,
+            "read": DB_READ_TIMEOUT,
+            "pool": DB_POOL_TIMEOUT,
+        },
+    }
+
+def or_filter(query, filters: str):
+    """
+    Add a PostgREST or=(...) filter to a query
+    The postgrest release pinned by supabase 2.3.0 predates .or_()
+    """
+    query.params = query.params.add("or", f"({filters})")
+    return query
+
+def order_by(query, *columns: str):
+    """
+    Order by several columns in one order= parameter, e.g.
+    order_by(query, "last_activity.desc", "id.desc")
+    (repeated .order() calls send duplicate parameters in this release)
+    """
+    query.params = query.params.set("order", ",".join(columns))
+    return query
@@ -0,0 +1,257 @@
+"""
+Token Estimator - Piece-level token counts calibrated against Gemini usage
+Counts text in prose and Pine code separately, then scales each by a factor
+fitted from (estimate, actual prompt_token_count) pairs of real calls
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import threading
+from typing import Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Decay of old samples per new one, so factors follow model/tokenizer changes
+CALIBRATION_DECAY = 0.995
+
+# Factors stay at the default until this many samples have been seen.
+# The default keeps uncalibrated estimates at the level of the previous
+# len/4 estimate (the rulebook: 14701 pieces vs 12600), which balance
+# checks and admission were tuned for
+MIN_CALIBRATION_SAMPLES = 20
+DEFAULT_FACTOR = float(os.getenv("TOKEN_ESTIMATOR_DEFAULT_FACTOR", "0.86"))
+
+# The fit is stored in Redis every this many samples and loaded on a
+# process's first estimate, so cold starts begin calibrated
+CALIBRATION_REDIS_KEY = "token_estimator:calibration"
+CALIBRATION_SAVE_EVERY = 20
+
+# Fitted factors are clamped to this range to survive outliers
+FACTOR_RANGE = (0.5, 2.0)
+
+_PIECE_PATTERN = re.compile(r"[A-Za-z]+|\d+|\n|[ \t]+|[^\sA-Za-z\d]+")
+
+_CODE_LINE_PATTERN = re.compile(
+    r"^\s*(?://|#|```)|[=;{}]|\w+\s*\(.*\)|^\s{4,}\S|\b(?:if|else|for|while|var|varip|import|export|return)\b.*[=(:]"
+)
+
+
+def _count_pieces(text: str) -> int:
+    """
+    Count tokens the way SentencePiece-style tokenizers split text:
+    common words are one token and long ones a few, digits are split one
+    per token, symbol runs take about one token per two characters and
+    spaces attach to the following word
+    """
+    count = 0
+    for piece in _PIECE_PATTERN.findall(text):
+        first = piece[0]
+        if first.isalpha():
+            count += max(1, math.ceil(len(piece) / 6))
+        elif first.isdigit():
+            count += len(piece)
+        elif first == "\n":
+            count += 1
+        elif first in " \t":
+            # Indentation is a token of its own, single spaces are not
+            count += 1 if len(piece) > 1 else 0
+        else:
+            count += math.ceil(len(piece) / 2)
+    return count
+
+
+def split_counts(text: str) -> Tuple[int, int]:
+    """
+    Raw piece counts of the prose and code lines of a text
+    Fenced blocks are code, other lines by their shape
+    """
+    prose, code = [], []
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+            code.append(line)
+        elif in_fence or _CODE_LINE_PATTERN.search(line):
+            code.append(line)
+        else:
+            prose.append(line)
+    return _count_pieces("".join(prose)), _count_pieces("".join(code))
+
+
+class TokenEstimator:
+    """
+    Estimates tokens as prose_factor * prose_pieces + code_factor * code_pieces
+
+    The factors are a decayed least-squares fit of actual prompt token
+    counts on the two piece counts, updated from every recorded call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Decayed sums for the 2x2 normal equations
+        self._pp = self._pc = self._cc = self._pa = self._ca = 0.0
+        # Samples in the fit, including those loaded from Redis
+        self._fit_samples = 0
+        self._load_started = False
+        self.prose_factor = DEFAULT_FACTOR
+        self.code_factor = DEFAULT_FACTOR
+        self._stats = {
+            "samples": 0,
+            "abs_error_total": 0.0,
+            "abs_pct_error_total": 0.0,
+            "under_estimates": 0,
+            "over_estimates": 0,
+        }
+
+    def estimate(self, text: str) -> int:
+        self._ensure_loaded()
+        if not text:
+            return 0
+        prose, code = split_counts(text)
+        return max(1, round(self.prose_factor * prose + self.code_factor * code))
+
+    def record(self, text: str, actual_tokens: int) -> None:
+        """
+        Record the actual token count of a text sent to the model
+        Error statistics use the estimate as it was before this sample
+        """
+        self._ensure_loaded()
+        if not text or actual_tokens <= 0:
+            return
+
+        prose, code = split_counts(text)
+        estimated = self.prose_factor * prose + self.code_factor * code
+
+        with self._lock:
+            error = estimated - actual_tokens
+            self._stats["samples"] += 1
+            self._stats["abs_error_total"] += abs(error)
+            self._stats["abs_pct_error_total"] += abs(error) / actual_tokens
+            if error < 0:
+                self._stats["under_estimates"] += 1
+            elif error > 0:
+                self._stats["over_estimates"] += 1
+
+            d = CALIBRATION_DECAY
+            self._pp = self._pp * d + prose * prose
+            self._pc = self._pc * d + prose * code
+            self._cc = self._cc * d + code * code
+            self._pa = self._pa * d + prose * actual_tokens
+            self._ca = self._ca * d + code * actual_tokens
+            self._fit_samples += 1
+
+            if self._fit_samples >= MIN_CALIBRATION_SAMPLES:
+                self._refit()
+
+            snapshot = self._snapshot() if self._fit_samples % CALIBRATION_SAVE_EVERY == 0 else None
+
+        if snapshot:
+            self._schedule_save(snapshot)
+
+    def _snapshot(self) -> Dict:
+        return {
+            "pp": self._pp, "pc": self._pc, "cc": self._cc,
+            "pa": self._pa, "ca": self._ca, "samples": self._fit_samples,
+        }
+
+    def _schedule_save(self, snapshot: Dict) -> None:
+        """
+        Store the fit without blocking the event loop (the Redis client is synchronous)
+        """
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._save, snapshot)
+        except RuntimeError:
+            self._save(snapshot)
+
+    @staticmethod
+    def _save(snapshot: Dict) -> None:
+        from utils.rate_limiter import get_redis
+        redis = get_redis()
+        if not redis:
+            return
+        try:
+            redis.set(CALIBRATION_REDIS_KEY, json.dumps(snapshot))
+        except Exception as e:
+            logger.warning(f"Token calibration save error: {e}")
+
+    def _ensure_loaded(self) -> None:
+        """
+        Start loading the stored fit once per process, off the event loop
+        (serverless invocations re-enter the app lifespan, so this is
+        not done there)
+        """
+        if self._load_started:
+            return
+        self._load_started = True
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._load_quietly)
+        except RuntimeError:
+            self._load_quietly()
+
+    def _load_quietly(self) -> None:
+        try:
+            if self.load():
+                logger.info(f"Token calibration loaded: {self.get_stats()}")
+        except Exception as e:
+            logger.warning(f"Token calibration unavailable: {e}")
+
+    def load(self) -> bool:
+        """
+        Load the stored fit, unless this process has already fitted more
+        samples than it holds
+        Returns whether it was applied
+        """
+        from utils.rate_limiter import get_redis
+        redis = get_redis()
+        if not redis:
+            return False
+
+        cached = redis.get(CALIBRATION_REDIS_KEY)
+        if not cached:
+            return False
+
+        data = json.loads(cached)
+        with self._lock:
+            if int(data["samples"]) <= self._fit_samples:
+                return False
+            self._pp, self._pc, self._cc = data["pp"], data["pc"], data["cc"]
+            self._pa, self._ca = data["pa"], data["ca"]
+            self._fit_samples = int(data["samples"])
+            if self._fit_samples >= MIN_CALIBRATION_SAMPLES:
+                self._refit()
+        return True
+
+    def _refit(self) -> None:
+        low, high = FACTOR_RANGE
+        determinant = self._pp * self._cc - self._pc * self._pc
+
+        if abs(determinant) > 1e-9 * max(self._pp * self._cc, 1.0):
+            prose_factor = (self._pa * self._cc - self._ca * self._pc) / determinant
+            code_factor = (self._ca * self._pp - self._pa * self._pc) / determinant
+        else:
+            # Samples don't separate the two kinds yet, fit one shared factor
+            total = self._pp + 2 * self._pc + self._cc
+            prose_factor = code_factor = (self._pa + self._ca) / total if total else DEFAULT_FACTOR
+
+        self.prose_factor = min(max(prose_factor, low), high)
+        self.code_factor = min(max(code_factor, low), high)
+
+    def get_stats(self) -> Dict:
+        samples = self._stats["samples"]
+        return {
+            "samples": samples,
+            "calibrated": self._fit_samples >= MIN_CALIBRATION_SAMPLES,
+            "fit_samples": self._fit_samples,
+            "prose_factor": round(self.prose_factor, 4),
+            "code_factor": round(self.code_factor, 4),
+            "mean_abs_error": round(self._stats["abs_error_total"] / samples, 1) if samples else 0.0,
+            "mean_abs_pct_error": round(self._stats["abs_pct_error_total"] / samples, 4) if samples else 0.0,
+            "under_estimates": self._stats["under_estimates"],
+            "over_estimates": self._stats["over_estimates"],
+        }
+
+
+token_estimator = TokenEstimator()
@@ -0,0 +1,115 @@
+-- Record a completed generation in one transaction:
+-- create the thread if needed, write the user and assistant messages,
+-- deduct tokens and update the thread totals.
+-- p_total_tokens = 0 records a free exchange (cache hit) without a deduction.
+-- The output is already paid for upstream, so a failed deduction (e.g. a
+-- stream that overran the balance) still keeps the exchange: the balance
+-- is clamped at 0 and the rest is recorded in tokens_overdrawn.
+-- On any other failure nothing is written and success is false.
+
+alter table public.user_profiles
+  add column if not exists tokens_overdrawn bigint not null default 0;
+
+create or replace function public.record_generation(
+  p_user_id uuid,
+  p_thread_id uuid,
+  p_thread_title text,
+  p_thread_is_saved boolean,
+  p_thread_expires_at timestamptz,
+  p_prompt text,
+  p_prompt_tokens int,
+  p_content text,
+  p_input_tokens int,
+  p_output_tokens int,
+  p_total_tokens int,
+  p_action text default 'generate'
+)
+returns json as $$
+declare
+  v_thread_id uuid := p_thread_id;
+  v_user_message_id uuid;
+  v_message public.messages%rowtype;
+  v_deduct jsonb;
+  v_user jsonb;
+  v_remaining bigint;
+  v_shortfall bigint := 0;
+begin
+  if v_thread_id is null then
+    insert into public.threads (user_id, title, is_saved, expires_at)
+    values (p_user_id, p_thread_title, p_thread_is_saved, p_thread_expires_at)
+    returning id into v_thread_id;
+  end if;
+
+  -- now() is fixed for the transaction; clock_timestamp() keeps the two
+  -- messages in turn order when threads are read by created_at
+  insert into public.messages (thread_id, role, content, tokens_used, created_at)
+  values (v_thread_id, 'user', p_prompt, p_prompt_tokens, clock_timestamp())
+  returning id into v_user_message_id;
+
+  insert into public.messages (thread_id, role, content, tokens_used, input_tokens, output_tokens, created_at)
+  values (v_thread_id, 'assistant', p_content, p_total_tokens, p_input_tokens, p_output_tokens, clock_timestamp())
+  returning * into v_message;
+
+  -- Increment in place: concurrent generations on a thread cannot lose updates
+  update public.threads
+  set total_tokens_used = coalesce(total_tokens_used, 0) + p_total_tokens,
+      last_activity = now()
+  where id = v_thread_id and user_id = p_user_id;
+
+  if not found then
+    raise exception 'thread_not_found';
+  end if;
+
+  if p_total_tokens > 0 then
+    -- Own subtransaction: a failed deduction rolls back only itself
+    begin
+      v_deduct := public.deduct_user_tokens(p_user_id, p_total_tokens, v_thread_id, p_action)::jsonb;
+    exception when others then
+      v_deduct := jsonb_build_object('success', false, 'error', sqlerrm);
+    end;
+
+    if coalesce((v_deduct->>'success')::boolean, false) then
+      v_user := v_deduct->'data';
+    else
+      select tokens_remaining into v_remaining
+      from public.user_profiles
+      where id = p_user_id
+      for update;
+
+      if not found then
+        raise exception '%', coalesce(v_deduct->>'error', 'profile_not_found');
+      end if;
+
+      v_shortfall := greatest(p_total_tokens - coalesce(v_remaining, 0), 0);
+
+      update public.user_profiles
+      set tokens_remaining = greatest(coalesce(tokens_remaining, 0) - p_total_tokens, 0),
+          tokens_used_this_month = coalesce(tokens_used_this_month, 0) + p_total_tokens,
+          tokens_overdrawn = tokens_overdrawn + v_shortfall
+      where id = p_user_id
+      returning to_jsonb(user_profiles.*) into v_user;
+
+      insert into public.token_usage (user_id, thread_id, action, total_tokens)
+      values (p_user_id, v_thread_id, p_action, p_total_tokens);
+    end if;
+  end if;
+
+  return json_build_object(
+    'success', true,
+    'data', json_build_object(
+      'thread_id', v_thread_id,
+      'user_message_id', v_user_message_id,
+      'message', row_to_json(v_message),
+      'user', v_user,
+      'shortfall', v_shortfall
+    )
+  );
+exception when others then
+  -- The block's writes are rolled back before this handler runs
+  return json_build_object('success', false, 'error', sqlerrm);
+end;
+$$ language plpgsql security definer set search_path = public;
+
+revoke execute on function public.record_generation(uuid, uuid, text, boolean, timestamptz, text, int, text, int, int, int, text) from public, anon, authenticated;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,89 @@
+-- Thread list without message bodies:
+-- message_count and preview live on the thread row and are maintained
+-- by triggers on messages; the list pages by keyset on (last_activity, id).
+
+alter table public.threads
+  add column if not exists message_count int not null default 0,
+  add column if not exists preview text not null default '';
+
+-- The list pages by last_activity, so it must always be set
+update public.threads
+set last_activity = coalesce(created_at, now())
+where last_activity is null;
+
+alter table public.threads
+  alter column last_activity set default now(),
+  alter column last_activity set not null;
+
+-- Backfill: preview is the start of the latest assistant message,
+-- or of the latest message when the thread has no assistant reply yet
+update public.threads t
+set message_count = counts.message_count,
+    preview = coalesce(left(latest.content, 100), '')
+from (
+  select thread_id, count(*)::int as message_count
+  from public.messages
+  group by thread_id
+) counts
+left join lateral (
+  select m.content
+  from public.messages m
+  where m.thread_id = counts.thread_id
+  order by (m.role = 'assistant') desc, m.created_at desc
+  limit 1
+) latest on true
+where t.id = counts.thread_id;
+
+create or replace function public.sync_thread_on_message_insert()
+returns trigger as $$
+begin
+  if new.role = 'assistant' then
+    update public.threads
+    set message_count = message_count + 1,
+        preview = left(new.content, 100)
+    where id = new.thread_id;
+  else
+    -- User messages only become the preview until an assistant replies
+    update public.threads t
+    set message_count = message_count + 1,
+        preview = case
+          when exists (
+            select 1 from public.messages m
+            where m.thread_id = new.thread_id and m.role = 'assistant'
+          ) then t.preview
+          else left(new.content, 100)
+        end
+    where id = new.thread_id;
+  end if;
+  return new;
+end;
+$$ language plpgsql security definer;
+
+create or replace function public.sync_thread_on_message_delete()
+returns trigger as $$
+begin
+  update public.threads
+  set message_count = greatest(message_count - 1, 0)
+  where id = old.thread_id;
+  return old;
+end;
+$$ language plpgsql security definer;
+
+drop trigger if exists on_message_inserted on public.messages;
+create trigger on_message_inserted
+  after insert on public.messages
+  for each row execute procedure public.sync_thread_on_message_insert();
+
+drop trigger if exists on_message_deleted on public.messages;
+create trigger on_message_deleted
+  after delete on public.messages
+  for each row execute procedure public.sync_thread_on_message_delete();
+
+-- Keyset order of the thread list, and the per-thread message lookups above
+create index if not exists threads_user_activity_idx
+  on public.threads (user_id, last_activity desc, id desc);
+
+create index if not exists messages_thread_role_idx
+  on public.messages (thread_id, role);
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,13 @@
+-- Message sizes without reading bodies: lets the thread view page
+-- message headers and fetch long bodies on demand.
+-- Adding a stored generated column rewrites messages once.
+
+alter table public.messages
+  add column if not exists content_length int
+  generated always as (char_length(content)) stored;
+
+-- Newest-first message pages of a thread, keyset on (created_at, id)
+create index if not exists messages_thread_created_idx
+  on public.messages (thread_id, created_at desc, id desc);
+
+NOTIFY pgrst, 'reload schema';
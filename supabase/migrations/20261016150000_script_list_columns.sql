@@ -0,0 +1,17 @@
+-- Script library listing without code: the preview is computed once on
+-- write, and list pages go newest first by keyset on (created_at, id).
+-- Adding a stored generated column rewrites scripts once.
+
+alter table public.scripts
+  add column if not exists code_preview text
+  generated always as (
+    left(code, 150) || case when char_length(code) > 150 then '...' else '' end
+  ) stored;
+
+create index if not exists scripts_user_created_idx
+  on public.scripts (user_id, created_at desc, id desc);
+
+create index if not exists scripts_user_type_created_idx
+  on public.scripts (user_id, strategy_type, created_at desc, id desc);
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,118 @@
+-- Full-text search over the script library and threads.
+-- Each table keeps a stored tsvector; punctuation is blanked first so
+-- Pine identifiers like ta.crossover index as their parts.
+-- Weights: script name / thread title A, description B, code C, message text D.
+-- Adding the stored columns rewrites scripts, threads and messages once.
+
+create or replace function public.search_document(p_text text)
+returns text as $$
+  select regexp_replace(coalesce(p_text, ''), '[^[:alnum:]_[:space:]]+', ' ', 'g');
+$$ language sql immutable;
+
+alter table public.scripts
+  add column if not exists search_vector tsvector
+  generated always as (
+    setweight(to_tsvector('english', public.search_document(name)), 'A') ||
+    setweight(to_tsvector('english', public.search_document(description)), 'B') ||
+    setweight(to_tsvector('english', public.search_document(left(code, 100000))), 'C')
+  ) stored;
+
+alter table public.threads
+  add column if not exists search_vector tsvector
+  generated always as (
+    setweight(to_tsvector('english', public.search_document(title)), 'A')
+  ) stored;
+
+alter table public.messages
+  add column if not exists search_vector tsvector
+  generated always as (
+    to_tsvector('english', public.search_document(left(content, 100000)))
+  ) stored;
+
+create index if not exists scripts_search_idx on public.scripts using gin (search_vector);
+create index if not exists threads_search_idx on public.threads using gin (search_vector);
+create index if not exists messages_search_idx on public.messages using gin (search_vector);
+
+-- Ranked matches of p_query (web search syntax: "phrase", or, -word)
+-- among the user's scripts and threads. A thread ranks by its title or
+-- its best matching message, whichever is higher; message_id is that
+-- message. Snippets are only built for the returned page.
+create or replace function public.search_library(
+  p_user_id uuid,
+  p_query text,
+  p_kinds text[] default array['script', 'thread'],
+  p_limit int default 20,
+  p_offset int default 0
+)
+returns table (
+  kind text,
+  id uuid,
+  title text,
+  snippet text,
+  message_id uuid,
+  rank real,
+  updated_at timestamptz
+) as $$
+  with q as (
+    select websearch_to_tsquery(
+      'english', regexp_replace(p_query, '[^[:alnum:]_[:space:]"-]+', ' ', 'g')
+    ) as query
+  ),
+  message_hits as (
+    select distinct on (m.thread_id)
+      m.thread_id, m.id, ts_rank_cd(m.search_vector, q.query) as rank
+    from public.messages m
+    join public.threads t on t.id = m.thread_id
+    cross join q
+    where 'thread' = any(p_kinds)
+      and t.user_id = p_user_id
+      and m.search_vector @@ q.query
+    order by m.thread_id, rank desc, m.created_at desc
+  ),
+  hits as (
+    select 'script'::text as kind, s.id, s.name as title, null::uuid as message_id,
+           ts_rank_cd(s.search_vector, q.query) as rank, s.created_at as updated_at
+    from public.scripts s
+    cross join q
+    where 'script' = any(p_kinds)
+      and s.user_id = p_user_id
+      and s.search_vector @@ q.query
+    union all
+    select 'thread', t.id, t.title, mh.id,
+           greatest(ts_rank_cd(t.search_vector, q.query), coalesce(mh.rank, 0)),
+           t.last_activity
+    from public.threads t
+    cross join q
+    left join message_hits mh on mh.thread_id = t.id
+    where 'thread' = any(p_kinds)
+      and t.user_id = p_user_id
+      and (t.search_vector @@ q.query or mh.id is not null)
+  ),
+  page as (
+    select * from hits
+    order by rank desc, updated_at desc, id
+    limit least(greatest(p_limit, 1), 100)
+    offset greatest(p_offset, 0)
+  )
+  select p.kind, p.id, p.title,
+         ts_headline(
+           'english',
+           case
+             when p.kind = 'script' then coalesce(s.description, '') || ' ' || left(s.code, 5000)
+             else left(coalesce(m.content, t.preview, p.title), 5000)
+           end,
+           q.query,
+           'StartSel=**, StopSel=**, MaxWords=25, MinWords=10, MaxFragments=1'
+         ) as snippet,
+         p.message_id, p.rank, p.updated_at
+  from page p
+  cross join q
+  left join public.scripts s on p.kind = 'script' and s.id = p.id
+  left join public.threads t on p.kind = 'thread' and t.id = p.id
+  left join public.messages m on m.id = p.message_id
+  order by p.rank desc, p.updated_at desc, p.id;
+$$ language sql stable security definer;
+
+revoke execute on function public.search_library(uuid, text, text[], int, int) from public, anon, authenticated;
+
+NOTIFY pgrst, 'reload schema';
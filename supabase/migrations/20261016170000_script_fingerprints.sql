@@ -0,0 +1,64 @@
+-- Near-duplicate script lookup: each script stores the winnowed k-gram
+-- hashes of its normalized code (computed by the API on save, at most
+-- 256 sorted ints). Candidates share at least one hash (GIN overlap),
+-- then rank by estimated Jaccard similarity. Each stored set is the
+-- bottom 256 of the script's hashes, so the estimate is taken over the
+-- 256 smallest hashes of the union (the bottom-k estimator): exact when
+-- the union has at most 256, unbiased beyond that. Plain Jaccard of two
+-- capped sets would understate the overlap of long scripts.
+-- Existing scripts are fingerprinted by the API in the background after
+-- their owner's first lookup.
+
+alter table public.scripts
+  add column if not exists fingerprint int[];
+
+create index if not exists scripts_fingerprint_idx
+  on public.scripts using gin (fingerprint);
+
+create or replace function public.similar_scripts(
+  p_user_id uuid,
+  p_fingerprint int[],
+  p_exclude_id uuid default null,
+  p_min_similarity real default 0.5,
+  p_limit int default 5
+)
+returns table (
+  id uuid,
+  name text,
+  description text,
+  strategy_type text,
+  created_at timestamptz,
+  similarity real
+) as $$
+  with candidates as (
+    select s.id, s.name, s.description, s.strategy_type, s.created_at, s.fingerprint
+    from public.scripts s
+    where s.user_id = p_user_id
+      and s.fingerprint && p_fingerprint
+      and (p_exclude_id is null or s.id <> p_exclude_id)
+  ),
+  scored as (
+    select c.id, c.name, c.description, c.strategy_type, c.created_at,
+           (
+             -- share of the union's bottom 256 (FINGERPRINT_MAX_HASHES) in both sets
+             select avg((u.h = any(c.fingerprint) and u.h = any(p_fingerprint))::int)::real
+             from (
+               select h from unnest(c.fingerprint) as h
+               union
+               select h from unnest(p_fingerprint) as h
+               order by h
+               limit 256
+             ) u
+           ) as similarity
+    from candidates c
+  )
+  select sc.id, sc.name, sc.description, sc.strategy_type::text, sc.created_at, sc.similarity
+  from scored sc
+  where sc.similarity >= p_min_similarity
+  order by sc.similarity desc, sc.created_at desc
+  limit least(greatest(p_limit, 1), 20);
+$$ language sql stable security definer;
+
+revoke execute on function public.similar_scripts(uuid, int[], uuid, real, int) from public, anon, authenticated;
+
+NOTIFY pgrst, 'reload schema';
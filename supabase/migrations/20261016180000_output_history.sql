@@ -0,0 +1,34 @@
+-- Output length history for the API's output predictor: recent
+-- generations as (prompt, output_tokens) pairs, without reading any
+-- assistant bodies. A generation is an assistant message with
+-- output_tokens whose preceding message in the thread is a user prompt
+-- (refinement requests excluded).
+
+create index if not exists messages_output_history_idx
+  on public.messages (created_at desc)
+  where role = 'assistant' and output_tokens > 0;
+
+create or replace function public.generation_output_history(p_limit int default 1000)
+returns table (prompt text, output_tokens int) as $$
+  select prev.content, a.output_tokens::int
+  from (
+    select m.thread_id, m.created_at, m.output_tokens
+    from public.messages m
+    where m.role = 'assistant' and m.output_tokens > 0
+    order by m.created_at desc
+    limit least(greatest(p_limit, 0), 10000)
+  ) a
+  cross join lateral (
+    select p.role, p.content
+    from public.messages p
+    where p.thread_id = a.thread_id and p.created_at < a.created_at
+    order by p.created_at desc, p.id desc
+    limit 1
+  ) prev
+  where prev.role = 'user'
+    and prev.content not like '[Refinement Request]%';
+$$ language sql stable security definer set search_path = public;
+
+revoke execute on function public.generation_output_history(int) from public, anon, authenticated;
+
+NOTIFY pgrst, 'reload schema';